@@ -167,10 +167,13 @@ class FluxServiceRunPod {
             if (data.status === 'COMPLETED') {
                 this.activeJobs.delete(jobId);
                 
+                // The streaming handler aggregates its results into an array
+                const output = Array.isArray(data.output) ? data.output[0] : data.output;
+                
                 // Extract image data from output based on v5.0.0+ format
-                if (data.output && data.output.images && data.output.images.length > 0) {
+                if (output && output.images && output.images.length > 0) {
                     // v5.0.0+ format returns images as an array
-                    const firstImage = data.output.images[0];
+                    const firstImage = output.images[0];
                     
                     if (firstImage.type === 'base64' && firstImage.data) {
                         return {
@@ -178,19 +181,32 @@ class FluxServiceRunPod {
                             image: firstImage.data,
                             filename: firstImage.filename || `runpod_${jobId}.png`
                         };
-                    } else if (firstImage.type === 's3_url' && firstImage.data) {
-                        // If S3 URL, we'd need to fetch it - for now just return the URL
+                    } else if ((firstImage.type === 's3_url' || firstImage.type === 'url') && firstImage.data) {
+                        // Images in an object store are fetched here so callers still get base64
+                        if (/^https?:\/\//.test(firstImage.data)) {
+                            const imageResponse = await axios.get(firstImage.data, { responseType: 'arraybuffer' });
+                            return {
+                                status: 'success',
+                                image: Buffer.from(imageResponse.data).toString('base64'),
+                                filename: firstImage.filename || `runpod_${jobId}.png`
+                            };
+                        }
                         return {
                             status: 'success',
                             imageUrl: firstImage.data,
                             filename: firstImage.filename || `runpod_${jobId}.png`
                         };
                     }
-                } else if (data.output && data.output.message) {
+                } else if (output && output.error) {
+                    return {
+                        status: 'error',
+                        error: output.error
+                    };
+                } else if (output && output.message) {
                     // Legacy format (< v5.0.0)
                     return {
                         status: 'success',
-                        image: data.output.message,
+                        image: output.message,
                         filename: `runpod_${jobId}.png`
                     };
                 }
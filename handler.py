@@ -12,15 +12,47 @@ import base64
 import requests
 from typing import Dict, Any
 
+from output_store import get_output_store, store_image
+
 # Add ComfyUI to path
 sys.path.append('/workspace/ComfyUI')
 
+# Overridable to point the handler at an already running ComfyUI (see runpod/bench_handlers.py)
+COMFYUI_URL = os.environ.get("COMFYUI_URL", "http://localhost:8188")
+COMFYUI_DIR = os.environ.get("COMFYUI_DIR", "/workspace/ComfyUI")
+
+# Object store for result images (see output_store.py), set up by the first job;
+# None means base64 responses
+output_store = None
+output_store_checked = False
+
+def init_output_store():
+    """Set up the configured object store once; a broken configuration falls back to base64"""
+    global output_store, output_store_checked
+    if not output_store_checked:
+        output_store_checked = True
+        try:
+            output_store = get_output_store()
+            if output_store:
+                print(f"Storing result images in {type(output_store).__name__}")
+        except Exception as e:
+            print(f"Could not set up output store, falling back to base64: {e}")
+    return output_store
+
 # Start ComfyUI server
 def start_comfyui():
     """Start ComfyUI server in the background"""
+    # Reuse a server that is already up instead of starting a second one
+    try:
+        if requests.get(f"{COMFYUI_URL}/system_stats", timeout=2).status_code == 200:
+            print(f"Using running ComfyUI server at {COMFYUI_URL}")
+            return None
+    except requests.RequestException:
+        pass
+    
     cmd = [
         "python3",
-        "/workspace/ComfyUI/main.py",
+        f"{COMFYUI_DIR}/main.py",
         "--listen",
         "0.0.0.0",
         "--port", "8188"
@@ -32,7 +64,7 @@ def start_comfyui():
     # Wait for server to be ready
     for i in range(30):  # 30 second timeout
         try:
-            response = requests.get("http://localhost:8188/system_stats")
+            response = requests.get(f"{COMFYUI_URL}/system_stats")
             if response.status_code == 200:
                 print("ComfyUI server is ready")
                 return process
@@ -64,9 +96,13 @@ def handler(job):
         else:
             return {"error": "No workflow provided"}
         
+        # Results go to the object store when one is configured; base64 is opt-in
+        init_output_store()
+        output_mode = job_input.get("output_mode", "store" if output_store else "base64")
+        
         # Submit workflow to ComfyUI
         prompt_response = requests.post(
-            "http://localhost:8188/prompt",
+            f"{COMFYUI_URL}/prompt",
             json={"prompt": workflow}
         )
         
@@ -79,7 +115,7 @@ def handler(job):
         # Poll for completion
         max_attempts = 120  # 10 minutes
         for attempt in range(max_attempts):
-            history_response = requests.get(f"http://localhost:8188/history/{prompt_id}")
+            history_response = requests.get(f"{COMFYUI_URL}/history/{prompt_id}")
             
             if history_response.status_code == 200:
                 history = history_response.json()
@@ -92,9 +128,20 @@ def handler(job):
                         if "images" in node_output:
                             images = []
                             for image_info in node_output["images"]:
+                                # Upload straight from ComfyUI's output dir when storing
+                                image_path = os.path.join(
+                                    COMFYUI_DIR,
+                                    image_info.get("type", "output"),
+                                    image_info.get("subfolder", ""),
+                                    image_info["filename"]
+                                )
+                                if output_mode == "store" and output_store and os.path.isfile(image_path):
+                                    images.append(store_image(output_store, image_path, image_info["filename"]))
+                                    continue
+                                
                                 # Get image data
                                 image_response = requests.get(
-                                    f"http://localhost:8188/view",
+                                    f"{COMFYUI_URL}/view",
                                     params={
                                         "filename": image_info["filename"],
                                         "subfolder": image_info.get("subfolder", ""),
@@ -1433,7 +1433,7 @@ ipcMain.handle('whisper-transcribe', async (event, { audioPath, modelName, langu
     }
 });
 
-ipcMain.handle('whisper-transcribe-base64', async (event, { audioData, filename, modelName, language }) => {
+ipcMain.handle('whisper-transcribe-base64', async (event, { audioData, filename, modelName, language, segmentsPath }) => {
     try {
         // Convert base64 to file temporarily
         const tempPath = path.join(os.tmpdir(), `whisper-${Date.now()}-${filename}`);
@@ -1443,12 +1443,26 @@ ipcMain.handle('whisper-transcribe-base64', async (event, { audioData, filename,
         // Create a job-like response for compatibility
         const jobId = `local-${Date.now()}`;
         
-        // Start transcription asynchronously
+        // Start transcription asynchronously; progress is reported through the job status
+        // and the segments decoded so far are kept in segmentsPath
+        global.whisperJobs = global.whisperJobs || {};
+        global.whisperJobs[jobId] = { status: 'processing' };
         setTimeout(async () => {
             try {
                 const result = await whisperLocal.transcribe(tempPath, {
                     modelName: modelName || 'base',
-                    language: language || 'en'
+                    language: language || 'en',
+                    segmentsPath,
+                    onProgress: ({ processedSeconds, totalSeconds }) => {
+                        const percent = totalSeconds ? Math.round(100 * processedSeconds / totalSeconds) : 0;
+                        global.whisperJobs[jobId] = {
+                            status: 'processing',
+                            progress: percent,
+                            processedSeconds,
+                            totalSeconds,
+                            message: `Transcribing ${filename}: ${percent}%`
+                        };
+                    }
                 });
                 
                 // Store result temporarily
@@ -1746,6 +1760,9 @@ app.on('window-all-closed', () => {
     // Stop terminal server
     terminalServer.stop();
     
+    // Stop the local transcription service and free its models
+    whisperLocal.unloadAllModels();
+    
     if (process.platform !== 'darwin') {
         app.quit();
     }
@@ -0,0 +1,216 @@
+"""
+Whole-book character extraction helpers for the Kimi worker
+
+Chapters are split into chunks that fit the model context and each chunk is
+extracted on its own (the map step, batched together by the engine). The
+per-chunk character records are then merged by a deterministic reduce step
+into one database in the AudioBookVisualizer character format. Per-chapter
+results are cached by a hash of the chapter text and extraction settings, so
+re-running a book after editing one chapter only re-extracts that chapter.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXTRACTION_PROMPT = """You are an intelligent character database manager for an audiobook. You will be given part of one chapter transcript. Identify every character that appears in it and describe their physical appearance as precisely as the text allows.
+
+Return ONLY a JSON array of character records with this structure:
+{
+  "name": "Character Full Name",
+  "baseDescription": "Detailed physical description including face, body, typical clothing and distinguishing features",
+  "imagePrompt": "Clean head-to-toe visual description for image generation, always including footwear, with no commentary",
+  "photo": "placeholder.png",
+  "chapters": [1],
+  "personalityTraits": "Brief personality description based on actions/dialogue",
+  "subCharacteristics": [
+    {
+      "id": "short_snake_case_id",
+      "name": "Name of this version of the character",
+      "ageRange": "Approximate age range",
+      "description": "Appearance in this state",
+      "imagePrompt": "Clean visual description of this state",
+      "chapters": [1],
+      "triggerEvent": "What caused this appearance",
+      "photo": "placeholder.png"
+    }
+  ]
+}
+
+Use an empty subCharacteristics list when the character has a single appearance. Return [] if no characters appear."""
+
+PLACEHOLDER_PHOTO = "placeholder.png"
+TEXT_FIELDS = ["baseDescription", "imagePrompt", "personalityTraits"]
+SUB_TEXT_FIELDS = ["name", "ageRange", "description", "imagePrompt", "triggerEvent"]
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def normalize_chapters(chapters):
+    """Accept chapter texts or {number, title, text} objects, numbering from 1 by default"""
+    normalized = []
+    for index, chapter in enumerate(chapters):
+        if isinstance(chapter, str):
+            chapter = {"text": chapter}
+        normalized.append({
+            "number": chapter.get("number", index + 1),
+            "title": chapter.get("title", ""),
+            "text": chapter.get("text", ""),
+        })
+    return normalized
+
+def chunk_text(text, count_tokens, max_tokens):
+    """Split text into chunks of at most max_tokens, breaking between sentences where possible"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence in SENTENCE_END.split(text.strip()):
+        sentence_tokens = count_tokens(sentence)
+        if sentence_tokens > max_tokens:
+            # A run-on "sentence" (transcripts can lack punctuation): split it on words
+            words = sentence.split()
+            step = max(1, len(words) * max_tokens // sentence_tokens)
+            pieces = [" ".join(words[i:i + step]) for i in range(0, len(words), step)]
+        else:
+            pieces = [sentence]
+        for piece in pieces:
+            piece_tokens = sentence_tokens if piece is sentence else count_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(" ".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def chapter_prompt(chapter, chunk, chunk_index, chunk_count):
+    """User prompt for one chunk of a chapter"""
+    title = f": {chapter['title']}" if chapter["title"] else ""
+    part = f" (part {chunk_index + 1} of {chunk_count})" if chunk_count > 1 else ""
+    return f"=== CHAPTER {chapter['number']}{title}{part} ===\n{chunk}"
+
+def parse_characters(text):
+    """Pull the JSON array of character records out of a model response"""
+    start = text.find("[")
+    end = text.rfind("]")
+    if start == -1 or end < start:
+        raise ValueError("No JSON array in extraction output")
+    records = json.loads(text[start:end + 1])
+    if not isinstance(records, list):
+        raise ValueError("Extraction output is not a JSON array")
+    return [record for record in records if isinstance(record, dict) and record.get("name")]
+
+def normalize_name(name):
+    return " ".join(str(name).split()).casefold()
+
+def _longer(current, candidate):
+    """Keep the more detailed text; ties go to what was seen first"""
+    if isinstance(candidate, str) and len(candidate.strip()) > len(current):
+        return candidate.strip()
+    return current
+
+def _chapter_numbers(values):
+    numbers = set()
+    for value in values or []:
+        try:
+            numbers.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return numbers
+
+def _merge_sub_characteristics(target, subs):
+    by_id = {normalize_name(sub.get("id") or sub.get("name", "")): sub for sub in target}
+    for sub in subs or []:
+        if not isinstance(sub, dict):
+            continue
+        key = normalize_name(sub.get("id") or sub.get("name", ""))
+        if not key:
+            continue
+        if key not in by_id:
+            by_id[key] = {"id": sub.get("id") or key.replace(" ", "_"), "chapters": [], "photo": PLACEHOLDER_PHOTO}
+            for field in SUB_TEXT_FIELDS:
+                by_id[key][field] = ""
+            target.append(by_id[key])
+        merged = by_id[key]
+        for field in SUB_TEXT_FIELDS:
+            merged[field] = _longer(merged[field], sub.get(field))
+        merged["chapters"] = sorted(set(merged["chapters"]) | _chapter_numbers(sub.get("chapters")))
+        if merged["photo"] == PLACEHOLDER_PHOTO and sub.get("photo"):
+            merged["photo"] = sub["photo"]
+
+def merge_characters(record_lists):
+    """
+    Merge lists of character records into one database.
+    
+    Records are matched by normalized name. Chapter lists are unioned, the most
+    detailed text of each field wins, and a real photo beats the placeholder.
+    Characters keep the order in which they were first seen, so the result
+    only depends on the order of record_lists (existing database first, then
+    chapters in book order).
+    """
+    merged = {}
+    for records in record_lists:
+        for record in records:
+            key = normalize_name(record["name"])
+            if key not in merged:
+                merged[key] = {
+                    "name": " ".join(str(record["name"]).split()),
+                    "baseDescription": "",
+                    "imagePrompt": "",
+                    "photo": PLACEHOLDER_PHOTO,
+                    "chapters": [],
+                    "personalityTraits": "",
+                    "subCharacteristics": [],
+                }
+            target = merged[key]
+            for field in TEXT_FIELDS:
+                target[field] = _longer(target[field], record.get(field))
+            if target["photo"] == PLACEHOLDER_PHOTO and record.get("photo"):
+                target["photo"] = record["photo"]
+            target["chapters"] = sorted(set(target["chapters"]) | _chapter_numbers(record.get("chapters")))
+            _merge_sub_characteristics(target["subCharacteristics"], record.get("subCharacteristics"))
+    return list(merged.values())
+
+def assign_chapter(records, number):
+    """Pin records extracted from one chapter to that chapter's number"""
+    for record in records:
+        record["chapters"] = [number]
+        for sub in record.get("subCharacteristics") or []:
+            if isinstance(sub, dict):
+                sub["chapters"] = [number]
+    return records
+
+def chapter_cache_key(model_name, system_prompt, options, chapter):
+    """Hash of everything that determines a chapter's extraction result"""
+    payload = json.dumps({
+        "model": model_name,
+        "system_prompt": system_prompt,
+        "options": options,
+        "number": chapter["number"],
+        "title": chapter["title"],
+        "text": chapter["text"],
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def load_cached_chapter(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, f"{key}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_cached_chapter(cache_dir, key, characters):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f"{key}.json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(characters, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not cache chapter extraction {key}: {e}")
@@ -3,16 +3,28 @@ import torch
 import os
 import logging
 import json
+import re
+import time
+import hashlib
+import uuid
+import asyncio
+import threading
+from contextlib import aclosing, suppress
+
+from character_extraction import (
+    DEFAULT_EXTRACTION_PROMPT, normalize_chapters, chunk_text, chapter_prompt, parse_characters,
+    merge_characters, assign_chapter, chapter_cache_key, load_cached_chapter, save_cached_chapter
+)
 
 # Try to import vLLM, fall back to transformers if not available
 try:
-    from vllm import LLM, SamplingParams
+    from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
     VLLM_AVAILABLE = True
     logger = logging.getLogger(__name__)
     logger.info("vLLM is available, using for inference")
 except ImportError:
     VLLM_AVAILABLE = False
-    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteriaList, TextIteratorStreamer
     logger = logging.getLogger(__name__)
     logger.info("vLLM not available, using transformers instead")
 
@@ -22,64 +34,619 @@ logger = logging.getLogger(__name__)
 
 # Global model instance
 model = None
+model_lock = threading.Lock()
+
+# Weights start loading in the background at import; jobs wait on model_ready
+# instead of each calling load_model(), and a readiness job reports load_status
+EAGER_LOAD = os.environ.get("EAGER_LOAD", "true").lower() == "true"
+model_ready = threading.Event()
+load_status = {"phase": "idle", "started": None, "error": None}
+
+# Files of each downloaded snapshot (path -> size), so a warm volume skips the hub
+MODEL_MANIFEST_FILE = "kimi_manifest.json"
+
+# Jobs a worker takes at once. With vLLM they all share the engine's continuous
+# batching; the transformers fallback can only run one generate() at a time.
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 32))
+generate_lock = asyncio.Lock()
+MAX_MODEL_LEN = int(os.environ.get("MAX_MODEL_LEN", 32768))
+
+# Automatic prefix caching keeps the KV blocks of shared prompt prefixes (our long
+# extraction instructions) on the GPU, so repeat jobs only prefill what follows
+PREFIX_CACHING = os.environ.get("PREFIX_CACHING", "true").lower() == "true"
+KV_BLOCK_SIZE = 16
+
+# Named system prompts, registered once and referenced by id; kept next to the
+# model so every worker on the volume sees them
+SYSTEM_PROMPT_DIR = os.environ.get(
+    "SYSTEM_PROMPT_DIR",
+    os.path.join(os.environ.get("MODEL_PATH", "/workspace/models"), "system_prompts")
+)
+SYSTEM_PROMPT_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+system_prompts = {}
+
+# System prompts this worker has prefilled (sha256 -> prefix token count)
+warm_prefixes = {}
+
+# Whole-book character extraction: chapter chunk size in tokens, room kept for
+# the prompt template, and where per-chapter results are cached by text hash
+EXTRACTION_CHUNK_TOKENS = int(os.environ.get("EXTRACTION_CHUNK_TOKENS", 16000))
+EXTRACTION_PROMPT_MARGIN = 256
+EXTRACTION_CACHE_DIR = os.environ.get(
+    "EXTRACTION_CACHE_DIR",
+    os.path.join(os.environ.get("MODEL_PATH", "/workspace/models"), "extraction_cache")
+)
+
+# Optional lifetime metrics export: a Prometheus text file (for a textfile
+# collector) rewritten after every request, or one JSON line per request
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_FORMAT = os.environ.get("METRICS_FORMAT", "prometheus").lower()
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")]
+
+class Histogram:
+    """Cumulative-bucket histogram in seconds, Prometheus style"""
+    
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+class WorkerMetrics:
+    """Token and latency totals over the worker's lifetime"""
+    
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {
+            "requests": 0,
+            "errors": 0,
+            "cancelled": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+        }
+        self.histograms = {
+            "queue_wait_seconds": Histogram(),
+            "time_to_first_token_seconds": Histogram(),
+            "request_duration_seconds": Histogram(),
+        }
+        self.decode_tokens = 0
+        self.decode_seconds = 0.0
+    
+    def record(self, usage, timings):
+        self.counters["requests"] += 1
+        for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+            self.counters[key] += usage[key]
+        if timings["queue_wait"] is not None:
+            self.histograms["queue_wait_seconds"].observe(timings["queue_wait"])
+        if timings["time_to_first_token"] is not None:
+            self.histograms["time_to_first_token_seconds"].observe(timings["time_to_first_token"])
+        self.histograms["request_duration_seconds"].observe(timings["total"])
+        if timings["decode_tokens_per_second"]:
+            decode_tokens = usage["completion_tokens"] - 1
+            self.decode_tokens += decode_tokens
+            self.decode_seconds += decode_tokens / timings["decode_tokens_per_second"]
+        self.export({"usage": usage, "timings": timings})
+    
+    def record_failure(self, kind):
+        self.counters[kind] += 1
+        self.export({kind: True})
+    
+    def snapshot(self):
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            **self.counters,
+            "decode_tokens_per_second": round(self.decode_tokens / self.decode_seconds, 2) if self.decode_seconds else None,
+            **{
+                f"{name}_mean": round(histogram.sum / histogram.count, 3) if histogram.count else None
+                for name, histogram in self.histograms.items()
+            },
+        }
+    
+    def prometheus_text(self):
+        lines = []
+        for name, value in self.counters.items():
+            lines.append(f"# TYPE kimi_{name}_total counter")
+            lines.append(f"kimi_{name}_total {value}")
+        lines.append("# TYPE kimi_decode_tokens_total counter")
+        lines.append(f"kimi_decode_tokens_total {self.decode_tokens}")
+        lines.append("# TYPE kimi_decode_seconds_total counter")
+        lines.append(f"kimi_decode_seconds_total {self.decode_seconds:.6f}")
+        for name, histogram in self.histograms.items():
+            lines.append(f"# TYPE kimi_{name} histogram")
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                label = "+Inf" if bound == float("inf") else bound
+                lines.append(f'kimi_{name}_bucket{{le="{label}"}} {count}')
+            lines.append(f"kimi_{name}_sum {histogram.sum:.6f}")
+            lines.append(f"kimi_{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+    
+    def export(self, request):
+        if not METRICS_FILE:
+            return
+        try:
+            if METRICS_FORMAT == "jsonl":
+                with open(METRICS_FILE, "a") as f:
+                    f.write(json.dumps({"time": time.time(), "request": request, "worker": self.snapshot()}) + "\n")
+            else:
+                tmp_path = f"{METRICS_FILE}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(self.prometheus_text())
+                os.replace(tmp_path, METRICS_FILE)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {METRICS_FILE}: {e}")
+
+metrics = WorkerMetrics()
+
+def set_load_phase(phase, error=None):
+    load_status["phase"] = phase
+    load_status["error"] = error
+    logger.info(f"Model load phase: {phase}")
+
+def load_local_snapshot(model_name, model_path):
+    """Return the local snapshot directory if the manifest shows every file present with its size"""
+    try:
+        with open(os.path.join(model_path, MODEL_MANIFEST_FILE), "r") as f:
+            entry = json.load(f).get(model_name)
+    except (OSError, ValueError):
+        return None
+    if not entry or not entry.get("files"):
+        return None
+    
+    snapshot_dir = entry["snapshot"]
+    for relpath, size in entry["files"].items():
+        try:
+            if os.path.getsize(os.path.join(snapshot_dir, relpath)) != size:
+                return None
+        except OSError:
+            return None
+    return snapshot_dir
+
+def save_local_snapshot(model_name, model_path, snapshot_dir):
+    """Record a downloaded snapshot's files in the manifest"""
+    manifest_path = os.path.join(model_path, MODEL_MANIFEST_FILE)
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    
+    files = {}
+    for root, _, names in os.walk(snapshot_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, snapshot_dir)] = os.path.getsize(path)
+    manifest[model_name] = {"snapshot": snapshot_dir, "files": files, "saved": time.time()}
+    
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
 
 def load_model():
     """Load the Kimi-K2 model using vLLM or transformers"""
     global model
-    if model is None:
-        model_name = os.environ.get("MODEL_NAME", "moonshotai/Kimi-K2-Instruct")
-        model_path = os.environ.get("MODEL_PATH", "/workspace/models")
-        
-        logger.info(f"Loading model: {model_name}")
-        
-        # Check if we need to download the model first
-        if os.environ.get("DOWNLOAD_MODEL_ON_START", "true").lower() == "true":
-            logger.info("Downloading model if not cached...")
-            from huggingface_hub import snapshot_download
+    with model_lock:
+        if model is None:
+            model_name = os.environ.get("MODEL_NAME", "moonshotai/Kimi-K2-Instruct")
+            model_path = os.environ.get("MODEL_PATH", "/workspace/models")
+            load_status["started"] = time.time()
+            
+            logger.info(f"Loading model: {model_name}")
+            
+            # A complete snapshot on the volume needs no hub round trips at all
+            set_load_phase("verifying")
+            model_source = load_local_snapshot(model_name, model_path)
+            if model_source:
+                logger.info(f"Using verified local snapshot {model_source}")
+            elif os.environ.get("DOWNLOAD_MODEL_ON_START", "true").lower() == "true":
+                set_load_phase("downloading")
+                from huggingface_hub import snapshot_download
+                try:
+                    model_source = snapshot_download(model_name, cache_dir=model_path)
+                    save_local_snapshot(model_name, model_path, model_source)
+                    logger.info("Model download complete")
+                except Exception as e:
+                    logger.warning(f"Model download failed (may already exist): {e}")
+            model_source = model_source or model_name
+            
+            set_load_phase("loading")
             try:
-                snapshot_download(model_name, cache_dir=model_path)
-                logger.info("Model download complete")
-            except Exception as e:
-                logger.warning(f"Model download failed (may already exist): {e}")
-        
-        try:
-            if VLLM_AVAILABLE:
-                # Use vLLM for efficient inference
-                model = {
-                    'llm': LLM(
-                        model=model_name,
+                if VLLM_AVAILABLE:
+                    # Async engine so requests from concurrent jobs are batched together
+                    engine_args = AsyncEngineArgs(
+                        model=model_source,
                         download_dir=model_path,
                         tensor_parallel_size=torch.cuda.device_count(),
                         dtype="auto",
                         trust_remote_code=True,
-                        max_model_len=32768,
+                        max_model_len=MAX_MODEL_LEN,
                         gpu_memory_utilization=0.95,
-                    ),
-                    'type': 'vllm'
-                }
-            else:
-                # Fall back to transformers
-                logger.info("Loading with transformers...")
-                tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=model_path, trust_remote_code=True)
-                model_obj = AutoModelForCausalLM.from_pretrained(
-                    model_name,
-                    cache_dir=model_path,
-                    torch_dtype=torch.float16,
-                    device_map="auto",
-                    trust_remote_code=True
-                )
-                model = {
-                    'model': model_obj,
-                    'tokenizer': tokenizer,
-                    'type': 'transformers'
-                }
-            logger.info(f"Model loaded successfully using {model['type']}!")
-        except Exception as e:
-            logger.error(f"Failed to load model: {e}")
-            raise
+                        enable_prefix_caching=PREFIX_CACHING,
+                        block_size=KV_BLOCK_SIZE,
+                    )
+                    model = {
+                        'llm': AsyncLLMEngine.from_engine_args(engine_args),
+                        'type': 'vllm'
+                    }
+                else:
+                    # Fall back to transformers
+                    logger.info("Loading with transformers...")
+                    tokenizer = AutoTokenizer.from_pretrained(model_source, cache_dir=model_path, trust_remote_code=True)
+                    model_obj = AutoModelForCausalLM.from_pretrained(
+                        model_source,
+                        cache_dir=model_path,
+                        torch_dtype=torch.float16,
+                        device_map="auto",
+                        trust_remote_code=True
+                    )
+                    model = {
+                        'model': model_obj,
+                        'tokenizer': tokenizer,
+                        'type': 'transformers'
+                    }
+                set_load_phase("ready")
+                logger.info(f"Model loaded successfully using {model['type']} in {time.time() - load_status['started']:.1f}s!")
+            except Exception as e:
+                logger.error(f"Failed to load model: {e}")
+                set_load_phase("failed", str(e))
+                raise
+            finally:
+                model_ready.set()
+    return model
+
+def start_model_loading():
+    """Load the model in a background thread; progress is tracked in load_status"""
+    model_ready.clear()
+    load_status["phase"] = "starting"
+    
+    def run():
+        try:
+            load_model()
+        except Exception:
+            pass  # Reported through load_status
+    
+    threading.Thread(target=run, name="model-loader", daemon=True).start()
+
+async def wait_for_model():
+    """Wait for the background load (starting it if nothing has) and return the model"""
+    if model is None and load_status["phase"] in ("idle", "failed"):
+        start_model_loading()
+    await asyncio.to_thread(model_ready.wait)
+    if model is None:
+        raise RuntimeError(f"Model failed to load: {load_status['error']}")
     return model
 
-def handler(event):
+def get_readiness():
+    """Loading progress for readiness probes"""
+    started = load_status["started"]
+    return {
+        "ready": model is not None,
+        "phase": load_status["phase"],
+        "elapsed": round(time.time() - started, 1) if started else None,
+        "error": load_status["error"],
+    }
+
+def prompt_prefix(system_prompt):
+    """The start of build_prompt()'s output that every prompt with this system prompt shares"""
+    return f"{system_prompt}\n\nUser: "
+
+def build_prompt(prompt, system_prompt=""):
+    """Combine system prompt and user prompt if needed"""
+    if system_prompt:
+        return f"{prompt_prefix(system_prompt)}{prompt}\n\nAssistant:"
+    return prompt
+
+def register_system_prompt(prompt_id, text):
+    """Store a named system prompt so jobs can reference it by id"""
+    if not SYSTEM_PROMPT_ID_PATTERN.match(prompt_id):
+        raise ValueError(f"Invalid system prompt id: {prompt_id}")
+    os.makedirs(SYSTEM_PROMPT_DIR, exist_ok=True)
+    path = os.path.join(SYSTEM_PROMPT_DIR, f"{prompt_id}.txt")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    system_prompts[prompt_id] = text
+    logger.info(f"Registered system prompt {prompt_id} ({len(text)} chars)")
+
+def get_system_prompt(prompt_id):
+    """Look up a registered system prompt, falling back to the shared directory"""
+    if prompt_id not in system_prompts:
+        path = os.path.join(SYSTEM_PROMPT_DIR, f"{prompt_id}.txt")
+        if not SYSTEM_PROMPT_ID_PATTERN.match(prompt_id) or not os.path.exists(path):
+            raise ValueError(f"Unknown system_prompt_id: {prompt_id}")
+        with open(path, "r", encoding="utf-8") as f:
+            system_prompts[prompt_id] = f.read()
+    return system_prompts[prompt_id]
+
+def resolve_system_prompt(job_input, default=""):
+    """System prompt for a job or batch item: by id, inline, or the given default"""
+    if job_input.get("system_prompt_id"):
+        return get_system_prompt(job_input["system_prompt_id"])
+    return job_input.get("system_prompt", default)
+
+async def get_cached_prefix_tokens(llm, system_prompt):
+    """
+    Tokens of the system prompt prefix that vLLM can serve from its prefix cache.
+    
+    Only whole KV blocks are cached, and only once this worker has prefilled
+    the prompt before. Returns 0 the first time a system prompt is seen. This is
+    an estimate; stream_vllm() replaces it with the engine's own count when
+    vLLM reports one.
+    """
+    if llm['type'] != 'vllm' or not PREFIX_CACHING or not system_prompt:
+        return 0
+    key = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+    if key not in warm_prefixes:
+        tokenizer = await llm['llm'].get_tokenizer()
+        # Without the trailing space, which usually merges into the prompt's first token
+        warm_prefixes[key] = len(tokenizer.encode(prompt_prefix(system_prompt).rstrip(" ")))
+        return 0
+    return warm_prefixes[key] // KV_BLOCK_SIZE * KV_BLOCK_SIZE
+
+def get_sampling_options(job_input):
+    """Sampling parameters from a job (or batch item) with the handler defaults"""
+    return {
+        "max_tokens": job_input.get("max_tokens", 2048),
+        "temperature": job_input.get("temperature", 0.7),
+        "top_p": job_input.get("top_p", 0.95),
+        "top_k": job_input.get("top_k", 50),
+        "stop": job_input.get("stop", None),
+    }
+
+async def stream_vllm(llm, full_prompt, options, stats):
+    """Yield text deltas from the async engine as they decode"""
+    request_id = str(uuid.uuid4())
+    sampling_params = SamplingParams(**options)
+    sent = 0
+    finished = False
+    try:
+        async for output in llm['llm'].generate(full_prompt, sampling_params, request_id):
+            text = output.outputs[0].text
+            if len(text) > sent:
+                yield text[sent:]
+                sent = len(text)
+        finished = True
+        
+        # Exact counts and scheduler timings from the final output
+        stats["prompt_tokens"] = len(output.prompt_token_ids)
+        stats["completion_tokens"] = len(output.outputs[0].token_ids)
+        if getattr(output, "num_cached_tokens", None) is not None:
+            if output.num_cached_tokens != stats.get("cached_tokens", 0):
+                logger.info(
+                    f"vLLM served {output.num_cached_tokens} prompt tokens from its prefix cache, "
+                    f"estimated {stats.get('cached_tokens', 0)}"
+                )
+            stats["cached_tokens"] = output.num_cached_tokens
+        # Not every vLLM version (or engine) records scheduler timestamps
+        request_metrics = getattr(output, "metrics", None)
+        first_scheduled_time = getattr(request_metrics, "first_scheduled_time", None)
+        arrival_time = getattr(request_metrics, "arrival_time", None)
+        if first_scheduled_time and arrival_time:
+            stats["queue_wait"] = first_scheduled_time - arrival_time
+    finally:
+        if not finished:
+            # Cancelled or abandoned: drop the sequence from the running batch
+            logger.info(f"Aborting request {request_id}")
+            await llm['llm'].abort(request_id)
+
+async def stream_transformers(llm, full_prompt, options, stats):
+    """Yield text deltas from transformers generate() running in a thread"""
+    tokenizer = llm['tokenizer']
+    model = llm['model']
+    
+    inputs = tokenizer(full_prompt, return_tensors="pt").to(model.device)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    cancelled = threading.Event()
+    stats["prompt_tokens"] = inputs['input_ids'].shape[1]
+    
+    def run():
+        try:
+            with torch.no_grad():
+                outputs = model.generate(
+                    **inputs,
+                    max_new_tokens=options["max_tokens"],
+                    temperature=options["temperature"],
+                    top_p=options["top_p"],
+                    top_k=options["top_k"],
+                    do_sample=True,
+                    pad_token_id=tokenizer.eos_token_id,
+                    streamer=streamer,
+                    # Checked after every token, so a cancelled job stops decoding right away
+                    stopping_criteria=StoppingCriteriaList([lambda input_ids, scores, **kwargs: cancelled.is_set()])
+                )
+            stats["completion_tokens"] = outputs.shape[1] - stats["prompt_tokens"]
+        finally:
+            streamer.end()
+    
+    # Keep the event loop free for other jobs while transformers runs
+    wait_start = time.time()
+    async with generate_lock:
+        stats["queue_wait"] = time.time() - wait_start
+        worker = asyncio.get_running_loop().run_in_executor(None, run)
+        try:
+            while True:
+                delta = await asyncio.to_thread(next, streamer, None)
+                if delta is None:
+                    break
+                if delta:
+                    yield delta
+            await worker
+        finally:
+            cancelled.set()
+            # generate() stops at the next token; the next job must not take the
+            # lock (and the GPU) until it has
+            with suppress(Exception):
+                await asyncio.shield(worker)
+
+def stream_completion(llm, full_prompt, options, stats):
+    """
+    Async iterator of text deltas for one prompt, from whichever backend is loaded.
+    
+    stats is filled in with backend-reported figures (e.g. cached_tokens).
+    """
+    if llm['type'] == 'vllm':
+        return stream_vllm(llm, full_prompt, options, stats)
+    return stream_transformers(llm, full_prompt, options, stats)
+
+def describe_completion(start_time, first_token_time, end_time, stats):
+    """Usage and timing fields for a finished completion"""
+    completion_tokens = stats.get("completion_tokens", 0)
+    decode_seconds = end_time - first_token_time if first_token_time and completion_tokens > 1 else 0
+    return {
+        "usage": {
+            "prompt_tokens": stats.get("prompt_tokens", 0),
+            "completion_tokens": completion_tokens,
+            "cached_tokens": stats.get("cached_tokens", 0),
+        },
+        "timings": {
+            "queue_wait": round(stats["queue_wait"], 3) if stats.get("queue_wait") is not None else None,
+            "time_to_first_token": round(first_token_time - start_time, 3) if first_token_time else None,
+            "decode_tokens_per_second": round((completion_tokens - 1) / decode_seconds, 2) if decode_seconds else None,
+            "total": round(end_time - start_time, 3),
+        },
+    }
+
+async def generate_stream(llm, prompt, system_prompt, options):
+    """
+    Generate a completion for one prompt.
+    
+    Yields text deltas as they decode, then a result dict with the full text,
+    usage and timings. Each finished, failed or cancelled request is added to
+    the worker metrics.
+    """
+    full_prompt = build_prompt(prompt, system_prompt)
+    logger.info(f"Generating response for prompt: {prompt[:100]}...")
+    
+    start_time = time.time()
+    try:
+        stats = {"cached_tokens": await get_cached_prefix_tokens(llm, system_prompt)}
+        first_token_time = None
+        parts = []
+        async with aclosing(stream_completion(llm, full_prompt, options, stats)) as deltas:
+            async for delta in deltas:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                parts.append(delta)
+                yield delta
+    except asyncio.CancelledError:
+        metrics.record_failure("cancelled")
+        raise
+    except Exception:
+        metrics.record_failure("errors")
+        raise
+    
+    end_time = time.time()
+    result = describe_completion(start_time, first_token_time, end_time, stats)
+    metrics.record(result["usage"], result["timings"])
+    yield {"text": "".join(parts), **result}
+
+async def generate(llm, prompt, system_prompt, options):
+    """Generate a completion for one prompt and describe it for the job result"""
+    async with aclosing(generate_stream(llm, prompt, system_prompt, options)) as chunks:
+        async for chunk in chunks:
+            result = chunk
+    return result
+
+async def generate_indexed(index, llm, prompt, system_prompt, options):
+    """generate() tagged with the prompt's position in a batch"""
+    try:
+        return index, await generate(llm, prompt, system_prompt, options)
+    except Exception as e:
+        logger.error(f"Batch item {index} failed: {e}")
+        return index, {"error": str(e)}
+
+async def get_tokenizer(llm):
+    if llm['type'] == 'vllm':
+        return await llm['llm'].get_tokenizer()
+    return llm['tokenizer']
+
+async def extract_chapter(llm, chapter, system_prompt, options, chunk_tokens, count_tokens, model_name):
+    """Map step for one chapter: extract every chunk concurrently, or reuse the cached result"""
+    summary = {"number": chapter["number"], "cached": False}
+    key = chapter_cache_key(model_name, system_prompt, options, chapter)
+    cached = load_cached_chapter(EXTRACTION_CACHE_DIR, key)
+    if cached is not None:
+        summary["cached"] = True
+        return cached, summary
+    
+    try:
+        chunks = await asyncio.to_thread(chunk_text, chapter["text"], count_tokens, chunk_tokens)
+        summary["chunks"] = len(chunks)
+        outputs = await asyncio.gather(*(
+            generate(llm, chapter_prompt(chapter, chunk, index, len(chunks)), system_prompt, options)
+            for index, chunk in enumerate(chunks)
+        ))
+        summary["usage"] = {
+            key: sum(output["usage"][key] for output in outputs)
+            for key in ("prompt_tokens", "completion_tokens", "cached_tokens")
+        }
+        records = []
+        for output in outputs:
+            records.extend(assign_chapter(parse_characters(output["text"]), chapter["number"]))
+    except Exception as e:
+        logger.error(f"Character extraction failed for chapter {chapter['number']}: {e}")
+        summary["error"] = str(e)
+        return [], summary
+    
+    characters = merge_characters([records])
+    save_cached_chapter(EXTRACTION_CACHE_DIR, key, characters)
+    return characters, summary
+
+async def extract_characters(llm, job_input, system_prompt, model_name):
+    """
+    Map-reduce character extraction over a whole book.
+    
+    Every chunk of every chapter is submitted at once so the engine keeps its
+    batch full. Yields a progress entry per chapter as it finishes (used when
+    streaming), then the merged database with per-chapter summaries.
+    """
+    chapters = normalize_chapters(job_input["chapters"])
+    system_prompt = system_prompt or DEFAULT_EXTRACTION_PROMPT
+    options = get_sampling_options(job_input)
+    
+    tokenizer = await get_tokenizer(llm)
+    count_tokens = lambda text: len(tokenizer.encode(text))
+    prompt_tokens = count_tokens(build_prompt("", system_prompt)) + EXTRACTION_PROMPT_MARGIN
+    chunk_tokens = min(EXTRACTION_CHUNK_TOKENS, MAX_MODEL_LEN - prompt_tokens - options["max_tokens"])
+    if chunk_tokens < 512:
+        raise ValueError("System prompt and max_tokens leave no room for chapter text")
+    logger.info(f"Extracting characters from {len(chapters)} chapters in chunks of up to {chunk_tokens} tokens")
+    
+    tasks = [
+        asyncio.create_task(extract_chapter(llm, chapter, system_prompt, options, chunk_tokens, count_tokens, model_name))
+        for chapter in chapters
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            characters, summary = await next_done
+            yield {"progress": summary, "characters_found": len(characters)}
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    # Reduce in book order (existing database first) so the merge is deterministic
+    results = [task.result() for task in tasks]
+    existing = [record for record in job_input.get("characters") or [] if isinstance(record, dict) and record.get("name")]
+    summaries = [summary for _, summary in results]
+    yield {
+        "characters": merge_characters([existing] + [characters for characters, _ in results]),
+        "chapters": summaries,
+        "model": model_name,
+        "usage": {
+            key: sum(summary.get("usage", {}).get(key, 0) for summary in summaries)
+            for key in ("prompt_tokens", "completion_tokens", "cached_tokens")
+        }
+    }
+
+async def handler(event):
     """
     RunPod serverless handler function
     
@@ -88,6 +655,7 @@ def handler(event):
         "input": {
             "prompt": "The text prompt for the model",
             "system_prompt": "Optional system prompt",
+            "system_prompt_id": "Optional id of a registered system prompt (instead of system_prompt)",
             "max_tokens": 2048,
             "temperature": 0.7,
             "top_p": 0.95,
@@ -95,72 +663,156 @@ def handler(event):
             "stream": false
         }
     }
+    
+    With "stream": true the handler yields {"delta": "..."} chunks as tokens
+    decode, then a final chunk with the full "text", "usage" and "timings".
+    Otherwise it yields a single result.
+    
+    "usage" has exact prompt, completion and cached token counts; "timings"
+    has queue_wait, time_to_first_token, decode_tokens_per_second and total.
+    queue_wait is null when the vLLM engine does not report when the request
+    was first scheduled.
+    
+    A job with "register_system_prompt": {"id": "...", "text": "..."} stores a
+    named system prompt (and prefills it) so later jobs can send just its
+    "system_prompt_id". The system prompt always leads the full prompt, so
+    repeat jobs reuse its KV cache and report the reused "cached_tokens" in
+    "usage".
+    
+    A job with "chapters" (chapter texts, or {"number", "title", "text"}
+    objects) runs whole-book character extraction: chapters are split into
+    chunks that fit the context, all chunks are extracted concurrently, and
+    the records are merged into one "characters" database (merged into an
+    optional existing "characters" list). Unchanged chapters reuse cached
+    results. With "stream" a progress entry is yielded per chapter first.
+    
+    A job with "readiness": true returns the model loading phase right away
+    (idle, verifying, downloading, loading, ready or failed).
+    
+    Instead of "prompt", a job may carry "prompts": a list of prompt strings, or
+    of objects with their own "prompt" and optional "system_prompt" and sampling
+    overrides. They are generated concurrently and returned in input order as
+    "results", or with "stream" each one is yielded as soon as it finishes,
+    tagged with its "index".
     """
     try:
-        # Get the model
-        llm = load_model()
-        
         # Extract parameters from the event
         job_input = event.get("input", {})
-        prompt = job_input.get("prompt", "")
-        system_prompt = job_input.get("system_prompt", "")
         
-        # Combine system prompt and user prompt if needed
-        if system_prompt:
-            full_prompt = f"{system_prompt}\n\nUser: {prompt}\n\nAssistant:"
-        else:
-            full_prompt = prompt
+        # Readiness probe: answer right away, even while the model is loading
+        if job_input.get("readiness"):
+            yield get_readiness()
+            return
         
-        # Generate response based on backend
-        logger.info(f"Generating response for prompt: {prompt[:100]}...")
+        # Wait for the background load rather than starting one per job
+        llm = await wait_for_model()
+        stream = job_input.get("stream", False)
+        model_name = os.environ.get("MODEL_NAME", "moonshotai/Kimi-K2-Instruct")
         
-        if llm['type'] == 'vllm':
-            # vLLM generation
-            sampling_params = SamplingParams(
-                max_tokens=job_input.get("max_tokens", 2048),
-                temperature=job_input.get("temperature", 0.7),
-                top_p=job_input.get("top_p", 0.95),
-                top_k=job_input.get("top_k", 50),
-                stop=job_input.get("stop", None)
-            )
-            outputs = llm['llm'].generate([full_prompt], sampling_params)
-            generated_text = outputs[0].outputs[0].text
-        else:
-            # Transformers generation
-            tokenizer = llm['tokenizer']
-            model = llm['model']
-            
-            inputs = tokenizer(full_prompt, return_tensors="pt").to(model.device)
+        if "register_system_prompt" in job_input:
+            registration = job_input["register_system_prompt"]
+            text = registration["text"]
+            prompt_id = registration.get("id") or hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+            register_system_prompt(prompt_id, text)
+            # Prefill it once so the first job that uses it already hits the prefix cache
+            await generate(llm, "", text, {**get_sampling_options({}), "max_tokens": 1})
+            if "prompt" not in job_input and "prompts" not in job_input:
+                yield {"registered": prompt_id, "model": model_name}
+                return
+        
+        system_prompt = resolve_system_prompt(job_input)
+        
+        if "chapters" in job_input:
+            async with aclosing(extract_characters(llm, job_input, system_prompt, model_name)) as updates:
+                async for update in updates:
+                    if "characters" in update:
+                        logger.info(f"Merged {len(update['characters'])} characters")
+                        yield update
+                    elif stream:
+                        yield update
+            return
+        
+        if "prompts" in job_input:
+            items = [item if isinstance(item, dict) else {"prompt": item} for item in job_input["prompts"]]
+            logger.info(f"Generating batch of {len(items)} prompts")
             
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=job_input.get("max_tokens", 2048),
-                    temperature=job_input.get("temperature", 0.7),
-                    top_p=job_input.get("top_p", 0.95),
-                    top_k=job_input.get("top_k", 50),
-                    do_sample=True,
-                    pad_token_id=tokenizer.eos_token_id
-                )
+            tasks = [
+                asyncio.create_task(generate_indexed(
+                    index,
+                    llm,
+                    item.get("prompt", ""),
+                    resolve_system_prompt(item, system_prompt),
+                    get_sampling_options({**job_input, **item})
+                ))
+                for index, item in enumerate(items)
+            ]
+            try:
+                if stream:
+                    for next_done in asyncio.as_completed(tasks):
+                        index, output = await next_done
+                        yield {"index": index, "model": model_name, **output}
+                    return
+                
+                results = [output for _, output in await asyncio.gather(*tasks)]
+            finally:
+                # A cancelled job must not leave its prompts generating
+                for task in tasks:
+                    task.cancel()
             
-            generated_text = tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+            logger.info("Batch generation completed")
+            yield {
+                "results": results,
+                "model": model_name,
+                "usage": {
+                    "prompt_tokens": sum(r["usage"]["prompt_tokens"] for r in results if "usage" in r),
+                    "completion_tokens": sum(r["usage"]["completion_tokens"] for r in results if "usage" in r),
+                    "cached_tokens": sum(r["usage"]["cached_tokens"] for r in results if "usage" in r),
+                }
+            }
+            return
+        
+        prompt = job_input.get("prompt", "")
+        options = get_sampling_options(job_input)
+        
+        if stream:
+            async with aclosing(generate_stream(llm, prompt, system_prompt, options)) as chunks:
+                async for chunk in chunks:
+                    if isinstance(chunk, str):
+                        yield {"delta": chunk}
+                    else:
+                        logger.info("Generation completed successfully")
+                        yield {**chunk, "model": model_name, "finished": True}
+            return
+        
+        output = await generate(llm, prompt, system_prompt, options)
         
         # Return the result
         result = {
-            "text": generated_text,
-            "model": os.environ.get("MODEL_NAME", "moonshotai/Kimi-K2-Instruct"),
-            "usage": {
-                "prompt_tokens": len(full_prompt.split()),  # Rough estimate
-                "completion_tokens": len(generated_text.split()),  # Rough estimate
-            }
+            "text": output["text"],
+            "model": model_name,
+            "usage": output["usage"],
+            "timings": output["timings"]
         }
         
         logger.info("Generation completed successfully")
-        return result
-        
+        yield result
+    
     except Exception as e:
         logger.error(f"Error in handler: {e}")
-        return {"error": str(e)}
+        yield {"error": str(e)}
+
+def concurrency_modifier(current_concurrency):
+    """How many jobs this worker should run at once"""
+    return MAX_CONCURRENCY if VLLM_AVAILABLE else 1
+
+# Start loading weights now so it overlaps with the RunPod worker starting up
+if EAGER_LOAD:
+    start_model_loading()
 
 # RunPod serverless entrypoint
-runpod.serverless.start({"handler": handler})
\ No newline at end of file
+# return_aggregate_stream keeps /run and /runsync returning the yielded results
+runpod.serverless.start({
+    "handler": handler,
+    "concurrency_modifier": concurrency_modifier,
+    "return_aggregate_stream": True
+})
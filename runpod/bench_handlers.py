@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput benchmark for the RunPod handlers, without a GPU
+
+Starts fake_comfyui.py and drives handler() from runpod/handler.py and the
+root handler.py with a stream of image jobs (a FLUX Kontext style workflow
+with a reference image), then reports jobs/s, peak RSS and per-stage
+latency for each handler:
+
+    upload  - reference image uploads (/upload/image)
+    queue   - prompt submission (/prompt)
+    wait    - from the first prompt being queued until its first image is fetched
+              (websocket events and /history polling)
+    fetch   - result image downloads (/view)
+    encode  - base64 encoding of the results
+    other   - everything else the handler does (workflow prep, hashing, JSON)
+
+With --batch-every, some jobs are storyboard batches (bulk priority in
+runpod/handler.py, which only it accepts) mixed in with single image jobs
+(interactive), and the report adds latency per class and the scheduler's
+queue wait histograms. Run with --concurrency above 1 to see interactive jobs
+overtake the batches.
+
+Each handler runs in its own process so their peak RSS is measured
+separately. The render latency is the fake server's, so with a fixed latency
+any change in the numbers comes from the handler side.
+
+Usage:
+    python bench_handlers.py --jobs 20 --latency 0.5
+    python bench_handlers.py --handler runpod --url http://127.0.0.1:8188
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import random
+import argparse
+import logging
+import resource
+import tempfile
+import threading
+import subprocess
+import importlib.util
+from typing import Dict, Any, List
+
+import requests
+
+RUNPOD_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDLERS = {
+    "runpod": os.path.join(RUNPOD_DIR, "handler.py"),
+    "root": os.path.join(os.path.dirname(RUNPOD_DIR), "handler.py"),
+}
+STAGES = ["upload", "queue", "wait", "fetch", "encode", "other"]
+# Request path -> stage its time is counted in (/history polls are part of the wait)
+PATH_STAGES = {"/upload/image": "upload", "/prompt": "queue", "/view": "fetch"}
+SERVER_STARTUP_TIMEOUT = 15
+
+# Timings of the job running on each thread
+current = threading.local()
+
+def job_workflow(reference: str, seed: int) -> Dict[str, Any]:
+    """A FLUX Kontext style workflow editing a reference image"""
+    return {
+        "1": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux1-kontext-dev-fp8.safetensors", "weight_dtype": "fp8_e4m3fn"}},
+        "2": {"class_type": "DualCLIPLoader", "inputs": {"clip_name1": "clip_l.safetensors", "clip_name2": "t5xxl_fp8_e4m3fn.safetensors", "type": "flux"}},
+        "3": {"class_type": "VAELoader", "inputs": {"vae_name": "ae.safetensors"}},
+        "4": {"class_type": "LoadImage", "inputs": {"image": reference, "upload": "image"}},
+        "5": {"class_type": "CLIPTextEncode", "inputs": {"text": "a Roman street at dusk", "clip": ["2", 0]}},
+        "6": {"class_type": "VAEEncode", "inputs": {"pixels": ["4", 0], "vae": ["3", 0]}},
+        "7": {"class_type": "ReferenceLatent", "inputs": {"conditioning": ["5", 0], "latent": ["6", 0]}},
+        "8": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "positive": ["7", 0], "negative": ["7", 0], "latent_image": ["6", 0],
+                                                   "seed": seed, "steps": 20, "cfg": 1.0, "sampler_name": "euler", "scheduler": "simple", "denoise": 1.0}},
+        "9": {"class_type": "VAEDecode", "inputs": {"samples": ["8", 0], "vae": ["3", 0]}},
+        "10": {"class_type": "SaveImage", "inputs": {"images": ["9", 0], "filename_prefix": "scene"}},
+    }
+
+def make_jobs(count: int, reference_kb: int, same_reference: bool, batch_every: int = 0,
+              batch_size: int = 8) -> List[Dict[str, Any]]:
+    """
+    Job inputs, each with its own reference image unless same_reference is
+    set; every batch_every-th job is a batch of batch_size workflows
+    """
+    rng = random.Random(0)
+    shared = rng.randbytes(reference_kb * 1024)
+    jobs = []
+    for index in range(count):
+        reference = shared if same_reference else rng.randbytes(reference_kb * 1024)
+        image = "data:image/png;base64," + base64.b64encode(reference).decode("ascii")
+        if batch_every and index % batch_every == 0:
+            workflows = [job_workflow(image, index * batch_size + i) for i in range(batch_size)]
+            jobs.append({"id": f"bench-{index}", "input": {"workflows": workflows}})
+        else:
+            jobs.append({"id": f"bench-{index}", "input": {"workflow": job_workflow(image, index)}})
+    return jobs
+
+def instrument():
+    """Count HTTP and base64 time towards the stages of the job on the calling thread"""
+    send = requests.Session.request
+    b64encode = base64.b64encode
+
+    def timed_request(session, method, url, *args, **kwargs):
+        timings = getattr(current, "timings", None)
+        start = time.perf_counter()
+        try:
+            return send(session, method, url, *args, **kwargs)
+        finally:
+            if timings is not None:
+                end = time.perf_counter()
+                path = requests.utils.urlparse(url).path
+                stage = PATH_STAGES.get(path)
+                if stage:
+                    timings[stage] += end - start
+                if stage == "queue" and current.queued_at is None:
+                    current.queued_at = end
+                elif stage == "fetch" and current.first_fetch is None:
+                    current.first_fetch = start
+
+    def timed_b64encode(*args, **kwargs):
+        timings = getattr(current, "timings", None)
+        start = time.perf_counter()
+        try:
+            return b64encode(*args, **kwargs)
+        finally:
+            if timings is not None:
+                timings["encode"] += time.perf_counter() - start
+
+    requests.Session.request = timed_request
+    base64.b64encode = timed_b64encode
+
+def run_job(handler_function, job: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one job through a handler and split its wall time into stages"""
+    current.timings = dict.fromkeys(STAGES, 0.0)
+    current.queued_at = None
+    current.first_fetch = None
+    start = time.perf_counter()
+    try:
+        result = handler_function(job)
+        results = list(result) if hasattr(result, "__next__") else [result]
+    except Exception as e:
+        results = [{"error": str(e)}]
+    end = time.perf_counter()
+
+    timings = current.timings
+    if current.queued_at is not None:
+        timings["wait"] = (current.first_fetch or end) - current.queued_at
+    timings["other"] = max(0.0, (end - start) - sum(timings.values()))
+    timings["total"] = end - start
+    current.timings = None
+
+    errors = [r["error"] for r in results if isinstance(r, dict) and "error" in r]
+    if not results:
+        errors = ["No result"]
+    job_class = "bulk" if "workflows" in job["input"] else "interactive"
+    return {"timings": timings, "error": errors[0] if errors else None, "class": job_class}
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def load_handler(name: str):
+    """Import a handler module by path (both are called handler.py) and prepare it like a warm worker"""
+    sys.path.insert(0, os.path.dirname(HANDLERS[name]))
+    if name == "root":
+        sys.path.insert(0, RUNPOD_DIR)
+    spec = importlib.util.spec_from_file_location(f"{name}_handler", HANDLERS[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    if name == "runpod":
+        # Models are resident on a warm worker; the benchmark has none to check
+        for path in module.get_critical_models("fp16") + module.get_critical_models("fp8"):
+            module.model_manifest[path] = {}
+        module.model_manifest_ready.set()
+    return module
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(name: str, runs: List[Dict[str, Any]], elapsed: float, baseline_rss: float) -> Dict[str, Any]:
+    ok = [run["timings"] for run in runs if not run["error"]]
+    stages = {}
+    for stage in STAGES + ["total"]:
+        values = [timings[stage] * 1000 for timings in ok]
+        stages[stage] = {
+            "mean_ms": round(sum(values) / len(values), 2),
+            "p50_ms": round(percentile(values, 0.5), 2),
+            "p95_ms": round(percentile(values, 0.95), 2),
+        } if values else None
+    return {
+        "handler": name,
+        "jobs": len(runs),
+        "errors": len(runs) - len(ok),
+        "first_error": next((run["error"] for run in runs if run["error"]), None),
+        "elapsed_seconds": round(elapsed, 2),
+        "jobs_per_second": round(len(ok) / elapsed, 3) if elapsed else None,
+        "baseline_rss_mb": round(baseline_rss, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "stages": stages,
+        "classes": {
+            job_class: {
+                "jobs": len(totals),
+                "mean_ms": round(sum(totals) / len(totals), 2),
+                "p50_ms": round(percentile(totals, 0.5), 2),
+                "p95_ms": round(percentile(totals, 0.95), 2),
+            }
+            for job_class in ("interactive", "bulk")
+            for totals in [[run["timings"]["total"] * 1000 for run in runs if not run["error"] and run["class"] == job_class]]
+            if totals
+        },
+    }
+
+def run_benchmark(name: str, jobs: List[Dict[str, Any]], concurrency: int = 1) -> Dict[str, Any]:
+    """Run the jobs through one handler in this process (concurrency threads pulling from the list)"""
+    instrument()
+    try:
+        module = load_handler(name)
+    except Exception as e:
+        return {"handler": name, "error": f"Could not load {HANDLERS[name]}: {e}"}
+    baseline_rss = peak_rss_mb()
+
+    runs = []
+    pending = list(jobs)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                job = pending.pop(0)
+            run = run_job(module.handler, job)
+            with lock:
+                runs.append(run)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f"bench-{i}") for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(name, runs, time.perf_counter() - start, baseline_rss)
+    if hasattr(module, "scheduler"):
+        result["scheduler"] = module.scheduler.stats()
+    return result
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_fake_server(args, directory: str):
+    """Start fake_comfyui.py in its own process and wait until it answers"""
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(RUNPOD_DIR, "fake_comfyui.py"),
+        "--port", str(port), "--latency", str(args.latency), "--jitter", str(args.jitter),
+        "--width", str(args.width), "--height", str(args.height), "--images", str(args.images),
+        "--directory", directory,
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + SERVER_STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Fake ComfyUI exited with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/system_stats", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Fake ComfyUI did not start")
+
+def run_child(name: str, args, url: str, directory: str) -> Dict[str, Any]:
+    """Benchmark one handler in a fresh process against the given server"""
+    env = dict(os.environ, COMFYUI_URL=url, COMFYUI_DIR=directory)
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    try:
+        command = [
+            sys.executable, os.path.abspath(__file__), "--child", name, "--result-file", result_path,
+            "--jobs", str(args.jobs), "--concurrency", str(args.concurrency), "--reference-kb", str(args.reference_kb),
+        ]
+        if args.same_reference:
+            command.append("--same-reference")
+        if args.batch_every and name == "runpod":
+            command += ["--batch-every", str(args.batch_every), "--batch-size", str(args.batch_size)]
+        if args.verbose:
+            command.append("--verbose")
+        completed = subprocess.run(command, env=env, stdout=None if args.verbose else subprocess.DEVNULL)
+        try:
+            with open(result_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"handler": name, "error": f"Benchmark process exited with code {completed.returncode}"}
+    finally:
+        os.remove(result_path)
+
+def print_results(results: List[Dict[str, Any]]):
+    for result in results:
+        if "error" in result:
+            print(f"{result['handler']}: {result['error']}")
+            continue
+        print(f"{result['handler']}: {result['jobs']} jobs ({result['errors']} failed) in {result['elapsed_seconds']}s, "
+              f"{result['jobs_per_second']} jobs/s, peak RSS {result['peak_rss_mb']} MB "
+              f"(after import {result['baseline_rss_mb']} MB)")
+        if result["first_error"]:
+            print(f"  first error: {result['first_error']}")
+        print(f"  {'stage':<8} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+        for stage, values in result["stages"].items():
+            if values:
+                print(f"  {stage:<8} {values['mean_ms']:>10.2f} {values['p50_ms']:>10.2f} {values['p95_ms']:>10.2f}")
+        if len(result["classes"]) > 1:
+            print(f"  {'class':<12} {'jobs':>5} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'slot wait p95':>14} {'max':>10}")
+            for job_class, values in result["classes"].items():
+                wait = result.get("scheduler", {}).get("queue_wait", {}).get(job_class, {})
+                print(f"  {job_class:<12} {values['jobs']:>5} {values['mean_ms']:>10.2f} {values['p50_ms']:>10.2f} "
+                      f"{values['p95_ms']:>10.2f} {'<=' + str(wait.get('p95_ms')) + 'ms':>14} {str(wait.get('max_ms')) + 'ms':>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RunPod handlers against a fake ComfyUI")
+    parser.add_argument("--handler", choices=["runpod", "root", "both"], default="both",
+                        help="runpod/handler.py, the root handler.py, or both (default: both)")
+    parser.add_argument("--url", help="Use a ComfyUI (or fake_comfyui.py) already running here")
+    parser.add_argument("--jobs", type=int, default=10, help="Jobs per handler (default: 10)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs run at once per handler (default: 1)")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake render time per prompt in seconds (default: 0.5)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- fraction of the render time (default: 0)")
+    parser.add_argument("--width", type=int, default=1024, help="Output image width (default: 1024)")
+    parser.add_argument("--height", type=int, default=1024, help="Output image height (default: 1024)")
+    parser.add_argument("--images", type=int, default=1, help="Images per prompt (default: 1)")
+    parser.add_argument("--reference-kb", type=int, default=512, help="Reference image size per job in KB (default: 512)")
+    parser.add_argument("--same-reference", action="store_true", help="Reuse one reference image (measures upload dedup)")
+    parser.add_argument("--batch-every", type=int, default=0,
+                        help="Make every Nth job a storyboard batch (runpod/handler.py only; default: none)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Workflows per batch job (default: 8)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show handler logs")
+    parser.add_argument("--child", choices=list(HANDLERS), help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+
+    if args.child:
+        result = run_benchmark(args.child, make_jobs(args.jobs, args.reference_kb, args.same_reference, args.batch_every, args.batch_size), args.concurrency)
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    names = list(HANDLERS) if args.handler == "both" else [args.handler]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_handlers_") as directory:
+        server = None
+        url = args.url
+        if not url:
+            server, url = start_fake_server(args, directory)
+        try:
+            for name in names:
+                results.append(run_child(name, args, url, directory))
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    return 1 if any("error" in result or result["errors"] for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+HTTP client for the local ComfyUI API
+
+All handler traffic to ComfyUI goes through one pooled keep-alive session
+with per-endpoint timeouts, bounded retries with jittered backoff, and a
+latency histogram per endpoint so a slow or hung ComfyUI shows up in the
+logs instead of stalling the worker.
+"""
+
+import time
+import random
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import websocket
+    WEBSOCKET_AVAILABLE = True
+except ImportError:
+    WEBSOCKET_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 2
+POOL_SIZE = 16
+
+# Read timeouts in seconds per endpoint
+READ_TIMEOUTS = {
+    "system_stats": 2,
+    "object_info": 10,
+    "prompt": 30,
+    "history": 10,
+    "queue": 10,
+    "view": 60,
+    "upload": 60,
+}
+DEFAULT_READ_TIMEOUT = 30
+
+# Retries apply to connection errors, timeouts and 5xx responses
+DEFAULT_RETRIES = 3
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 2.0
+
+# Latency histogram bucket upper bounds in milliseconds
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram for one endpoint"""
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS_MS)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.errors = 0
+        self.retries = 0
+
+    def observe(self, latency_ms: float):
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                self.counts[i] += 1
+                break
+        self.total += 1
+        self.sum_ms += latency_ms
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Upper bound of the bucket containing the given percentile"""
+        if not self.total:
+            return None
+        target = fraction * self.total
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return LATENCY_BUCKETS_MS[-1]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.total,
+            "errors": self.errors,
+            "retries": self.retries,
+            "mean_ms": round(self.sum_ms / self.total, 1) if self.total else None,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "buckets": {
+                ("+Inf" if bound == float("inf") else str(bound)): count
+                for bound, count in zip(LATENCY_BUCKETS_MS, self.counts)
+            },
+        }
+
+class ComfyClient:
+    """Pooled, instrumented client for one ComfyUI server"""
+
+    def __init__(self, base_url: str, retries: int = DEFAULT_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = self.base_url.replace("http", "ws", 1) + "/ws"
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.lock = threading.Lock()
+
+    def _histogram(self, endpoint: str) -> LatencyHistogram:
+        with self.lock:
+            if endpoint not in self.histograms:
+                self.histograms[endpoint] = LatencyHistogram()
+            return self.histograms[endpoint]
+
+    def request(self, method: str, endpoint: str, path: str, retries: Optional[int] = None,
+                timeout: Optional[Tuple[float, float]] = None, **kwargs) -> requests.Response:
+        """
+        Send a request to ComfyUI, retrying transient failures.
+
+        endpoint names the histogram and timeout bucket (e.g. "history" for
+        /history/{id}). Returns the last response, or raises the last
+        requests exception if every attempt failed to get one.
+        """
+        retries = self.retries if retries is None else retries
+        timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUTS.get(endpoint, DEFAULT_READ_TIMEOUT))
+        histogram = self._histogram(endpoint)
+
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+            except requests.RequestException as e:
+                histogram.observe((time.perf_counter() - start) * 1000)
+                histogram.errors += 1
+                if attempt >= retries:
+                    raise
+                logger.warning(f"ComfyUI {method} {path} failed ({e}), retrying")
+            else:
+                histogram.observe((time.perf_counter() - start) * 1000)
+                if response.status_code < 500 or attempt >= retries:
+                    if response.status_code >= 500:
+                        histogram.errors += 1
+                    return response
+                histogram.errors += 1
+                logger.warning(f"ComfyUI {method} {path} returned {response.status_code}, retrying")
+
+            histogram.retries += 1
+            # Full jitter keeps retries from several callers from lining up
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+    def get(self, endpoint: str, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", endpoint, path, **kwargs)
+
+    def post(self, endpoint: str, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", endpoint, path, **kwargs)
+
+    def connect_websocket(self, client_id: str, recv_timeout: float):
+        """Open the execution event websocket, timed like the HTTP endpoints"""
+        if not WEBSOCKET_AVAILABLE:
+            return None
+        histogram = self._histogram("ws_connect")
+        start = time.perf_counter()
+        try:
+            ws = websocket.create_connection(f"{self.ws_url}?clientId={client_id}", timeout=CONNECT_TIMEOUT + 3)
+        except Exception:
+            histogram.errors += 1
+            raise
+        finally:
+            histogram.observe((time.perf_counter() - start) * 1000)
+        ws.settimeout(recv_timeout)
+        return ws
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-endpoint latency histograms and error/retry counts"""
+        with self.lock:
+            return {endpoint: histogram.snapshot() for endpoint, histogram in sorted(self.histograms.items())}
+
+    def summary(self) -> str:
+        """One-line latency summary for logs"""
+        parts: List[str] = []
+        for endpoint, snapshot in self.stats().items():
+            parts.append(
+                f"{endpoint} n={snapshot['count']} p50<={snapshot['p50_ms']}ms "
+                f"p95<={snapshot['p95_ms']}ms err={snapshot['errors']}"
+            )
+        return "; ".join(parts)
@@ -1,33 +1,448 @@
 #!/usr/bin/env python3
 """
 Download required models for FLUX.1 Kontext Dev
+
+Models are fetched concurrently, large files are split across several HTTP
+range requests, interrupted downloads resume from their .part file, and every
+file is checked against its sha256 before being renamed into place.
+
+The expected sha256 of each model is pinned in model_hashes.json, keyed by the
+file's path under the models directory. A model without a pinned hash is not
+downloaded unless ALLOW_UNPINNED_MODELS=true, in which case the server's ETag
+is the only check. Run "python download_models.py --pin" (with HF_TOKEN set)
+to fill in missing hashes from the Hugging Face LFS metadata, then review and
+commit the file.
 """
 
 import os
-import subprocess
 import sys
+import json
+import argparse
+import time
+import hashlib
+import logging
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Download tuning
+MAX_PARALLEL_FILES = 4
+SEGMENTS_PER_FILE = 8
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+REQUEST_TIMEOUT = 60
+SEGMENT_RETRIES = 5
+# Client errors worth retrying; any other 4xx (bad token, missing file) fails at once
+RETRYABLE_CLIENT_ERRORS = {408, 429}
+STATE_SAVE_INTERVAL = 5  # seconds between .part.json progress saves
+MAX_REDIRECTS = 10
+
+# Pinned model hashes: relative path -> {"url", "sha256"}
+MODEL_HASHES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_hashes.json")
+# Explicit opt-out: download models with no pinned sha256, checked against the server's ETag only
+ALLOW_UNPINNED_MODELS = os.environ.get("ALLOW_UNPINNED_MODELS", "false").lower() == "true"
+
+# sha256 of files downloaded and verified by this process, so the model
+# manifest doesn't have to hash them again
+verified_hashes: Dict[str, str] = {}
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Surface redirects as HTTPError so we can read headers on each hop"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+_probe_opener = urllib.request.build_opener(_NoRedirect)
+
+def _auth_headers(url: str, origin: str, hf_token: Optional[str]) -> Dict[str, str]:
+    """Only send the token to the host it was meant for, not to CDN redirects"""
+    if hf_token and urllib.parse.urlparse(url).netloc == urllib.parse.urlparse(origin).netloc:
+        return {"Authorization": f"Bearer {hf_token}"}
+    return {}
+
+def _parse_sha256(etag: Optional[str]) -> Optional[str]:
+    """Hugging Face reports the sha256 of LFS files as their (linked) ETag"""
+    if not etag:
+        return None
+    etag = etag.strip().strip('"')
+    if etag.startswith("W/"):
+        etag = etag[2:].strip('"')
+    if len(etag) == 64 and all(c in "0123456789abcdef" for c in etag.lower()):
+        return etag.lower()
+    return None
+
+def probe(url: str, hf_token: Optional[str] = None) -> Dict[str, Any]:
+    """
+    HEAD the URL, following redirects by hand.
+
+    Returns the final URL, its size, whether it accepts range requests, and the
+    sha256 advertised by the server (X-Linked-Etag on Hugging Face) if any.
+    """
+    current = url
+    sha256 = None
+    size = None
+    for _ in range(MAX_REDIRECTS):
+        request = urllib.request.Request(current, method="HEAD", headers=_auth_headers(current, url, hf_token))
+        try:
+            response = _probe_opener.open(request, timeout=REQUEST_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code in (301, 302, 303, 307, 308) and e.headers.get("Location"):
+                sha256 = sha256 or _parse_sha256(e.headers.get("X-Linked-Etag"))
+                if e.headers.get("X-Linked-Size"):
+                    size = size or int(e.headers["X-Linked-Size"])
+                current = urllib.parse.urljoin(current, e.headers["Location"])
+                continue
+            raise
+        with response:
+            headers = response.headers
+            if headers.get("Content-Length"):
+                size = int(headers["Content-Length"])
+            sha256 = sha256 or _parse_sha256(headers.get("X-Linked-Etag")) or _parse_sha256(headers.get("ETag"))
+            return {
+                "url": current,
+                "size": size,
+                "accept_ranges": headers.get("Accept-Ranges", "").lower() == "bytes",
+                "sha256": sha256,
+            }
+    raise IOError(f"Too many redirects for {url}")
+
+def sha256_file(path: str) -> str:
+    """Compute the sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE * 8), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class _PartState:
+    """Progress of a segmented download, persisted next to the .part file"""
+
+    def __init__(self, path: str, url: str, size: int, segments: List[Dict[str, int]]):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.last_save = 0.0
 
-def download_file(url, destination):
-    """Download a file using wget with progress bar"""
-    print(f"Downloading {os.path.basename(destination)}...")
+    @classmethod
+    def create(cls, path: str, url: str, size: int, segment_count: int) -> "_PartState":
+        segment_size = -(-size // segment_count)
+        segments = [
+            {"start": start, "end": min(start + segment_size, size) - 1, "done": 0}
+            for start in range(0, size, segment_size)
+        ]
+        return cls(path, url, size, segments)
+
+    @classmethod
+    def load(cls, path: str, url: str, size: int) -> Optional["_PartState"]:
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("size") == size:
+                return cls(path, url, size, data["segments"])
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def downloaded(self) -> int:
+        return sum(segment["done"] for segment in self.segments)
+
+    def advance(self, segment: Dict[str, int], count: int):
+        with self.lock:
+            segment["done"] += count
+            if time.time() - self.last_save > STATE_SAVE_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": self.url, "size": self.size, "segments": self.segments}, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+
+def _fetch_segment(url: str, part_path: str, state: _PartState, segment: Dict[str, int], headers: Dict[str, str]):
+    """Download one byte range into the .part file, retrying from where it stopped"""
+    for attempt in range(SEGMENT_RETRIES):
+        offset = segment["start"] + segment["done"]
+        if offset > segment["end"]:
+            return
+        request = urllib.request.Request(url, headers={**headers, "Range": f"bytes={offset}-{segment['end']}"})
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                if response.status != 206:
+                    raise IOError(f"Server ignored range request (status {response.status})")
+                # Unbuffered so bytes counted as done are actually in the file
+                with open(part_path, "r+b", buffering=0) as f:
+                    f.seek(offset)
+                    while True:
+                        block = response.read(READ_SIZE)
+                        if not block:
+                            break
+                        block = block[:segment["end"] + 1 - (segment["start"] + segment["done"])]
+                        f.write(block)
+                        state.advance(segment, len(block))
+            if segment["start"] + segment["done"] > segment["end"]:
+                return
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500 and e.code not in RETRYABLE_CLIENT_ERRORS:
+                raise IOError(f"Segment {segment['start']}-{segment['end']} failed: HTTP {e.code} {e.reason}")
+            logger.warning(f"Segment {segment['start']}-{segment['end']} failed (attempt {attempt + 1}): {e}")
+            time.sleep(min(2 ** attempt, 30))
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(f"Segment {segment['start']}-{segment['end']} failed (attempt {attempt + 1}): {e}")
+            time.sleep(min(2 ** attempt, 30))
+    raise IOError(f"Segment {segment['start']}-{segment['end']} failed after {SEGMENT_RETRIES} attempts")
+
+def _fetch_stream(url: str, part_path: str, headers: Dict[str, str]):
+    """Download the whole file in one request (server doesn't support ranges)"""
+    request = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response, open(part_path, "wb") as f:
+        while True:
+            block = response.read(READ_SIZE)
+            if not block:
+                break
+            f.write(block)
+
+def load_pinned_hashes(path: str = MODEL_HASHES_FILE) -> Dict[str, Dict[str, Any]]:
+    """Load the pinned model hashes (relative path -> url, sha256), or none"""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not load pinned model hashes from {path}: {e}")
+        return {}
+
+def with_pinned_hashes(models: List[Dict[str, Any]], models_base: str,
+                       pinned: Optional[Dict[str, Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    Fill in each model's "sha256" from the pinned hashes, by its path under
+    models_base. A pin only applies to the URL it was recorded for.
+    """
+    if pinned is None:
+        pinned = load_pinned_hashes()
+    for model in models:
+        entry = pinned.get(os.path.relpath(model["path"], models_base)) or {}
+        if not model.get("sha256") and entry.get("sha256") and entry.get("url") == model["url"]:
+            model["sha256"] = entry["sha256"]
+    return models
+
+def download_file(url: str, destination: str, sha256: Optional[str] = None,
+                  hf_token: Optional[str] = None, segments: int = SEGMENTS_PER_FILE,
+                  allow_unpinned: bool = False) -> bool:
+    """
+    Download a file to destination via <destination>.part, resuming if possible.
+
+    The file is only renamed into place once its sha256 matches the pinned
+    value. The server's ETag is a cross-check: a pin that disagrees with it
+    fails before anything is downloaded. Without a pin the download fails,
+    unless allow_unpinned is set, in which case the ETag (if any) is used.
+    """
+    name = os.path.basename(destination)
+    part_path = f"{destination}.part"
+    state_path = f"{part_path}.json"
     os.makedirs(os.path.dirname(destination), exist_ok=True)
-    
-    cmd = ["wget", "-O", destination, "--progress=bar:force", url]
-    result = subprocess.run(cmd)
-    
-    if result.returncode != 0:
-        print(f"Failed to download {url}")
+
+    try:
+        info = probe(url, hf_token)
+        expected_sha256 = (sha256 or "").lower() or None
+        if expected_sha256 and info["sha256"] and info["sha256"] != expected_sha256:
+            logger.error(f"Pinned sha256 for {name} ({expected_sha256}) differs from the server's ({info['sha256']})")
+            return False
+        if not expected_sha256:
+            if not allow_unpinned:
+                logger.error(
+                    f"No pinned sha256 for {name}; add it to {os.path.basename(MODEL_HASHES_FILE)} "
+                    f"or set ALLOW_UNPINNED_MODELS=true"
+                )
+                return False
+            expected_sha256 = info["sha256"]
+        size = info["size"]
+        start_time = time.time()
+
+        if info["accept_ranges"] and size:
+            segment_count = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+            state = None
+            if os.path.exists(part_path) and os.path.getsize(part_path) == size:
+                state = _PartState.load(state_path, info["url"], size)
+            if state:
+                logger.info(f"Resuming {name} at {state.downloaded() / (1024 * 1024):.1f} MB")
+            else:
+                state = _PartState.create(state_path, info["url"], size, segment_count)
+                with open(part_path, "wb") as f:
+                    f.truncate(size)
+            state.save()
+
+            logger.info(f"Downloading {name} ({size / (1024 * 1024):.1f} MB) in {len(state.segments)} segments")
+            headers = _auth_headers(info["url"], url, hf_token)
+            with ThreadPoolExecutor(max_workers=len(state.segments)) as pool:
+                futures = [
+                    pool.submit(_fetch_segment, info["url"], part_path, state, segment, headers)
+                    for segment in state.segments
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                finally:
+                    state.save()
+        else:
+            logger.info(f"Downloading {name} in a single stream")
+            _fetch_stream(info["url"], part_path, _auth_headers(info["url"], url, hf_token))
+
+        if size is not None and os.path.getsize(part_path) != size:
+            raise IOError(f"Size mismatch: expected {size} bytes, got {os.path.getsize(part_path)}")
+
+        if expected_sha256:
+            actual_sha256 = sha256_file(part_path)
+            if actual_sha256 != expected_sha256:
+                logger.error(f"Checksum mismatch for {name}: expected {expected_sha256}, got {actual_sha256}")
+                for path in (part_path, state_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return False
+        else:
+            logger.warning(f"No sha256 known for {name}, skipping checksum verification (ALLOW_UNPINNED_MODELS)")
+
+        os.replace(part_path, destination)
+        if expected_sha256:
+            verified_hashes[destination] = expected_sha256
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        elapsed = max(time.time() - start_time, 1e-6)
+        size_mb = os.path.getsize(destination) / (1024 * 1024)
+        logger.info(f"Downloaded {name}: {size_mb:.1f} MB in {elapsed:.1f}s ({size_mb / elapsed:.1f} MB/s)")
+        return True
+    except Exception as e:
+        # Keep the .part file and its state so the next attempt can resume
+        logger.error(f"Failed to download {name}: {e}")
         return False
-    return True
+
+def download_models(models: List[Dict[str, Any]], hf_token: Optional[str] = None,
+                    max_workers: int = MAX_PARALLEL_FILES,
+                    allow_unpinned: bool = ALLOW_UNPINNED_MODELS) -> Dict[str, bool]:
+    """
+    Download all missing models concurrently.
+
+    Each model is a dict with "name", "url", "path" and optionally "sha256"
+    (see with_pinned_hashes) and "requires_auth". Returns a name -> success mapping.
+    """
+    results = {}
+    missing = []
+    for model in models:
+        if os.path.exists(model["path"]):
+            results[model["name"]] = True
+        else:
+            missing.append(model)
+
+    if not missing:
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as pool:
+        futures = {
+            model["name"]: pool.submit(
+                download_file,
+                model["url"],
+                model["path"],
+                model.get("sha256"),
+                hf_token if model.get("requires_auth", False) else None,
+                allow_unpinned=allow_unpinned
+            )
+            for model in missing
+        }
+        for name, future in futures.items():
+            results[name] = future.result()
+    return results
+
+def load_manifest(path: str) -> Dict[str, Dict[str, Any]]:
+    """Load a model manifest (path -> size, mtime, sha256), or an empty one"""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(path: str, manifest: Dict[str, Dict[str, Any]]):
+    """Atomically write a model manifest"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def verify_model_files(paths: List[str], manifest: Dict[str, Dict[str, Any]],
+                       hash_files: bool = True) -> Dict[str, Dict[str, Any]]:
+    """
+    Stat each model file and return manifest entries for the ones present.
+
+    Cached entries whose size and mtime still match are reused without touching
+    the file contents. Other files get the hash verified at download time, or
+    are hashed now if hash_files is set.
+    """
+    entries = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        cached = manifest.get(path)
+        if cached and cached.get("size") == stat.st_size and cached.get("mtime") == stat.st_mtime:
+            if cached.get("sha256") or not hash_files:
+                entries[path] = cached
+                continue
+        sha256 = verified_hashes.get(path)
+        if sha256 is None and hash_files:
+            logger.info(f"Hashing {os.path.basename(path)} for the model manifest...")
+            sha256 = sha256_file(path)
+        entries[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+    return entries
+
+def pin_hashes(path: str = MODEL_HASHES_FILE, hf_token: Optional[str] = None) -> bool:
+    """
+    Fill in missing sha256 values of the pinned hashes file from the
+    Hugging Face LFS metadata (X-Linked-Etag). Existing pins are only checked.
+    """
+    pinned = load_pinned_hashes(path)
+    complete = True
+    for relative_path, entry in pinned.items():
+        try:
+            server_sha256 = probe(entry["url"], hf_token)["sha256"]
+        except Exception as e:
+            logger.error(f"Could not probe {relative_path}: {e}")
+            complete = complete and bool(entry.get("sha256"))
+            continue
+        if not server_sha256:
+            logger.warning(f"{relative_path}: the server reports no sha256")
+            complete = complete and bool(entry.get("sha256"))
+        elif not entry.get("sha256"):
+            entry["sha256"] = server_sha256
+            logger.info(f"{relative_path}: pinned {server_sha256}")
+        elif entry["sha256"] != server_sha256:
+            logger.error(f"{relative_path}: pinned {entry['sha256']} but the server reports {server_sha256}")
+            complete = False
+    save_manifest(path, pinned)
+    return complete
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pin", action="store_true",
+                        help=f"Fill in missing hashes in {os.path.basename(MODEL_HASHES_FILE)} instead of downloading")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
     models_base = "/workspace/ComfyUI/models"
-    
-    # Create directories
-    os.makedirs(f"{models_base}/unet", exist_ok=True)
-    os.makedirs(f"{models_base}/clip", exist_ok=True)
-    os.makedirs(f"{models_base}/vae", exist_ok=True)
-    
+    hf_token = os.environ.get('HF_TOKEN', os.environ.get('HUGGING_FACE_TOKEN', None))
+
+    if args.pin:
+        sys.exit(0 if pin_hashes(hf_token=hf_token) else 1)
+
     # Models to download
     models = [
         {
@@ -48,27 +463,27 @@ def main():
         {
             "name": "VAE",
             "url": "https://huggingface.co/black-forest-labs/FLUX.1-Kontext-dev/resolve/main/ae.safetensors",
-            "path": f"{models_base}/vae/ae.safetensors"
+            "path": f"{models_base}/vae/ae.safetensors",
+            "requires_auth": True
         }
     ]
-    
+
     print("Downloading required models for FLUX.1 Kontext Dev...")
     print("-" * 50)
-    
+
+    results = download_models(with_pinned_hashes(models, models_base), hf_token)
+
     for model in models:
-        if os.path.exists(model["path"]):
-            print(f"✓ {model['name']} already exists")
-            continue
-        
-        print(f"\nDownloading {model['name']}...")
-        if download_file(model["url"], model["path"]):
-            print(f"✓ {model['name']} downloaded successfully")
+        if results.get(model["name"]):
+            print(f"✓ {model['name']}")
         else:
             print(f"✗ Failed to download {model['name']}")
-            sys.exit(1)
-    
+
+    if not all(results.values()):
+        sys.exit(1)
+
     print("\n" + "-" * 50)
     print("All models downloaded successfully!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
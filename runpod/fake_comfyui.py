@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Offline stand-in for the ComfyUI HTTP and websocket API
+
+Implements the endpoints the handlers use (/prompt, /history, /view,
+/upload/image, /queue, /interrupt, /system_stats and /ws) without a GPU or
+any models.
+Prompts run one at a time in queue order like in ComfyUI: each node of the
+workflow "executes" for an equal share of the render latency, with the same
+websocket events ComfyUI sends, and every SaveImage node (or the last node if
+there is none) outputs noise PNGs of the configured size. Used by
+bench_handlers.py to measure handler overhead on CPU-only machines.
+
+Only the standard library is needed.
+
+Usage:
+    python fake_comfyui.py --port 8188 --latency 2 --width 1024 --height 1024
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import zlib
+import base64
+import random
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OUTPUT_NODES = {"SaveImage", "PreviewImage"}
+
+def noise_png(width: int, height: int, seed: int = 0) -> bytes:
+    """RGB noise PNG, so the encoded size is close to a real render's"""
+    rng = random.Random(seed)
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b"")
+
+def parse_multipart(body: bytes, content_type: str) -> Dict[str, Tuple[Optional[str], bytes]]:
+    """Form fields of a multipart/form-data body as name -> (filename, data)"""
+    boundary = content_type.split("boundary=", 1)[-1].split(";")[0].strip('"').encode("latin-1")
+    fields = {}
+    for part in body.split(b"--" + boundary)[1:-1]:
+        # Each part is CRLF, headers, blank line, data, CRLF
+        head, _, data = part[2:].partition(b"\r\n\r\n")
+        params = dict(re.findall(r'(\w+)="([^"]*)"', head.decode("latin-1")))
+        fields[params.get("name")] = (params.get("filename"), data[:-2])
+    return fields
+
+class WebSocketClient:
+    """Server side of one /ws connection (text frames out, close and ping handled in)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send_frame(self, opcode: int, payload: bytes):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.connection.sendall(header + payload)
+            except OSError:
+                self.closed = True
+
+    def send_json(self, message: Dict[str, Any]):
+        self.send_frame(0x1, json.dumps(message).encode("utf-8"))
+
+    def read_frame(self, rfile):
+        """Read one (masked) client frame; returns (opcode, payload), or None when the socket closes"""
+        header = rfile.read(2)
+        if len(header) < 2:
+            return None
+        opcode = header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", rfile.read(8))[0]
+        mask = rfile.read(4) if header[1] & 0x80 else b"\x00" * 4
+        payload = bytearray(rfile.read(length))
+        for i in range(len(payload)):
+            payload[i] ^= mask[i % 4]
+        return opcode, bytes(payload)
+
+class FakeComfyUI:
+    """Prompt queue, history, files and websocket clients of the fake server"""
+
+    def __init__(self, latency: float = 1.0, jitter: float = 0.0, width: int = 1024, height: int = 1024,
+                 images: int = 1, directory: Optional[str] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.images_per_output = images
+        self.directory = directory
+        # Every output shares the same bytes, only the filenames differ
+        self.image = noise_png(width, height)
+        self.files: Dict[str, bytes] = {}
+        self.history: Dict[str, Dict[str, Any]] = {}
+        self.pending = deque()
+        self.running: Optional[List[Any]] = None
+        self.number = 0
+        self.image_counter = 0
+        self.clients: Dict[str, List[WebSocketClient]] = {}
+        self.condition = threading.Condition()
+        self.interrupted = threading.Event()
+        threading.Thread(target=self.worker, name="fake-comfyui-worker", daemon=True).start()
+
+    def queue_prompt(self, prompt: Dict[str, Any], client_id: Optional[str]) -> Dict[str, Any]:
+        with self.condition:
+            prompt_id = str(uuid.uuid4())
+            entry = [self.number, prompt_id, prompt, {"client_id": client_id}, self.output_nodes(prompt)]
+            self.number += 1
+            self.pending.append(entry)
+            self.condition.notify()
+        self.send_status()
+        return {"prompt_id": prompt_id, "number": entry[0], "node_errors": {}}
+
+    @staticmethod
+    def output_nodes(prompt: Dict[str, Any]) -> List[str]:
+        nodes = [node_id for node_id, node in prompt.items() if node.get("class_type") in OUTPUT_NODES]
+        return nodes or list(prompt)[-1:]
+
+    def queue_info(self) -> Dict[str, Any]:
+        with self.condition:
+            return {
+                "queue_running": [self.running] if self.running else [],
+                "queue_pending": list(self.pending),
+            }
+
+    def delete(self, prompt_ids: List[str]):
+        """Drop prompts that are still waiting in the queue"""
+        with self.condition:
+            self.pending = deque(entry for entry in self.pending if entry[1] not in prompt_ids)
+        self.send_status()
+
+    def interrupt(self, prompt_id: Optional[str] = None):
+        """Stop the running prompt, only if it is prompt_id when one is given"""
+        with self.condition:
+            if self.running and prompt_id in (None, self.running[1]):
+                self.interrupted.set()
+
+    def queue_remaining(self) -> int:
+        with self.condition:
+            return len(self.pending) + (1 if self.running else 0)
+
+    def send(self, client_id: Optional[str], event_type: str, data: Dict[str, Any]):
+        """Send an event to one client's sockets, or to every client when client_id is None"""
+        with self.condition:
+            if client_id is None:
+                sockets = [ws for client in self.clients.values() for ws in client]
+            else:
+                sockets = list(self.clients.get(client_id, []))
+        for ws in sockets:
+            ws.send_json({"type": event_type, "data": data})
+
+    def send_status(self, client_id: Optional[str] = None):
+        self.send(client_id, "status", {"status": {"exec_info": {"queue_remaining": self.queue_remaining()}}})
+
+    def save_image(self, data: bytes, folder_type: str, filename: str):
+        self.files[f"{folder_type}/{filename}"] = data
+        if self.directory:
+            folder = os.path.join(self.directory, folder_type)
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, filename), "wb") as f:
+                f.write(data)
+
+    def render(self, entry: List[Any]) -> Dict[str, Any]:
+        """Run one prompt: node events spread over the render latency, then history and outputs"""
+        number, prompt_id, prompt, extra, output_nodes = entry
+        client_id = extra.get("client_id")
+        latency = max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+        started = time.time()
+
+        self.send(client_id, "execution_start", {"prompt_id": prompt_id, "timestamp": int(started * 1000)})
+        outputs = {}
+        for node_id in prompt:
+            self.send(client_id, "executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+            if self.interrupted.wait(latency / len(prompt)):
+                self.send(client_id, "execution_interrupted", {"prompt_id": prompt_id, "node_id": node_id})
+                return {
+                    "prompt": entry,
+                    "outputs": outputs,
+                    "status": {
+                        "status_str": "error",
+                        "completed": False,
+                        "messages": [["execution_interrupted", {"prompt_id": prompt_id, "node_id": node_id}]],
+                    },
+                }
+            if node_id in output_nodes:
+                images = []
+                for _ in range(self.images_per_output):
+                    self.image_counter += 1
+                    filename = f"ComfyUI_{self.image_counter:05d}_.png"
+                    self.save_image(self.image, "output", filename)
+                    images.append({"filename": filename, "subfolder": "", "type": "output"})
+                outputs[node_id] = {"images": images}
+                self.send(client_id, "executed", {"node": node_id, "display_node": node_id,
+                                                  "output": outputs[node_id], "prompt_id": prompt_id})
+
+        return {
+            "prompt": entry,
+            "outputs": outputs,
+            "status": {
+                "status_str": "success",
+                "completed": True,
+                "messages": [
+                    ["execution_start", {"prompt_id": prompt_id, "timestamp": int(started * 1000)}],
+                    ["execution_success", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}],
+                ],
+            },
+        }
+
+    def worker(self):
+        """Run queued prompts one at a time, in queue order"""
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                self.running = self.pending.popleft()
+                self.interrupted.clear()
+            entry = self.running
+            client_id = entry[3].get("client_id")
+            history = self.render(entry)
+            with self.condition:
+                # Stored before the final event, as ComfyUI does, so a client can fetch it straight away
+                self.history[entry[1]] = history
+                self.running = None
+            self.send(client_id, "executing", {"node": None, "display_node": None, "prompt_id": entry[1]})
+            self.send_status()
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeComfyUI/1.0"
+    # Headers and body go out in separate writes; don't let delayed ACKs add 40ms to every response
+    disable_nagle_algorithm = True
+
+    @property
+    def comfy(self) -> FakeComfyUI:
+        return self.server.comfy
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def send_body(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data: Any, status: int = 200):
+        self.send_body(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/ws":
+            self.serve_websocket(query.get("clientId") or str(uuid.uuid4()))
+        elif url.path == "/system_stats":
+            self.send_json({
+                "system": {"os": os.name, "python_version": sys.version, "comfyui_version": "fake", "ram_total": 0, "ram_free": 0},
+                "devices": [{"name": "cpu (fake)", "type": "cpu", "index": 0, "vram_total": 0, "vram_free": 0}],
+            })
+        elif url.path == "/queue":
+            self.send_json(self.comfy.queue_info())
+        elif url.path == "/history":
+            max_items = int(query.get("max_items", 0)) or None
+            with self.comfy.condition:
+                items = list(self.comfy.history.items())
+            self.send_json(dict(items[-max_items:] if max_items else items))
+        elif url.path.startswith("/history/"):
+            prompt_id = url.path[len("/history/"):]
+            entry = self.comfy.history.get(prompt_id)
+            self.send_json({prompt_id: entry} if entry else {})
+        elif url.path == "/view":
+            name = "/".join(part for part in (query.get("subfolder"), query.get("filename")) if part)
+            data = self.comfy.files.get(f"{query.get('type', 'output')}/{name}")
+            if data is None:
+                self.send_body(404, b"404: Not Found", "text/plain")
+            else:
+                self.send_body(200, data, "image/png")
+        else:
+            self.send_body(404, b"404: Not Found", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/prompt":
+            try:
+                data = json.loads(self.read_body())
+                prompt = data["prompt"]
+                if not isinstance(prompt, dict) or not prompt:
+                    raise ValueError("prompt must be a non-empty object")
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json({"error": {"type": "invalid_prompt", "message": str(e)}, "node_errors": {}}, 400)
+                return
+            self.send_json(self.comfy.queue_prompt(prompt, data.get("client_id")))
+        elif url.path in ("/queue", "/interrupt"):
+            try:
+                data = json.loads(self.read_body() or b"{}")
+            except ValueError:
+                data = {}
+            if url.path == "/interrupt":
+                self.comfy.interrupt(data.get("prompt_id"))
+            elif data.get("clear"):
+                with self.comfy.condition:
+                    prompt_ids = [entry[1] for entry in self.comfy.pending]
+                self.comfy.delete(prompt_ids)
+            else:
+                self.comfy.delete(data.get("delete", []))
+            self.send_body(200, b"", "text/plain")
+        elif url.path == "/upload/image":
+            fields = parse_multipart(self.read_body(), self.headers.get("Content-Type", ""))
+            filename, data = fields.get("image", (None, b""))
+            if not filename:
+                self.send_body(400, b"No image uploaded", "text/plain")
+                return
+            filename = os.path.basename(filename)
+            folder_type = fields.get("type", (None, b""))[1].decode("utf-8").strip() or "input"
+            self.comfy.save_image(data, folder_type, filename)
+            self.send_json({"name": filename, "subfolder": "", "type": folder_type})
+        else:
+            self.send_body(404, b"404: Not Found", "text/plain")
+
+    def serve_websocket(self, client_id: str):
+        """Upgrade to a websocket and hold it open until the client goes away"""
+        key = self.headers.get("Sec-WebSocket-Key")
+        if not key:
+            self.send_body(400, b"Expected a websocket upgrade", "text/plain")
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode("ascii")).digest()).decode("ascii")
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        ws = WebSocketClient(self.connection)
+        with self.comfy.condition:
+            self.comfy.clients.setdefault(client_id, []).append(ws)
+        self.comfy.send_status(client_id)
+        try:
+            while True:
+                frame = ws.read_frame(self.rfile)
+                if frame is None:
+                    break
+                opcode, payload = frame
+                if opcode == 0x8:
+                    ws.send_frame(0x8, payload[:2])
+                    break
+                if opcode == 0x9:
+                    ws.send_frame(0xA, payload)
+        except OSError:
+            pass
+        finally:
+            ws.closed = True
+            with self.comfy.condition:
+                self.comfy.clients[client_id].remove(ws)
+                if not self.comfy.clients[client_id]:
+                    del self.comfy.clients[client_id]
+            self.close_connection = True
+
+def make_server(host: str = "127.0.0.1", port: int = 8188, **settings) -> ThreadingHTTPServer:
+    """Create a fake ComfyUI server (call serve_forever() to run it)"""
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.comfy = FakeComfyUI(**settings)
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for the ComfyUI API")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8188, help="Port to listen on (default: 8188)")
+    parser.add_argument("--latency", type=float, default=1.0, help="Render time per prompt in seconds (default: 1)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- fraction of the latency (default: 0)")
+    parser.add_argument("--width", type=int, default=1024, help="Output image width (default: 1024)")
+    parser.add_argument("--height", type=int, default=1024, help="Output image height (default: 1024)")
+    parser.add_argument("--images", type=int, default=1, help="Images per output node (default: 1)")
+    parser.add_argument("--directory", help="Also write input/ and output/ images here, like ComfyUI's own directories")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+    server = make_server(args.host, args.port, latency=args.latency, jitter=args.jitter, width=args.width,
+                         height=args.height, images=args.images, directory=args.directory)
+    logger.info(f"Fake ComfyUI listening on http://{args.host}:{server.server_port} "
+                f"({args.latency:g}s per prompt, {args.width}x{args.height} images, "
+                f"{len(server.comfy.image) / 1024:.0f}KB each)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,15 +4,34 @@ RunPod Serverless Handler for ComfyUI with FLUX.1 Kontext Dev
 """
 
 import runpod
+import asyncio
 import json
 import os
 import sys
 import subprocess
+import shutil
+import tempfile
 import time
 import base64
+import hashlib
 import requests
 import logging
-from typing import Dict, Any, Optional
+import threading
+import uuid
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from download_models import download_models, with_pinned_hashes, load_manifest, save_manifest, verify_model_files
+from output_store import get_output_store, store_image
+from comfy_client import ComfyClient
+from result_cache import ResultCache, workflow_key
+from scheduler import PromptScheduler, PRIORITIES
+
+# websocket-client is used to receive ComfyUI execution events; without it we
+# fall back to polling /history
+try:
+    import websocket
+except ImportError:
+    websocket = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -23,52 +42,81 @@ sys.path.append('/workspace/ComfyUI')
 
 # Global ComfyUI process
 comfyui_process = None
-COMFYUI_URL = "http://127.0.0.1:8188"
+# Overridable to point the handler at an already running ComfyUI (see bench_handlers.py)
+COMFYUI_URL = os.environ.get("COMFYUI_URL", "http://127.0.0.1:8188")
+COMFYUI_DIR = os.environ.get("COMFYUI_DIR", "/workspace/ComfyUI")
+CLIENT_ID = str(uuid.uuid4())
 models_checked = False
 
-def download_model_if_needed(model_name: str, model_path: str, download_url: str, hf_token: Optional[str] = None) -> bool:
-    """Download a model if it doesn't exist."""
-    if os.path.exists(model_path):
-        logger.info(f"Model {model_name} already exists at {model_path}")
-        return True
-    
-    logger.info(f"Downloading {model_name} from {download_url}")
+# Shared pooled client for every call to the local ComfyUI API
+comfy = ComfyClient(COMFYUI_URL)
+
+# Validated model files (path -> size, mtime, sha256), built at startup and
+# cached on the volume so jobs check models with a dict lookup
+MODEL_MANIFEST_FILE = "manifest.json"
+model_manifest: Dict[str, Dict[str, Any]] = {}
+model_manifest_lock = threading.Lock()
+model_manifest_ready = threading.Event()
+model_download_lock = threading.Lock()
+
+# Per-phase cold start timings in seconds, reported with the first job
+startup_timings: Dict[str, float] = {}
+startup_reported = False
+# Precision policy: keep one FLUX/T5 precision resident across jobs instead of
+# swapping multi-GB checkpoints whenever traffic alternates between fp8 and fp16.
+#   allow   - load whatever each workflow asks for (smart memory stays disabled)
+#   rewrite - switch workflows to the resident precision's model files
+#   reject  - fail workflows that would force a swap
+PRECISION_POLICY = os.environ.get("PRECISION_POLICY", "allow").lower()
+resident_precision = os.environ.get("PINNED_PRECISION") or None
+# FLUX and T5 model files of each precision, as downloaded by ensure_models()
+FLUX_MODELS = {"fp16": "flux1-kontext-dev-fp16.safetensors", "fp8": "flux1-kontext-dev-fp8.safetensors"}
+T5_MODELS = {"fp16": "t5xxl_fp16.safetensors", "fp8": "t5xxl_fp8_e4m3fn.safetensors"}
+
+# Node classes whose execution time is reported as model loading or sampling
+MODEL_LOADER_NODES = {"UNETLoader", "DualCLIPLoader", "CLIPLoader", "VAELoader", "CheckpointLoaderSimple", "LoraLoader"}
+SAMPLER_NODES = {"KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced"}
+
+STARTUP_TIMEOUT = 60
+STARTUP_POLL_INTERVAL = 0.1
+REQUIRED_NODES = ["ReferenceLatent"]
+
+# Reference images are stored content-addressed in ComfyUI's input directory,
+# with a hash -> filename index alongside them
+UPLOAD_INDEX_FILE = "upload_index.json"
+IMAGE_HASH_PREFIX = "sha256:"
+upload_index = None
+
+# Object store for result images (see output_store.py); None means base64 responses
+output_store = None
+
+# Finished results keyed by the processed workflow (see result_cache.py); 0 disables the cache
+RESULT_CACHE_MAX_GB = float(os.environ.get("RESULT_CACHE_MAX_GB", 20))
+result_cache = None
+
+# Jobs this worker takes at once (RunPod concurrency modifier) and ComfyUI prompts
+# in flight across all of them. Prompts past the cap wait in the local scheduler,
+# where interactive jobs can still overtake bulk ones, instead of in ComfyUI's queue.
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 4))
+MAX_INFLIGHT_PROMPTS = int(os.environ.get("MAX_INFLIGHT_PROMPTS", 2))
+scheduler = PromptScheduler(MAX_INFLIGHT_PROMPTS)
+
+# Completion wait settings
+GENERATION_TIMEOUT = 900  # 15 minutes
+# Also how quickly a cancelled job notices while no websocket events arrive
+WS_RECV_TIMEOUT = 1
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 4.0
+
+def log_free_space(model_name: str, model_path: str):
+    """Log free space on the volume a model is about to be downloaded to"""
     try:
-        # Create directory if needed
         os.makedirs(os.path.dirname(model_path), exist_ok=True)
-        
-        # Check available space
-        import shutil
         disk_usage = shutil.disk_usage(os.path.dirname(model_path))
         free_gb = disk_usage.free / (1024**3)
         logger.info(f"Free space before downloading {model_name}: {free_gb:.1f} GB")
-        
-        # Build wget command with optional auth header
-        cmd = f"wget -O {model_path}"
-        if hf_token:
-            cmd += f" --header='Authorization: Bearer {hf_token}'"
-        cmd += f" {download_url}"
-        
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            logger.info(f"Successfully downloaded {model_name}")
-            # Verify file size
-            if os.path.exists(model_path):
-                size_mb = os.path.getsize(model_path) / (1024 * 1024)
-                logger.info(f"{model_name} size: {size_mb:.1f} MB")
-            return True
-        else:
-            logger.error(f"Failed to download {model_name}: Exit code {result.returncode}")
-            logger.error(f"STDOUT: {result.stdout}")
-            logger.error(f"STDERR: {result.stderr}")
-            # Clean up partial download
-            if os.path.exists(model_path):
-                os.remove(model_path)
-            return False
-    except Exception as e:
-        logger.error(f"Error downloading {model_name}: {str(e)}")
-        return False
+    except OSError as e:
+        logger.warning(f"Could not check disk space: {e}")
 
 def ensure_models(hf_token=None, weight_dtype="fp8"):
     """Ensure all required models are downloaded."""
@@ -141,12 +189,18 @@ def ensure_models(hf_token=None, weight_dtype="fp8"):
             "requires_auth": False
         })
     
-    # Download models if needed
-    all_success = True
+    # Download all missing models concurrently
     for model in required_models:
-        token_to_use = hf_token if model.get('requires_auth', False) else None
-        if not download_model_if_needed(model["name"], model["path"], model["url"], token_to_use):
-            logger.warning(f"Failed to download {model['name']}")
+        if not os.path.exists(model["path"]):
+            logger.info(f"Downloading {model['name']} from {model['url']}")
+            log_free_space(model["name"], model["path"])
+    with model_download_lock:
+        results = download_models(with_pinned_hashes(required_models, models_base), hf_token)
+    
+    all_success = True
+    for name, success in results.items():
+        if not success:
+            logger.warning(f"Failed to download {name}")
             all_success = False
     
     # Mark as checked only if all models downloaded successfully
@@ -180,19 +234,29 @@ def start_comfyui():
             os.symlink(volume_models, comfyui_models)
             logger.info(f"Created symlink: {comfyui_models} -> {volume_models}")
     
-    # Kill any existing ComfyUI process
-    subprocess.run("pkill -f 'python.*main.py'", shell=True)
-    time.sleep(2)
+    # Kill any existing ComfyUI process, only waiting if there was one
+    if subprocess.run("pkill -f 'python.*main.py'", shell=True).returncode == 0:
+        time.sleep(2)
     
     cmd = [
         "python",
         "/workspace/ComfyUI/main.py",
         "--listen", "127.0.0.1",
         "--port", "8188",
-        "--preview-method", "none",
-        "--disable-smart-memory"
+        "--preview-method", "none"
     ]
     
+    # Smart memory keeps models in VRAM between jobs, which is only safe when the
+    # precision policy stops fp8 and fp16 checkpoints from being loaded side by side
+    if PRECISION_POLICY == "allow":
+        cmd.append("--disable-smart-memory")
+    logger.info(f"Precision policy: {PRECISION_POLICY}, resident precision: {resident_precision or 'first job'}")
+    
+    # Keep uploaded reference images on the Network Volume so they survive worker restarts
+    if os.path.exists("/runpod-volume"):
+        os.makedirs(get_input_dir(), exist_ok=True)
+        cmd += ["--input-directory", get_input_dir()]
+    
     # Start ComfyUI in background
     comfyui_process = subprocess.Popen(
         cmd,
@@ -202,29 +266,80 @@ def start_comfyui():
     )
     
     # Wait for server to be ready
-    for i in range(60):  # 60 second timeout
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if comfyui_process.poll() is not None:
+            logger.error(f"ComfyUI exited during startup with code {comfyui_process.returncode}")
+            return False
         try:
-            response = requests.get(f"{COMFYUI_URL}/system_stats", timeout=2)
+            response = comfy.get("system_stats", "/system_stats", retries=0)
             if response.status_code == 200:
                 logger.info("ComfyUI server is ready")
                 return True
-        except:
+        except requests.RequestException:
             pass
-        time.sleep(1)
+        time.sleep(STARTUP_POLL_INTERVAL)
     
     logger.error("ComfyUI server failed to start")
     return False
 
-def upload_image(image_data: str, filename: str) -> Optional[str]:
-    """Upload a base64 image to ComfyUI"""
+def get_input_dir() -> str:
+    """Return ComfyUI's input directory, on the Network Volume if available"""
+    if os.path.exists("/runpod-volume"):
+        return "/runpod-volume/input"
+    return f"{COMFYUI_DIR}/input"
+
+def load_upload_index() -> Dict[str, str]:
+    """Load the persistent image hash -> filename index (cached in memory)"""
+    global upload_index
+    if upload_index is None:
+        try:
+            with open(os.path.join(get_input_dir(), UPLOAD_INDEX_FILE), 'r') as f:
+                upload_index = json.load(f)
+        except (OSError, ValueError):
+            upload_index = {}
+    return upload_index
+
+def save_upload_index(digest: str, filename: str):
+    """Record an uploaded image in the index, merging with entries written by other workers"""
+    index = load_upload_index()
+    index[digest] = filename
+    
+    index_path = os.path.join(get_input_dir(), UPLOAD_INDEX_FILE)
+    try:
+        with open(index_path, 'r') as f:
+            on_disk = json.load(f)
+        on_disk.update(index)
+        index.update(on_disk)
+    except (OSError, ValueError):
+        pass
+    
+    try:
+        os.makedirs(get_input_dir(), exist_ok=True)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logger.warning(f"Could not save upload index: {e}")
+
+def find_uploaded_image(digest: str) -> Optional[str]:
+    """Return the input filename for an image hash if it is already in ComfyUI's input dir"""
+    filename = load_upload_index().get(digest, f"ref_{digest}.png")
+    if os.path.exists(os.path.join(get_input_dir(), filename)):
+        return filename
+    return None
+
+def decode_image_data(image_data: str) -> bytes:
+    """Decode a base64 image, with or without a data: URL prefix"""
+    # Remove data:image/png;base64, prefix if present
+    if image_data.startswith('data:'):
+        image_data = image_data.split(',')[1]
+    return base64.b64decode(image_data)
+
+def upload_image(image_bytes: bytes, filename: str) -> Optional[str]:
+    """Upload image bytes to ComfyUI"""
     try:
-        # Remove data:image/png;base64, prefix if present
-        if image_data.startswith('data:'):
-            image_data = image_data.split(',')[1]
-        
-        # Decode base64 to bytes
-        image_bytes = base64.b64decode(image_data)
-        
         # Create multipart form data
         files = {
             'image': (filename, image_bytes, 'image/png'),
@@ -232,10 +347,8 @@ def upload_image(image_data: str, filename: str) -> Optional[str]:
             'overwrite': (None, 'true')
         }
         
-        response = requests.post(
-            f"{COMFYUI_URL}/upload/image",
-            files=files
-        )
+        # Safe to retry: names are content-addressed and uploads overwrite
+        response = comfy.post("upload", "/upload/image", files=files)
         
         if response.status_code == 200:
             result = response.json()
@@ -250,38 +363,61 @@ def upload_image(image_data: str, filename: str) -> Optional[str]:
         return None
 
 def process_workflow_images(workflow: Dict[str, Any]) -> Dict[str, Any]:
-    """Process LoadImage nodes in workflow and upload base64 images"""
+    """
+    Process LoadImage nodes in workflow and upload base64 images.
+    
+    Images are keyed by the sha256 of their bytes, so an image that is already
+    in ComfyUI's input dir is referenced directly instead of being uploaded
+    again. A node may also pass just "sha256:<hex>" to reference an image
+    uploaded by an earlier job without sending the base64 payload.
+    """
     processed_workflow = workflow.copy()
     
     for node_id, node_data in processed_workflow.items():
         if node_data.get('class_type') == 'LoadImage':
             inputs = node_data.get('inputs', {})
             if 'image' in inputs and inputs.get('upload') == 'image':
-                # This is a base64 image that needs to be uploaded
                 image_data = inputs['image']
-                if image_data and isinstance(image_data, str) and len(image_data) > 100:
-                    # Generate a unique filename
-                    filename = f"input_{node_id}_{int(time.time())}.png"
-                    uploaded_name = upload_image(image_data, filename)
-                    
+                if not image_data or not isinstance(image_data, str):
+                    continue
+                
+                if image_data.startswith(IMAGE_HASH_PREFIX):
+                    # Bare hash reference to a previously uploaded image
+                    digest = image_data[len(IMAGE_HASH_PREFIX):].lower()
+                    uploaded_name = find_uploaded_image(digest)
+                    if not uploaded_name:
+                        raise ValueError(f"Unknown image hash for node {node_id}: {digest}")
+                    logger.info(f"Node {node_id} references cached image {uploaded_name}")
+                elif len(image_data) > 100:
+                    # This is a base64 image that needs to be uploaded
+                    image_bytes = decode_image_data(image_data)
+                    digest = hashlib.sha256(image_bytes).hexdigest()
+                    uploaded_name = find_uploaded_image(digest)
                     if uploaded_name:
-                        # Update the workflow to use the uploaded filename
-                        processed_workflow[node_id]['inputs']['image'] = uploaded_name
-                        # Remove the upload field as it's no longer needed
-                        if 'upload' in processed_workflow[node_id]['inputs']:
-                            del processed_workflow[node_id]['inputs']['upload']
+                        logger.info(f"Image for node {node_id} already uploaded as {uploaded_name}")
                     else:
-                        logger.error(f"Failed to upload image for node {node_id}")
+                        uploaded_name = upload_image(image_bytes, f"ref_{digest}.png")
+                        if uploaded_name:
+                            save_upload_index(digest, uploaded_name)
+                else:
+                    continue
+                
+                if uploaded_name:
+                    # Update the workflow to use the uploaded filename
+                    processed_workflow[node_id]['inputs']['image'] = uploaded_name
+                    # Remove the upload field as it's no longer needed
+                    if 'upload' in processed_workflow[node_id]['inputs']:
+                        del processed_workflow[node_id]['inputs']['upload']
+                else:
+                    logger.error(f"Failed to upload image for node {node_id}")
     
     return processed_workflow
 
-def queue_prompt(prompt: Dict[str, Any]) -> Optional[str]:
+def queue_prompt(prompt: Dict[str, Any], client_id: str = CLIENT_ID) -> Optional[str]:
     """Submit a prompt to ComfyUI and return the prompt ID"""
     try:
-        response = requests.post(
-            f"{COMFYUI_URL}/prompt",
-            json={"prompt": prompt}
-        )
+        # Not retried, a retry after a lost response would queue the prompt twice
+        response = comfy.post("prompt", "/prompt", json={"prompt": prompt, "client_id": client_id}, retries=0)
         
         if response.status_code == 200:
             data = response.json()
@@ -296,10 +432,26 @@ def queue_prompt(prompt: Dict[str, Any]) -> Optional[str]:
         logger.error(f"Error queuing prompt: {str(e)}")
         return None
 
+def cancel_prompts(prompt_ids: List[str]):
+    """Delete our prompts from ComfyUI's queue and interrupt the one that is running, if any"""
+    try:
+        queue = comfy.get("queue", "/queue").json()
+        running = {entry[1] for entry in queue.get("queue_running", [])}
+        queued = [prompt_id for prompt_id in prompt_ids if prompt_id not in running]
+        if queued:
+            comfy.post("queue", "/queue", json={"delete": queued}, retries=0)
+        for prompt_id in prompt_ids:
+            if prompt_id in running:
+                # Newer ComfyUI only interrupts the given prompt; older ones interrupt whatever runs, i.e. ours
+                comfy.post("interrupt", "/interrupt", json={"prompt_id": prompt_id}, retries=0)
+        logger.info(f"Cancelled {len(queued)} queued and {len(prompt_ids) - len(queued)} running prompt(s)")
+    except Exception as e:
+        logger.warning(f"Could not cancel prompts {prompt_ids}: {e}")
+
 def get_history(prompt_id: str) -> Optional[Dict[str, Any]]:
     """Get the history for a specific prompt"""
     try:
-        response = requests.get(f"{COMFYUI_URL}/history/{prompt_id}")
+        response = comfy.get("history", f"/history/{prompt_id}")
         if response.status_code == 200:
             return response.json()
         return None
@@ -307,11 +459,166 @@ def get_history(prompt_id: str) -> Optional[Dict[str, Any]]:
         logger.error(f"Error getting history: {str(e)}")
         return None
 
+def connect_websocket(client_id: str = CLIENT_ID) -> Optional[Any]:
+    """Open a websocket to ComfyUI for execution events, or None if unavailable"""
+    try:
+        return comfy.connect_websocket(client_id, WS_RECV_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Could not connect to ComfyUI websocket, will poll history: {e}")
+        return None
+
+class ExecutionTimer:
+    """Accumulates per-node execution time for prompts from ComfyUI websocket events"""
+    
+    def __init__(self):
+        self.node_times: Dict[str, Dict[str, float]] = {}
+        self.running: Dict[str, Tuple[str, float]] = {}
+    
+    def node_started(self, prompt_id: str, node: Optional[str]):
+        """Close the timing of the prompt's previous node and start timing the next one (None when done)"""
+        now = time.time()
+        previous = self.running.pop(prompt_id, None)
+        if previous:
+            node_id, started = previous
+            times = self.node_times.setdefault(prompt_id, {})
+            times[node_id] = times.get(node_id, 0.0) + now - started
+        if node is not None:
+            self.running[prompt_id] = (node, now)
+    
+    def summarize(self, prompt_id: str, workflow: Dict[str, Any]) -> Optional[Dict[str, float]]:
+        """Split a prompt's execution time into model loading, sampling and everything else"""
+        times = self.node_times.get(prompt_id)
+        if not times:
+            return None
+        summary = {"model_load": 0.0, "sampling": 0.0, "other": 0.0}
+        for node_id, seconds in times.items():
+            class_type = workflow.get(node_id, {}).get("class_type")
+            if class_type in MODEL_LOADER_NODES:
+                summary["model_load"] += seconds
+            elif class_type in SAMPLER_NODES:
+                summary["sampling"] += seconds
+            else:
+                summary["other"] += seconds
+        summary["total"] = sum(summary.values())
+        return {phase: round(seconds, 3) for phase, seconds in summary.items()}
+
+def wait_for_websocket(ws, pending: set, deadline: float, timer: Optional[ExecutionTimer] = None,
+                       stopped: Optional[threading.Event] = None) -> Optional[str]:
+    """
+    Block on ComfyUI execution events until one of our pending prompts finishes.
+    
+    Returns the finished prompt ID, or None if the socket dropped, the deadline
+    passed (the caller should fall back to polling) or the job was stopped.
+    """
+    while time.time() < deadline:
+        if stopped is not None and stopped.is_set():
+            return None
+        try:
+            message = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            continue
+        except Exception as e:
+            logger.warning(f"ComfyUI websocket dropped: {e}")
+            return None
+        
+        # Binary frames are previews, we only care about JSON status messages
+        if not isinstance(message, str):
+            continue
+        try:
+            event = json.loads(message)
+        except ValueError:
+            continue
+        
+        data = event.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if prompt_id not in pending:
+            continue
+        
+        event_type = event.get("type")
+        if event_type == "executing" and timer is not None:
+            timer.node_started(prompt_id, data.get("node"))
+        
+        if event_type == "executed":
+            logger.info(f"Node {data.get('node')} executed for prompt {prompt_id}")
+        elif event_type == "execution_error":
+            logger.error(f"Execution error in node {data.get('node_id')}: {data.get('exception_message')}")
+            return prompt_id
+        elif event_type == "executing" and data.get("node") is None:
+            # ComfyUI sends node=None once the prompt is finished and stored in history
+            return prompt_id
+    return None
+
+def poll_history(prompt_id: str, deadline: float) -> Optional[Dict[str, Any]]:
+    """Poll /history with exponential backoff until the prompt appears or the deadline passes"""
+    delay = POLL_INITIAL_DELAY
+    while True:
+        history = get_history(prompt_id)
+        if history and prompt_id in history:
+            return history[prompt_id]
+        if time.time() + delay > deadline:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+def wait_for_completion(prompt_ids: List[str], ws=None, timeout: float = GENERATION_TIMEOUT,
+                        timer: Optional[ExecutionTimer] = None,
+                        stopped: Optional[threading.Event] = None) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+    """
+    Wait for queued prompts to finish, yielding (prompt_id, history entry) in completion order.
+    
+    Uses the websocket event stream when available so each prompt is reported as
+    soon as ComfyUI finishes it, and falls back to history polling otherwise.
+    The timeout restarts whenever a prompt completes so long batches are not cut
+    off; prompts still pending at the deadline are yielded with None. Once
+    stopped is set, it returns without yielding the prompts still pending.
+    """
+    stopped = stopped or threading.Event()
+    start_time = time.time()
+    deadline = start_time + timeout
+    pending = list(prompt_ids)
+    
+    if ws is not None:
+        while pending:
+            prompt_id = wait_for_websocket(ws, set(pending), deadline, timer, stopped)
+            if stopped.is_set():
+                return
+            if prompt_id is None:
+                logger.info("Falling back to history polling")
+                break
+            prompt_data = poll_history(prompt_id, deadline)
+            logger.info(f"Prompt {prompt_id} finished after {time.time() - start_time:.1f} seconds")
+            pending.remove(prompt_id)
+            deadline = time.time() + timeout
+            yield prompt_id, prompt_data
+    
+    delay = POLL_INITIAL_DELAY
+    while pending:
+        # ComfyUI runs its queue in order, so stop at the first prompt that isn't done yet
+        for prompt_id in list(pending):
+            history = get_history(prompt_id)
+            if not history or prompt_id not in history:
+                break
+            logger.info(f"Prompt {prompt_id} completed after {time.time() - start_time:.1f} seconds")
+            pending.remove(prompt_id)
+            deadline = time.time() + timeout
+            delay = POLL_INITIAL_DELAY
+            yield prompt_id, history[prompt_id]
+        
+        if not pending or time.time() + delay > deadline:
+            break
+        if stopped.wait(delay):
+            return
+        delay = min(delay * 2, POLL_MAX_DELAY)
+    
+    for prompt_id in pending:
+        yield prompt_id, None
+
 def get_image(filename: str, subfolder: str = "", folder_type: str = "output") -> Optional[bytes]:
     """Get an image from ComfyUI"""
     try:
-        response = requests.get(
-            f"{COMFYUI_URL}/view",
+        response = comfy.get(
+            "view",
+            "/view",
             params={
                 "filename": filename,
                 "subfolder": subfolder,
@@ -325,16 +632,382 @@ def get_image(filename: str, subfolder: str = "", folder_type: str = "output") -
         logger.error(f"Error getting image: {str(e)}")
         return None
 
-def handler(job):
+def get_models_base() -> str:
+    """Return the models directory, on the Network Volume if available"""
+    if os.path.exists("/runpod-volume"):
+        return "/runpod-volume/models"
+    return f"{COMFYUI_DIR}/models"
+
+def get_critical_models(weight_dtype: str) -> List[str]:
+    """Return the model paths a workflow at the given precision needs"""
+    # Map precision to model filenames
+    is_fp16 = get_precision(weight_dtype) == "fp16"
+    flux_model_name = "flux1-kontext-dev-fp16.safetensors" if is_fp16 else "flux1-kontext-dev-fp8.safetensors"
+    t5_model_name = "t5xxl_fp16.safetensors" if is_fp16 else "t5xxl_fp8_e4m3fn.safetensors"
+    
+    models_base = get_models_base()
+    return [
+        f"{models_base}/unet/{flux_model_name}",
+        f"{models_base}/clip/{t5_model_name}",
+        f"{models_base}/clip/clip_l.safetensors",
+        f"{models_base}/vae/ae.safetensors"
+    ]
+
+def refresh_model_manifest(paths: List[str], hash_files: bool = False):
+    """Re-check the given model files and update the in-memory and on-disk manifest"""
+    manifest_path = os.path.join(get_models_base(), MODEL_MANIFEST_FILE)
+    with model_manifest_lock:
+        cached = {**load_manifest(manifest_path), **model_manifest}
+    
+    entries = verify_model_files(paths, cached, hash_files)
+    
+    with model_manifest_lock:
+        for path in paths:
+            if path in entries:
+                model_manifest[path] = entries[path]
+            else:
+                model_manifest.pop(path, None)
+        try:
+            os.makedirs(get_models_base(), exist_ok=True)
+            save_manifest(manifest_path, model_manifest)
+        except OSError as e:
+            logger.warning(f"Could not save model manifest: {e}")
+
+def verify_models_on_startup(hf_token: Optional[str] = None):
+    """
+    Build the model manifest while ComfyUI boots.
+    
+    Presence is published as soon as the files have been stat'ed; missing
+    models are then downloaded (if we have a token) and any file not yet in
+    the cached manifest is hashed.
+    """
+    paths = sorted(set(get_critical_models("fp16") + get_critical_models("fp8")))
+    
+    phase_start = time.time()
+    try:
+        refresh_model_manifest(paths)
+    finally:
+        # Never leave jobs waiting on a manifest that isn't coming
+        model_manifest_ready.set()
+    startup_timings["model_manifest"] = time.time() - phase_start
+    logger.info(f"Model manifest ready: {len(model_manifest)} of {len(paths)} known models present")
+    
+    if hf_token:
+        phase_start = time.time()
+        ensure_models(hf_token)
+        startup_timings["model_download"] = time.time() - phase_start
+    
+    phase_start = time.time()
+    refresh_model_manifest(paths, hash_files=True)
+    startup_timings["model_hashing"] = time.time() - phase_start
+    logger.info(f"Model verification finished in {startup_timings['model_hashing']:.1f}s")
+
+def get_weight_dtype(workflow: Dict[str, Any]) -> str:
+    """Return the FLUX precision requested by the workflow's UNETLoader node"""
+    for node in workflow.values():
+        if node.get("class_type") == "UNETLoader":
+            return node.get("inputs", {}).get("weight_dtype", "fp16")
+    return "fp16"  # default
+
+def get_precision(weight_dtype: str) -> str:
+    """Map a UNETLoader weight_dtype to the model set it loads ('fp16' or 'fp8')"""
+    # 'default' weight_dtype means use the model's native precision (FP16 for the FP16 model)
+    return "fp16" if weight_dtype in ["fp16", "default"] else "fp8"
+
+def uses_precision_models(workflow: Dict[str, Any], precision: str) -> bool:
+    """Whether every FLUX and T5 loader in the workflow loads the given precision's model files"""
+    for node in workflow.values():
+        inputs = node.get("inputs", {})
+        if node.get("class_type") == "UNETLoader" and inputs.get("unet_name") != FLUX_MODELS[precision]:
+            return False
+        if node.get("class_type") == "DualCLIPLoader":
+            for key in ("clip_name1", "clip_name2"):
+                if "t5xxl" in str(inputs.get(key, "")).lower() and inputs[key] != T5_MODELS[precision]:
+                    return False
+    return True
+
+def set_workflow_precision(workflow: Dict[str, Any], precision: str) -> Optional[str]:
+    """
+    Point the workflow's FLUX Kontext and T5 loaders (whatever files they
+    name) at the model files for the given precision.
+    
+    Returns the unet_name of a UNETLoader that isn't FLUX Kontext, and so
+    can't be rewritten, leaving the workflow untouched; None otherwise.
+    """
+    for node in workflow.values():
+        unet_name = node.get("inputs", {}).get("unet_name", "")
+        if node.get("class_type") == "UNETLoader" and "kontext" not in str(unet_name).lower():
+            return unet_name
+    
+    for node in workflow.values():
+        inputs = node.get("inputs", {})
+        if node.get("class_type") == "UNETLoader":
+            inputs["unet_name"] = FLUX_MODELS[precision]
+            inputs["weight_dtype"] = "default" if precision == "fp16" else "fp8_e4m3fn"
+        elif node.get("class_type") == "DualCLIPLoader":
+            for key in ("clip_name1", "clip_name2"):
+                if "t5xxl" in str(inputs.get(key, "")).lower():
+                    inputs[key] = T5_MODELS[precision]
+    return None
+
+def apply_precision_policy(workflow: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Check a workflow against the models resident on this worker.
+    
+    Returns the (possibly rewritten) workflow and an error message if the
+    policy rejects it. A workflow that names other FLUX/T5 files than the
+    resident precision's would load them next to the resident ones, so it
+    counts as a swap even at the same precision.
+    """
+    if PRECISION_POLICY == "allow":
+        return workflow, None
+    precision = get_precision(get_weight_dtype(workflow))
+    target = resident_precision or precision
+    if uses_precision_models(workflow, target):
+        return workflow, None
+    
+    if PRECISION_POLICY == "reject":
+        if resident_precision is None:
+            # Nothing resident yet; this job decides
+            return workflow, None
+        return workflow, (f"Worker has {resident_precision} models resident; workflows loading other FLUX/T5 "
+                          f"models ({precision}) are rejected by the precision policy")
+    
+    logger.info(f"Rewriting {precision} workflow to the {target} models")
+    unet_name = set_workflow_precision(workflow, target)
+    if unet_name is not None and resident_precision is not None:
+        return workflow, (f"Worker has {resident_precision} models resident; {unet_name} is not a FLUX Kontext "
+                          f"model, so the precision policy cannot rewrite the workflow")
+    return workflow, None
+
+def check_workflow_models(weight_dtype: str, hf_token: Optional[str] = None) -> Optional[str]:
+    """
+    Make sure the critical models for the given precision are present,
+    downloading them if needed.
+    
+    Returns an error message if the models could not be obtained.
+    """
+    critical_models = get_critical_models(weight_dtype)
+    
+    # Presence comes from the startup manifest instead of per-job filesystem checks
+    model_manifest_ready.wait()
+    missing_models = [m for m in critical_models if m not in model_manifest]
+    
+    if missing_models:
+        logger.info(f"Missing {len(missing_models)} critical models: {[os.path.basename(m) for m in missing_models]}")
+        
+        if hf_token:
+            logger.info("Using HF token from job input")
+            # Set it in environment
+            os.environ['HF_TOKEN'] = hf_token
+        
+        logger.info(f"Downloading missing models for {weight_dtype} precision...")
+        ensure_models(hf_token, weight_dtype)
+        
+        # Downloads only land at their final path once complete and verified,
+        # so anything still missing failed to download
+        refresh_model_manifest(critical_models)
+        final_missing = [m for m in critical_models if m not in model_manifest]
+        if final_missing:
+            return f"Failed to download models: {[os.path.basename(m) for m in final_missing]}"
+    
+    return None
+
+def get_output_path(image_info: Dict[str, Any]) -> Optional[str]:
+    """Return the on-disk path of a ComfyUI result image, if we can see it"""
+    folders = {
+        "output": f"{COMFYUI_DIR}/output",
+        "temp": f"{COMFYUI_DIR}/temp",
+        "input": get_input_dir()
+    }
+    folder = folders.get(image_info.get("type", "output"))
+    if not folder:
+        return None
+    path = os.path.join(folder, image_info.get("subfolder", ""), image_info["filename"])
+    return path if os.path.isfile(path) else None
+
+def store_output_image(image_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Copy a result image from ComfyUI's output dir to the object store"""
+    image_path = get_output_path(image_info)
+    if image_path:
+        return store_image(output_store, image_path, image_info["filename"])
+    
+    # Not on our filesystem, go through /view and a temp file instead
+    image_data = get_image(
+        image_info["filename"],
+        image_info.get("subfolder", ""),
+        image_info.get("type", "output")
+    )
+    if not image_data:
+        return None
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(image_info["filename"])[1]) as f:
+        f.write(image_data)
+        f.flush()
+        return store_image(output_store, f.name, image_info["filename"])
+
+def collect_images(prompt_id: str, prompt_data: Dict[str, Any], output_mode: str = "base64") -> Dict[str, Any]:
+    """
+    Build the handler result for a finished prompt from its history entry.
+    
+    With output_mode "store" images are put in the object store and returned
+    as URLs with their sha256; "base64" inlines them in the response.
+    """
+    # Check if there was an error
+    if "status" in prompt_data:
+        status = prompt_data.get("status")
+        if status and "status_str" in status:
+            logger.info(f"Prompt status: {status['status_str']}")
+            if status['status_str'] == "error":
+                error_msg = status.get("messages", ["Unknown error"])
+                logger.error(f"Workflow error: {error_msg}")
+                return {"error": f"Workflow failed: {error_msg}"}
+    
+    outputs = prompt_data.get("outputs", {})
+    
+    # Debug: log the entire history structure
+    logger.info(f"Prompt data keys: {list(prompt_data.keys())}")
+    logger.info(f"Output nodes: {list(outputs.keys())}")
+    
+    # If no outputs, check for execution info
+    if not outputs:
+        logger.warning("No outputs found, checking execution data...")
+        if "execution" in prompt_data:
+            logger.info(f"Execution data: {prompt_data['execution']}")
+        
+        # Try to get the raw history
+        try:
+            raw_response = comfy.get("history_all", "/history", params={"max_items": 64})
+            if raw_response.status_code == 200:
+                all_history = raw_response.json()
+                if prompt_id in all_history:
+                    logger.info(f"Raw history data: {json.dumps(all_history[prompt_id], indent=2)}")
+        except Exception as e:
+            logger.error(f"Could not get raw history: {e}")
+    
+    for node_id, node_output in outputs.items():
+        logger.info(f"Node {node_id} output keys: {list(node_output.keys())}")
+    
+    # Look for saved images
+    images = []
+    for node_id, node_output in outputs.items():
+        if "images" in node_output:
+            for image_info in node_output["images"]:
+                if output_mode == "store":
+                    stored = store_output_image(image_info)
+                    if stored:
+                        images.append(stored)
+                    continue
+                
+                # Get image data
+                image_data = get_image(
+                    image_info["filename"],
+                    image_info.get("subfolder", ""),
+                    image_info.get("type", "output")
+                )
+                
+                if image_data:
+                    # Convert to base64
+                    image_base64 = base64.b64encode(image_data).decode('utf-8')
+                    images.append({
+                        "type": "base64",
+                        "data": image_base64,
+                        "filename": image_info["filename"]
+                    })
+    
+    if images:
+        # Return in the format expected by the AudioBookVisualizer
+        return {
+            "images": images,
+            "prompt_id": prompt_id
+        }
+    else:
+        return {"error": "No images generated"}
+
+def get_result_cache_dir() -> str:
+    """Cache results on the Network Volume so every worker shares them"""
+    if os.path.exists("/runpod-volume"):
+        return os.environ.get("RESULT_CACHE_DIR", "/runpod-volume/result_cache")
+    return os.environ.get("RESULT_CACHE_DIR", f"{COMFYUI_DIR}/result_cache")
+
+def cache_result(cache_key: str, prompt_data: Dict[str, Any]):
+    """Save a finished prompt's images in the result cache"""
+    images = []
+    for node_output in prompt_data.get("outputs", {}).values():
+        for image_info in node_output.get("images", []):
+            if image_info.get("type", "output") != "output":
+                continue
+            source = get_output_path(image_info) or get_image(
+                image_info["filename"],
+                image_info.get("subfolder", ""),
+                image_info.get("type", "output")
+            )
+            if not source:
+                return
+            images.append((image_info["filename"], source))
+    if images:
+        result_cache.put(cache_key, images)
+
+def cached_result(files: List[Tuple[str, str]], output_mode: str = "base64") -> Optional[Dict[str, Any]]:
+    """
+    Build the handler result for a cache hit, in the same shape as collect_images.
+    
+    Returns None when the entry's files are gone (another worker on the volume
+    evicted it after the lookup), so the caller renders the workflow instead.
+    """
+    images = []
+    try:
+        for filename, path in files:
+            if output_mode == "store":
+                images.append(store_image(output_store, path, filename))
+                continue
+            with open(path, "rb") as f:
+                images.append({
+                    "type": "base64",
+                    "data": base64.b64encode(f.read()).decode('utf-8'),
+                    "filename": filename
+                })
+    except OSError as e:
+        logger.warning(f"Cached result could not be read, rendering instead: {e}")
+        return None
+    return {"images": images, "prompt_id": None, "cached": True}
+
+def add_job_stats(result: Dict[str, Any], job_input: Dict[str, Any]) -> Dict[str, Any]:
+    """Attach startup timings (first result only) and, on request, ComfyUI HTTP and scheduler stats"""
+    global startup_reported
+
+    if not startup_reported:
+        result["startup_timings"] = dict(startup_timings)
+        startup_reported = True
+    if job_input.get("include_http_stats"):
+        result["comfyui_http"] = comfy.stats()
+    if job_input.get("include_scheduler_stats"):
+        result["scheduler"] = scheduler.stats()
+    return result
+
+def handler(job, stopped: Optional[threading.Event] = None):
     """
     RunPod serverless handler function
     
+    Accepts either a single `workflow` or a batch of `workflows`. Prompts are
+    queued in ComfyUI as the scheduler hands out slots (interactive jobs
+    first), so a batch keeps the GPU going from one scene to the next without
+    holding up other jobs, and each scene's result is streamed back as soon as
+    it finishes (in completion order, tagged with its `index` in the input list).
+    
+    Once stopped is set (the job was cancelled), no more prompts are queued,
+    the job's prompts are removed from ComfyUI's queue or interrupted, and its
+    scheduler slots are given back.
+    
     Args:
         job: Contains the input data for the job
+        stopped: Set to cancel the job
     
-    Returns:
-        Dictionary containing the job results
+    Yields:
+        Dictionaries containing the job results, one per workflow
     """
+    global resident_precision
+    
+    stopped = stopped or threading.Event()
     try:
         job_input = job["input"]
         logger.info(f"Received job with input keys: {list(job_input.keys())}")
@@ -342,267 +1015,306 @@ def handler(job):
         # Extract HF token if provided
         hf_token = job_input.get('hf_token', None)
         
-        # Parse workflow first to determine which models we need
-        if "workflow" not in job_input:
-            return {"error": "No workflow provided"}
+        # Parse workflows first to determine which models we need
+        if "workflows" in job_input:
+            is_batch = True
+            workflows = job_input["workflows"]
+            if isinstance(workflows, str):
+                workflows = json.loads(workflows)
+            if not workflows:
+                yield {"error": "Empty workflows list"}
+                return
+        elif "workflow" in job_input:
+            is_batch = False
+            workflows = [job_input["workflow"]]
+        else:
+            yield {"error": "No workflow provided"}
+            return
         
-        workflow = job_input["workflow"]
-        if isinstance(workflow, str):
-            workflow = json.loads(workflow)
+        workflows = [json.loads(w) if isinstance(w, str) else w for w in workflows]
         
-        # Check workflow to determine which FLUX model precision is needed
-        weight_dtype = "fp16"  # default
-        for node in workflow.values():
-            if node.get("class_type") == "UNETLoader":
-                weight_dtype = node.get("inputs", {}).get("weight_dtype", "fp16")
-                logger.info(f"Workflow requests {weight_dtype} precision")
-                break
+        # Single images are someone waiting on a regenerate; batches are storyboard runs
+        priority = job_input.get("priority") or ("bulk" if len(workflows) > 1 else "interactive")
+        if priority not in PRIORITIES:
+            yield {"error": f"Unknown priority: {priority} (expected one of {', '.join(PRIORITIES)})"}
+            return
         
-        # Map precision to model filenames
-        # 'default' weight_dtype means use the model's native precision (FP16 for the FP16 model)
-        is_fp16 = weight_dtype in ["fp16", "default"]
-        flux_model_name = "flux1-kontext-dev-fp16.safetensors" if is_fp16 else "flux1-kontext-dev-fp8.safetensors"
-        t5_model_name = "t5xxl_fp16.safetensors" if is_fp16 else "t5xxl_fp8_e4m3fn.safetensors"
+        # Keep the resident precision loaded where the policy says so
+        for index, workflow in enumerate(workflows):
+            workflows[index], error = apply_precision_policy(workflow)
+            if error:
+                yield {"error": error}
+                return
         
-        # Check if any critical models are missing
-        # Use Network Volume if available
-        if os.path.exists("/runpod-volume"):
-            models_base = "/runpod-volume/models"
-        else:
-            models_base = "/workspace/ComfyUI/models"
-        critical_models = [
-            f"{models_base}/unet/{flux_model_name}",
-            f"{models_base}/clip/{t5_model_name}",
-            f"{models_base}/clip/clip_l.safetensors",
-            f"{models_base}/vae/ae.safetensors"
-        ]
-        
-        missing_models = [m for m in critical_models if not os.path.exists(m)]
-        
-        if missing_models:
-            logger.info(f"Missing {len(missing_models)} critical models: {[os.path.basename(m) for m in missing_models]}")
-            
-            if hf_token:
-                logger.info("Using HF token from job input")
-                # Set it in environment
-                os.environ['HF_TOKEN'] = hf_token
-            
-            logger.info(f"Downloading missing models for {weight_dtype} precision...")
-            ensure_models(hf_token, weight_dtype)
+        for index, workflow in enumerate(workflows):
+            logger.info(f"Workflow {index} has {len(workflow)} nodes")
             
-            # Log model sizes after download attempt
-            for model_path in critical_models:
-                if os.path.exists(model_path):
-                    size_mb = os.path.getsize(model_path) / (1024 * 1024)
-                    logger.info(f"{os.path.basename(model_path)}: {size_mb:.1f} MB")
-                else:
-                    logger.info(f"{os.path.basename(model_path)}: NOT FOUND")
-            
-            # Wait a moment for filesystem to sync
-            time.sleep(2)
+            # Log workflow structure for debugging
+            logger.info("Workflow nodes:")
+            for node_id, node_data in workflow.items():
+                logger.info(f"  Node {node_id}: {node_data.get('class_type', 'Unknown')}")
             
-            # Verify all models were downloaded and check sizes
-            still_missing = []
-            for model_path in critical_models:
-                if not os.path.exists(model_path):
-                    still_missing.append(model_path)
-                else:
-                    size_mb = os.path.getsize(model_path) / (1024 * 1024)
-                    model_name = os.path.basename(model_path)
-                    
-                    # Check for corrupted downloads (files that are too small)
-                    if model_name.startswith("flux1-kontext-dev") and size_mb < 1000:  # Should be much larger
-                        logger.error(f"FLUX model is corrupted! Only {size_mb:.1f} MB")
-                        # Delete the corrupted file so it can be re-downloaded
-                        os.remove(model_path)
-                        still_missing.append(model_path)
-            
-            if still_missing:
-                logger.info(f"Need to download: {[os.path.basename(m) for m in still_missing]}")
-                # Re-run ensure_models to download missing/corrupted files
-                ensure_models(hf_token, weight_dtype)
-                
-                # Check again
-                final_missing = [m for m in still_missing if not os.path.exists(m)]
-                if final_missing:
-                    return {"error": f"Failed to download models: {[os.path.basename(m) for m in final_missing]}"}
-        
-        # Parse workflow from input
-        if "workflow" not in job_input:
-            return {"error": "No workflow provided"}
-        
-        workflow = job_input["workflow"]
-        if isinstance(workflow, str):
-            workflow = json.loads(workflow)
+            # Process any base64 images in LoadImage nodes
+            logger.info("Processing workflow images...")
+            workflows[index] = process_workflow_images(workflow)
         
-        logger.info(f"Workflow has {len(workflow)} nodes")
+        # Listen for execution events before queueing so we can't miss completion.
+        # completion_mode "poll" skips the websocket and polls /history instead.
+        completion_mode = job_input.get("completion_mode", "websocket")
         
-        # Log workflow structure for debugging
-        logger.info("Workflow nodes:")
-        for node_id, node_data in workflow.items():
-            logger.info(f"  Node {node_id}: {node_data.get('class_type', 'Unknown')}")
+        # Results go to the object store when one is configured; base64 is opt-in
+        output_mode = job_input.get("output_mode", "store" if output_store else "base64")
+        if output_mode == "store" and not output_store:
+            logger.warning("No output store configured, returning base64 images")
+            output_mode = "base64"
         
-        # Process any base64 images in LoadImage nodes
-        logger.info("Processing workflow images...")
-        workflow = process_workflow_images(workflow)
+        # Identical workflows (same prompt, seed and reference images) are served
+        # from the result cache; cache "bypass" regenerates and refreshes the entry
+        cache_mode = job_input.get("cache", "use")
+        cache_keys = [workflow_key(workflow) for workflow in workflows] if result_cache else []
+        cached_results = []
+        if cache_keys and cache_mode == "use":
+            for index, cache_key in enumerate(cache_keys):
+                files = result_cache.get(cache_key)
+                result = cached_result(files, output_mode) if files else None
+                if result:
+                    logger.info(f"Workflow {index} served from result cache ({cache_key[:12]})")
+                    cached_results.append((index, result))
+        cached_indexes = {index for index, _ in cached_results}
         
-        # Queue the prompt
-        prompt_id = queue_prompt(workflow)
-        if not prompt_id:
-            return {"error": "Failed to queue prompt"}
-        
-        logger.info(f"Queued prompt with ID: {prompt_id}")
-        
-        # Poll for completion
-        max_attempts = 180  # 15 minutes
-        for attempt in range(max_attempts):
-            history = get_history(prompt_id)
-            
-            if history and prompt_id in history:
-                logger.info(f"Prompt completed after {attempt * 5} seconds")
-                prompt_data = history[prompt_id]
-                
-                # Check if there was an error
-                if "status" in prompt_data:
-                    status = prompt_data.get("status")
-                    if status and "status_str" in status:
-                        logger.info(f"Prompt status: {status['status_str']}")
-                        if status['status_str'] == "error":
-                            error_msg = status.get("messages", ["Unknown error"])
-                            logger.error(f"Workflow error: {error_msg}")
-                            return {"error": f"Workflow failed: {error_msg}"}
+        # Check models once per precision still to be generated
+        checked_dtypes = set()
+        for index, workflow in enumerate(workflows):
+            weight_dtype = get_weight_dtype(workflow)
+            if index in cached_indexes or weight_dtype in checked_dtypes:
+                continue
+            logger.info(f"Workflow requests {weight_dtype} precision")
+            error = check_workflow_models(weight_dtype, hf_token)
+            if error:
+                yield {"error": error}
+                return
+            checked_dtypes.add(weight_dtype)
+
+        # Each job listens on its own client ID; ComfyUI only keeps one socket per ID
+        client_id = str(uuid.uuid4())
+        ws = connect_websocket(client_id) if completion_mode == "websocket" and len(cached_indexes) < len(workflows) else None
+        held_slots = 0
+        in_flight = []
+        try:
+            remaining = [index for index in range(len(workflows)) if index not in cached_indexes]
+            prompt_indexes = {}
+            queue_waits = {}
+            model_swaps = set()
+            timer = ExecutionTimer()
+            while remaining or in_flight:
+                # Queue prompts while the scheduler has slots for us, only waiting
+                # for one when none of our prompts are left in ComfyUI
+                while remaining and not stopped.is_set():
+                    waited = scheduler.acquire(priority, block=not in_flight, cancelled=stopped)
+                    if waited is None:
+                        break
+                    held_slots += 1
+                    index = remaining.pop(0)
+                    workflow = workflows[index]
+                    prompt_id = queue_prompt(workflow, client_id)
+                    if not prompt_id:
+                        scheduler.release()
+                        held_slots -= 1
+                        if not is_batch:
+                            yield {"error": "Failed to queue prompt"}
+                            return
+                        yield {"index": index, "error": "Failed to queue prompt"}
+                        continue
+                    
+                    logger.info(f"Queued prompt with ID: {prompt_id} ({priority}, waited {waited:.2f}s for a slot)")
+                    prompt_indexes[prompt_id] = index
+                    queue_waits[prompt_id] = waited
+                    in_flight.append(prompt_id)
+                    
+                    precision = get_precision(get_weight_dtype(workflow))
+                    if resident_precision is not None and precision != resident_precision:
+                        model_swaps.add(prompt_id)
+                    resident_precision = precision
                 
-                outputs = prompt_data.get("outputs", {})
+                if stopped.is_set():
+                    return
                 
-                # Debug: log the entire history structure
-                logger.info(f"Prompt data keys: {list(prompt_data.keys())}")
-                logger.info(f"Output nodes: {list(outputs.keys())}")
+                for index, result in cached_results:
+                    if is_batch:
+                        result = {"index": index, **result}
+                    yield add_job_stats(result, job_input)
+                cached_results = []
+                if not in_flight:
+                    continue
                 
-                # If no outputs, check for execution info
-                if not outputs:
-                    logger.warning("No outputs found, checking execution data...")
-                    if "execution" in prompt_data:
-                        logger.info(f"Execution data: {prompt_data['execution']}")
-                    
-                    # Try to get the raw history
-                    try:
-                        raw_response = requests.get(f"{COMFYUI_URL}/history")
-                        if raw_response.status_code == 200:
-                            all_history = raw_response.json()
-                            if prompt_id in all_history:
-                                logger.info(f"Raw history data: {json.dumps(all_history[prompt_id], indent=2)}")
-                    except Exception as e:
-                        logger.error(f"Could not get raw history: {e}")
+                finished = next(wait_for_completion(list(in_flight), ws, timer=timer, stopped=stopped), None)
+                if finished is None:
+                    return
+                prompt_id, prompt_data = finished
+                in_flight.remove(prompt_id)
+                scheduler.release()
+                held_slots -= 1
                 
-                for node_id, node_output in outputs.items():
-                    logger.info(f"Node {node_id} output keys: {list(node_output.keys())}")
+                if prompt_data is None:
+                    result = {"error": f"Generation timeout after {GENERATION_TIMEOUT // 60} minutes"}
+                else:
+                    result = collect_images(prompt_id, prompt_data, output_mode)
+                    if cache_keys and "error" not in result and cache_mode != "off":
+                        cache_result(cache_keys[prompt_indexes[prompt_id]], prompt_data)
                 
-                # Look for saved images
-                images = []
-                for node_id, node_output in outputs.items():
-                    if "images" in node_output:
-                        for image_info in node_output["images"]:
-                            # Get image data
-                            image_data = get_image(
-                                image_info["filename"],
-                                image_info.get("subfolder", ""),
-                                image_info.get("type", "output")
-                            )
-                            
-                            if image_data:
-                                # Convert to base64
-                                image_base64 = base64.b64encode(image_data).decode('utf-8')
-                                images.append({
-                                    "type": "base64",
-                                    "data": image_base64,
-                                    "filename": image_info["filename"]
-                                })
+                # Model load vs sampling time (needs websocket events)
+                timings = timer.summarize(prompt_id, workflows[prompt_indexes[prompt_id]])
+                if timings:
+                    result["timings"] = timings
+                result["model_swap"] = prompt_id in model_swaps
+                result["queue_wait"] = round(queue_waits[prompt_id], 3)
                 
-                if images:
-                    # Return in the format expected by the AudioBookVisualizer
-                    return {
-                        "images": images,
-                        "prompt_id": prompt_id
-                    }
-                else:
-                    return {"error": "No images generated"}
+                if is_batch:
+                    result = {"index": prompt_indexes[prompt_id], "prompt_id": prompt_id, **result}
+                yield add_job_stats(result, job_input)
             
-            # Check for errors in queue
-            try:
-                queue_response = requests.get(f"{COMFYUI_URL}/queue")
-                if queue_response.status_code == 200:
-                    queue_data = queue_response.json()
-                    # Check if our prompt failed
-                    for item in queue_data.get("queue_running", []):
-                        if item[1] == prompt_id:
-                            logger.info(f"Prompt still running... ({attempt * 5}s)")
-                            break
-            except:
-                pass
-            
-            time.sleep(5)  # Wait 5 seconds before next check
-        
-        return {"error": "Generation timeout after 15 minutes"}
+            # Every workflow was served from the cache
+            for index, result in cached_results:
+                if is_batch:
+                    result = {"index": index, **result}
+                yield add_job_stats(result, job_input)
+        finally:
+            if in_flight and stopped.is_set():
+                cancel_prompts(in_flight)
+            for _ in range(held_slots):
+                scheduler.release()
+            if ws is not None:
+                ws.close()
+            logger.info(f"ComfyUI HTTP latency: {comfy.summary()}")
+            logger.info(f"Scheduler queue wait: {scheduler.summary()}")
         
     except Exception as e:
         logger.error(f"Handler error: {str(e)}", exc_info=True)
-        return {"error": str(e)}
+        yield {"error": str(e)}
 
-# Initialize on container start
-logger.info("Initializing ComfyUI for RunPod...")
+async def async_handler(job):
+    """
+    Run handler() in a worker thread so this worker can take several jobs at
+    once; the scheduler decides whose prompts go to ComfyUI first
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    
+    def run():
+        # handler() watches stopped while it waits for slots and for ComfyUI
+        results = handler(job, stopped)
+        try:
+            for result in results:
+                loop.call_soon_threadsafe(queue.put_nowait, result)
+                if stopped.is_set():
+                    break
+        finally:
+            # Closing runs the handler's cleanup, which cancels a stopped job's
+            # prompts in ComfyUI and gives back its scheduler slots
+            results.close()
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+    
+    loop.run_in_executor(None, run)
+    try:
+        while True:
+            result = await queue.get()
+            if result is None:
+                return
+            yield result
+    finally:
+        stopped.set()
 
-# Log ComfyUI version
-try:
-    with open('/workspace/comfyui_version.txt', 'r') as f:
-        logger.info(f"ComfyUI version: {f.read().strip()}")
-except:
-    logger.info("ComfyUI version file not found")
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Number of jobs RunPod may give this worker at once"""
+    return MAX_CONCURRENT_JOBS
 
-# Check disk space
-try:
-    import shutil
-    disk_usage = shutil.disk_usage("/workspace")
-    free_gb = disk_usage.free / (1024**3)
-    total_gb = disk_usage.total / (1024**3)
-    logger.info(f"Disk space: {free_gb:.1f}GB free of {total_gb:.1f}GB total")
+def check_required_nodes():
+    """Check ComfyUI has the nodes our workflows need, without fetching the full /object_info"""
+    for node_class in REQUIRED_NODES:
+        try:
+            response = comfy.get("object_info", f"/object_info/{node_class}")
+            available = response.status_code == 200 and node_class in response.json()
+            logger.info(f"{node_class} available: {available}")
+        except Exception as e:
+            logger.warning(f"Could not get node info for {node_class}: {e}")
+
+def initialize():
+    """Bring the worker up, verifying models in the background while ComfyUI boots"""
+    global output_store, result_cache
     
-    # Check for Network Volume
-    if os.path.exists("/runpod-volume"):
-        vol_usage = shutil.disk_usage("/runpod-volume")
-        vol_free_gb = vol_usage.free / (1024**3)
-        vol_total_gb = vol_usage.total / (1024**3)
-        logger.info(f"Network Volume: {vol_free_gb:.1f}GB free of {vol_total_gb:.1f}GB total")
-except Exception as e:
-    logger.warning(f"Could not check disk space: {e}")
-
-# Try to download models on startup if HF token is in environment
-logger.info("Checking for required models...")
-hf_token_env = os.environ.get('HF_TOKEN', os.environ.get('HUGGING_FACE_TOKEN', None))
-if hf_token_env:
-    logger.info("Found HF token in environment, downloading models...")
-    ensure_models(hf_token_env)
-else:
-    logger.info("No HF token in environment, will download on first job")
-
-# Start ComfyUI
-if not start_comfyui():
-    logger.error("Failed to start ComfyUI, but continuing anyway...")
-
-# Log available node types
-try:
-    response = requests.get(f"{COMFYUI_URL}/object_info")
-    if response.status_code == 200:
-        node_types = list(response.json().keys())
-        flux_nodes = [n for n in node_types if 'flux' in n.lower() or 'FLUX' in n]
-        logger.info(f"Available FLUX-related nodes: {flux_nodes}")
-        # Check for specific nodes we need
-        reference_nodes = [n for n in node_types if 'reference' in n.lower() or 'Reference' in n]
-        logger.info(f"Available Reference nodes: {reference_nodes}")
-        logger.info(f"ReferenceLatent available: {'ReferenceLatent' in node_types}")
-        logger.info(f"Total nodes available: {len(node_types)}")
-except Exception as e:
-    logger.warning(f"Could not get node info: {e}")
-
-# RunPod serverless handler
-logger.info("Starting RunPod handler...")
-runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    startup_start = time.time()
+    logger.info("Initializing ComfyUI for RunPod...")
+    
+    # Log ComfyUI version
+    try:
+        with open('/workspace/comfyui_version.txt', 'r') as f:
+            logger.info(f"ComfyUI version: {f.read().strip()}")
+    except:
+        logger.info("ComfyUI version file not found")
+    
+    # Check disk space
+    try:
+        disk_usage = shutil.disk_usage("/workspace")
+        free_gb = disk_usage.free / (1024**3)
+        total_gb = disk_usage.total / (1024**3)
+        logger.info(f"Disk space: {free_gb:.1f}GB free of {total_gb:.1f}GB total")
+        
+        # Check for Network Volume
+        if os.path.exists("/runpod-volume"):
+            vol_usage = shutil.disk_usage("/runpod-volume")
+            vol_free_gb = vol_usage.free / (1024**3)
+            vol_total_gb = vol_usage.total / (1024**3)
+            logger.info(f"Network Volume: {vol_free_gb:.1f}GB free of {vol_total_gb:.1f}GB total")
+    except Exception as e:
+        logger.warning(f"Could not check disk space: {e}")
+    startup_timings["preflight"] = time.time() - startup_start
+    
+    # Set up the object store for result images
+    try:
+        output_store = get_output_store()
+        if output_store:
+            logger.info(f"Storing result images in {type(output_store).__name__}")
+    except Exception as e:
+        logger.error(f"Could not set up output store, falling back to base64: {e}")
+    
+    if RESULT_CACHE_MAX_GB > 0:
+        result_cache = ResultCache(get_result_cache_dir(), int(RESULT_CACHE_MAX_GB * 1024**3))
+        logger.info(f"Caching results in {result_cache.directory} (up to {RESULT_CACHE_MAX_GB:g}GB)")
+    
+    # Verify (and, with an HF token in the environment, download) models in parallel with ComfyUI boot
+    logger.info("Checking for required models...")
+    hf_token_env = os.environ.get('HF_TOKEN', os.environ.get('HUGGING_FACE_TOKEN', None))
+    if hf_token_env:
+        logger.info("Found HF token in environment, missing models will be downloaded in the background")
+    else:
+        logger.info("No HF token in environment, will download on first job")
+    threading.Thread(target=verify_models_on_startup, args=(hf_token_env,), name="model-verification", daemon=True).start()
+    
+    # Start ComfyUI
+    phase_start = time.time()
+    if not start_comfyui():
+        logger.error("Failed to start ComfyUI, but continuing anyway...")
+    startup_timings["comfyui_boot"] = time.time() - phase_start
+    
+    phase_start = time.time()
+    check_required_nodes()
+    startup_timings["node_check"] = time.time() - phase_start
+    
+    startup_timings["ready"] = time.time() - startup_start
+    logger.info("Startup timings: " + ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in startup_timings.items()))
+
+if __name__ == "__main__":
+    initialize()
+    
+    # RunPod serverless handler
+    logger.info("Starting RunPod handler...")
+    # The handler is a generator so batch results stream back per scene;
+    # return_aggregate_stream also collects them into the /run and /runsync output.
+    # It runs async so up to MAX_CONCURRENT_JOBS jobs share the worker.
+    logger.info(f"Taking up to {MAX_CONCURRENT_JOBS} jobs at once with {MAX_INFLIGHT_PROMPTS} prompts in flight")
+    runpod.serverless.start({
+        "handler": async_handler,
+        "concurrency_modifier": concurrency_modifier,
+        "return_aggregate_stream": True,
+    })
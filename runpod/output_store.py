@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Object stores for generated images
+
+Images are written straight from ComfyUI's output directory to the configured
+store and returned as URLs with their sha256, instead of base64 blobs in the
+job response. Keys are content-addressed so re-renders of an identical image
+don't create duplicate objects.
+
+Configured through environment variables:
+    OUTPUT_STORE              "s3" or "local" (unset means base64 responses)
+    OUTPUT_DIR                local: directory to write images to
+    OUTPUT_BASE_URL           local: URL prefix the directory is served under (file:// URLs otherwise)
+    BUCKET_ENDPOINT_URL       s3: endpoint of any S3-compatible service
+    BUCKET_ACCESS_KEY_ID      s3: credentials
+    BUCKET_SECRET_ACCESS_KEY
+    BUCKET_NAME               s3: bucket to upload to
+    BUCKET_PUBLIC_URL         s3: public URL prefix; presigned URLs are returned otherwise
+    OUTPUT_URL_EXPIRY         s3: presigned URL lifetime in seconds (default 7 days)
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import boto3
+    BOTO3_AVAILABLE = True
+except ImportError:
+    BOTO3_AVAILABLE = False
+
+READ_SIZE = 1024 * 1024
+
+CONTENT_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+}
+
+def sha256_file(path: str) -> str:
+    """Compute the sha256 of a file without reading it into memory at once"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def content_key(sha256: str, filename: str, prefix: str = "images") -> str:
+    """Content-addressed object key, keeping the original extension"""
+    extension = os.path.splitext(filename)[1].lower() or ".png"
+    return f"{prefix}/{sha256}{extension}"
+
+class LocalDirectoryStore:
+    """Copies images into a local directory (e.g. on the Network Volume, or for offline testing)"""
+
+    def __init__(self, directory: str, base_url: Optional[str] = None):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/") if base_url else None
+
+    def put(self, source_path: str, key: str) -> str:
+        destination = os.path.join(self.directory, key)
+        if not os.path.exists(destination):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            tmp_path = f"{destination}.{os.getpid()}.tmp"
+            shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, destination)
+        if self.base_url:
+            return f"{self.base_url}/{key}"
+        return f"file://{os.path.abspath(destination)}"
+
+class S3Store:
+    """Uploads images to an S3-compatible bucket"""
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None,
+                 access_key_id: Optional[str] = None, secret_access_key: Optional[str] = None,
+                 public_url: Optional[str] = None, url_expiry: int = 7 * 24 * 3600):
+        if not BOTO3_AVAILABLE:
+            raise RuntimeError("boto3 is required for the s3 output store")
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.url_expiry = url_expiry
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+        )
+
+    def put(self, source_path: str, key: str) -> str:
+        content_type = CONTENT_TYPES.get(os.path.splitext(key)[1], "application/octet-stream")
+        # upload_file streams from disk (multipart for large files)
+        self.client.upload_file(source_path, self.bucket, key, ExtraArgs={"ContentType": content_type})
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=self.url_expiry,
+        )
+
+def get_output_store():
+    """Build the store configured in the environment, or None for base64 responses"""
+    store_type = os.environ.get("OUTPUT_STORE", "").lower()
+    if not store_type:
+        return None
+    if store_type == "local":
+        return LocalDirectoryStore(
+            os.environ.get("OUTPUT_DIR", "/runpod-volume/outputs"),
+            os.environ.get("OUTPUT_BASE_URL"),
+        )
+    if store_type == "s3":
+        return S3Store(
+            os.environ["BUCKET_NAME"],
+            endpoint_url=os.environ.get("BUCKET_ENDPOINT_URL"),
+            access_key_id=os.environ.get("BUCKET_ACCESS_KEY_ID"),
+            secret_access_key=os.environ.get("BUCKET_SECRET_ACCESS_KEY"),
+            public_url=os.environ.get("BUCKET_PUBLIC_URL"),
+            url_expiry=int(os.environ.get("OUTPUT_URL_EXPIRY", 7 * 24 * 3600)),
+        )
+    raise ValueError(f"Unknown OUTPUT_STORE: {store_type}")
+
+def store_image(store, source_path: str, filename: str) -> dict:
+    """Put an image file in the store and describe it for the job result"""
+    sha256 = sha256_file(source_path)
+    url = store.put(source_path, content_key(sha256, filename))
+    return {
+        "type": "url",
+        "data": url,
+        "filename": filename,
+        "sha256": sha256,
+        "size": os.path.getsize(source_path),
+    }
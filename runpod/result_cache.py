@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+On-disk cache of workflow results
+
+Results are keyed by a canonical hash of the workflow graph after reference
+images have been replaced by their content-addressed filenames, so the same
+prompt, seed and reference images map to the same key. Each entry keeps the
+generated image files and a small meta.json; least recently used entries are
+evicted once the cache grows past its size limit.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+
+def workflow_key(workflow: Dict[str, Any]) -> str:
+    """Canonical sha256 of a workflow graph (key order and whitespace don't matter)"""
+    canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """LRU cache of result images on disk, bounded by total size"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (last used timestamp, size in bytes), loaded lazily from disk
+        self.entries: Optional[Dict[str, Tuple[float, int]]] = None
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_entries(self) -> Dict[str, Tuple[float, int]]:
+        if self.entries is None:
+            self.entries = {}
+            if os.path.isdir(self.directory):
+                for shard in os.listdir(self.directory):
+                    shard_dir = os.path.join(self.directory, shard)
+                    if not os.path.isdir(shard_dir):
+                        continue
+                    for key in os.listdir(shard_dir):
+                        meta_path = os.path.join(shard_dir, key, META_FILE)
+                        try:
+                            with open(meta_path, "r") as f:
+                                meta = json.load(f)
+                            self.entries[key] = (os.path.getmtime(meta_path), meta["size"])
+                        except (OSError, ValueError, KeyError):
+                            continue
+        return self.entries
+
+    def get(self, key: str) -> Optional[List[Tuple[str, str]]]:
+        """Return (filename, path) pairs for a cached result, or None on a miss"""
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        files = [(filename, os.path.join(entry_dir, filename)) for filename in meta.get("files", [])]
+        if not files or not all(os.path.isfile(path) for _, path in files):
+            return None
+
+        # The meta file's mtime is the entry's last use, shared by all workers on the volume
+        now = time.time()
+        try:
+            os.utime(meta_path, (now, now))
+        except OSError:
+            pass
+        with self.lock:
+            self._load_entries()[key] = (now, meta.get("size", 0))
+        return files
+
+    def put(self, key: str, images: List[Tuple[str, Union[str, bytes]]]):
+        """Store result images, given as (filename, source path or bytes) pairs"""
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            size = 0
+            filenames = []
+            for filename, source in images:
+                filename = os.path.basename(filename)
+                destination = os.path.join(tmp_dir, filename)
+                if isinstance(source, bytes):
+                    with open(destination, "wb") as f:
+                        f.write(source)
+                else:
+                    shutil.copyfile(source, destination)
+                size += os.path.getsize(destination)
+                filenames.append(filename)
+
+            with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+                json.dump({"files": filenames, "size": size, "created": time.time()}, f)
+
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError as e:
+            logger.warning(f"Could not cache result {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        with self.lock:
+            self._load_entries()[key] = (time.time(), size)
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        entries = self._load_entries()
+        total = sum(size for _, size in entries.values())
+        if total <= self.max_bytes:
+            return
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            del entries[key]
+            total -= size
+            logger.info(f"Evicted cached result {key}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            entries = self._load_entries()
+            return {"entries": len(entries), "bytes": sum(size for _, size in entries.values())}
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Priority scheduler in front of ComfyUI's prompt queue
+
+Several jobs run on one worker at once, but ComfyUI renders one prompt at a
+time in the order they were queued. Once a prompt is in ComfyUI's queue
+nothing can overtake it, so jobs take a slot from the scheduler before
+queueing each prompt and give it back when the prompt finishes. Only a few
+prompts are in flight at a time (enough to keep the GPU busy), and freed
+slots go to waiting interactive jobs before bulk ones, first come first
+served within a class. This lets a single "regenerate this image" request
+skip ahead of a long storyboard batch.
+
+Time spent waiting for a slot is recorded per class.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+from typing import Dict, Any, List, Optional
+
+from comfy_client import LatencyHistogram
+
+# Priority classes, most urgent first
+PRIORITIES = {"interactive": 0, "bulk": 1}
+
+# How often a blocked acquire() looks at its cancelled event, in seconds
+CANCEL_CHECK_INTERVAL = 0.25
+
+class PromptScheduler:
+    """Hands out ComfyUI queue slots, interactive jobs first"""
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 0
+        # (priority, arrival, granted flag) of jobs waiting for a slot
+        self.waiting: List[Any] = []
+        self.arrivals = itertools.count()
+        self.condition = threading.Condition()
+        self.queue_waits = {name: LatencyHistogram() for name in PRIORITIES}
+        self.max_wait_ms = dict.fromkeys(PRIORITIES, 0.0)
+
+    def acquire(self, priority: str, block: bool = True,
+                cancelled: Optional[threading.Event] = None) -> Optional[float]:
+        """
+        Take a slot for one prompt and return the seconds spent waiting for it.
+
+        Without block, returns None at once when no slot is free, without
+        joining the line. A blocked caller also gets None, and leaves the line,
+        once cancelled is set.
+        """
+        start = time.perf_counter()
+        with self.condition:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return self._record(priority, 0.0)
+            if not block:
+                return None
+            entry = (PRIORITIES[priority], next(self.arrivals), [False])
+            heapq.heappush(self.waiting, entry)
+            while not entry[2][0]:
+                if cancelled is not None and cancelled.is_set():
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    return None
+                self.condition.wait(CANCEL_CHECK_INTERVAL if cancelled is not None else None)
+            return self._record(priority, time.perf_counter() - start)
+
+    def release(self):
+        """Give a slot back, handing it straight to the most urgent waiting job"""
+        with self.condition:
+            if self.waiting:
+                _, _, granted = heapq.heappop(self.waiting)
+                granted[0] = True
+                self.condition.notify_all()
+            else:
+                self.in_flight -= 1
+
+    def _record(self, priority: str, seconds: float) -> float:
+        wait_ms = seconds * 1000
+        self.queue_waits[priority].observe(wait_ms)
+        self.max_wait_ms[priority] = max(self.max_wait_ms[priority], wait_ms)
+        return seconds
+
+    def stats(self) -> Dict[str, Any]:
+        """Slots in use, jobs waiting and queue wait histograms per class"""
+        with self.condition:
+            waiting = dict.fromkeys(PRIORITIES, 0)
+            for priority, _, _ in self.waiting:
+                waiting[next(name for name, value in PRIORITIES.items() if value == priority)] += 1
+            return {
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "waiting": waiting,
+                "queue_wait": {
+                    name: {**histogram.snapshot(), "max_ms": round(self.max_wait_ms[name], 1)}
+                    for name, histogram in self.queue_waits.items()
+                },
+            }
+
+    def summary(self) -> str:
+        """One-line queue wait summary for logs"""
+        parts = []
+        for name, snapshot in self.stats()["queue_wait"].items():
+            if snapshot["count"]:
+                parts.append(f"{name} n={snapshot['count']} p50<={snapshot['p50_ms']}ms "
+                             f"p95<={snapshot['p95_ms']}ms max={snapshot['max_ms']}ms")
+        return "; ".join(parts)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Tests for download_models.py against a local HTTP server stand-in
+
+Run with: python -m unittest test_download_models (from runpod/)
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import download_models
+
+TOKEN = "test-token"
+
+class ModelServer(BaseHTTPRequestHandler):
+    """Serves one file at /model.bin with HEAD, ranges and an optional bearer token"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def authorized(self):
+        if not self.server.require_token:
+            return True
+        if self.headers.get("Authorization") == f"Bearer {TOKEN}":
+            return True
+        self.send_response(401)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return False
+
+    def send_file_headers(self, status, length):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{self.server.sha256}"')
+        self.end_headers()
+
+    def do_HEAD(self):
+        if self.authorized():
+            self.send_file_headers(200, len(self.server.data))
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.gets.append(self.headers.get("Range"))
+        if not self.authorized():
+            return
+        data = self.server.data
+        byte_range = self.headers.get("Range")
+        if not byte_range:
+            self.send_file_headers(200, len(data))
+            self.wfile.write(data)
+            return
+        start, end = (int(value) for value in byte_range.split("=", 1)[1].split("-"))
+        self.send_file_headers(206, end - start + 1)
+        self.wfile.write(data[start:end + 1])
+
+class DownloadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(64 * 1024 + 123)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ModelServer)
+        self.server.data = self.data
+        self.server.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.server.require_token = True
+        self.server.gets = []
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/model.bin"
+        self.directory = tempfile.mkdtemp()
+        self.destination = os.path.join(self.directory, "models", "model.bin")
+        # Small segments so a test file is split into several range requests
+        self.min_segment_size = download_models.MIN_SEGMENT_SIZE
+        download_models.MIN_SEGMENT_SIZE = 8 * 1024
+
+    def tearDown(self):
+        download_models.MIN_SEGMENT_SIZE = self.min_segment_size
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def read_destination(self):
+        with open(self.destination, "rb") as f:
+            return f.read()
+
+    def test_authenticated_segmented_download(self):
+        self.assertTrue(download_models.download_file(self.url, self.destination, self.server.sha256,
+                                                      hf_token=TOKEN, segments=4))
+        self.assertEqual(self.read_destination(), self.data)
+        self.assertEqual(len(self.server.gets), 4)
+        self.assertTrue(all(self.server.gets))
+        self.assertFalse(os.path.exists(f"{self.destination}.part"))
+        self.assertEqual(download_models.verified_hashes[self.destination], self.server.sha256)
+
+    def test_client_error_is_not_retried(self):
+        # HEAD succeeds without a token, the ranged GETs are refused
+        original_head = ModelServer.do_HEAD
+        ModelServer.do_HEAD = lambda handler: handler.send_file_headers(200, len(handler.server.data))
+        try:
+            self.assertFalse(download_models.download_file(self.url, self.destination, self.server.sha256, segments=2))
+        finally:
+            ModelServer.do_HEAD = original_head
+        self.assertEqual(len(self.server.gets), 2)
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_resumes_partial_download(self):
+        part_path = f"{self.destination}.part"
+        os.makedirs(os.path.dirname(part_path))
+        size = len(self.data)
+        half = size // 2
+        with open(part_path, "wb") as f:
+            f.write(self.data[:half])
+            f.truncate(size)
+        with open(f"{part_path}.json", "w") as f:
+            json.dump({"url": self.url, "size": size, "segments": [
+                {"start": 0, "end": half - 1, "done": half},
+                {"start": half, "end": size - 1, "done": 100},
+            ]}, f)
+        with open(part_path, "r+b") as f:
+            f.seek(half)
+            f.write(self.data[half:half + 100])
+
+        self.assertTrue(download_models.download_file(self.url, self.destination, self.server.sha256, hf_token=TOKEN))
+        self.assertEqual(self.read_destination(), self.data)
+        # Only the rest of the unfinished segment was fetched
+        self.assertEqual(self.server.gets, [f"bytes={half + 100}-{size - 1}"])
+        self.assertFalse(os.path.exists(f"{part_path}.json"))
+
+    def test_checksum_mismatch_discards_download(self):
+        # The server advertises the hash of what it actually sends
+        self.server.sha256 = "0" * 64
+        self.assertFalse(download_models.download_file(self.url, self.destination, sha256="0" * 64, hf_token=TOKEN))
+        self.assertFalse(os.path.exists(self.destination))
+        self.assertFalse(os.path.exists(f"{self.destination}.part"))
+        self.assertFalse(os.path.exists(f"{self.destination}.part.json"))
+
+    def test_pin_disagreeing_with_etag_fails_before_download(self):
+        self.assertFalse(download_models.download_file(self.url, self.destination, sha256="0" * 64, hf_token=TOKEN))
+        self.assertEqual(self.server.gets, [])
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_unpinned_download_fails(self):
+        self.assertFalse(download_models.download_file(self.url, self.destination, hf_token=TOKEN))
+        self.assertEqual(self.server.gets, [])
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_unpinned_download_with_opt_out_uses_etag(self):
+        self.assertTrue(download_models.download_file(self.url, self.destination, hf_token=TOKEN, allow_unpinned=True))
+        self.assertEqual(self.read_destination(), self.data)
+        self.assertEqual(download_models.verified_hashes[self.destination], self.server.sha256)
+
+    def test_pinned_hashes_by_relative_path(self):
+        hashes_path = os.path.join(self.directory, "model_hashes.json")
+        with open(hashes_path, "w") as f:
+            json.dump({
+                "models/model.bin": {"url": self.url, "sha256": None},
+                "models/other.bin": {"url": "http://example.invalid/other.bin", "sha256": "1" * 64},
+            }, f)
+        self.assertTrue(download_models.pin_hashes(hashes_path, TOKEN))
+        pinned = download_models.load_pinned_hashes(hashes_path)
+        self.assertEqual(pinned["models/model.bin"]["sha256"], self.server.sha256)
+
+        models = download_models.with_pinned_hashes([
+            {"name": "model", "url": self.url, "path": self.destination, "requires_auth": True},
+            # Pinned for another URL, so not applied
+            {"name": "other", "url": self.url, "path": os.path.join(self.directory, "models", "other.bin")},
+        ], self.directory, pinned)
+        self.assertEqual(models[0]["sha256"], self.server.sha256)
+        self.assertNotIn("sha256", models[1])
+        self.assertEqual(download_models.download_models(models[:1], TOKEN), {"model": True})
+        self.assertEqual(self.read_destination(), self.data)
+
+if __name__ == "__main__":
+    unittest.main()
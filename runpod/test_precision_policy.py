@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Tests for the handler's precision policy
+
+Run with: python -m unittest test_precision_policy (from runpod/, with the
+handler's dependencies installed)
+"""
+
+import copy
+import unittest
+
+import handler
+
+def flux_workflow(unet_name, weight_dtype, t5_name):
+    return {
+        "1": {"class_type": "UNETLoader", "inputs": {"unet_name": unet_name, "weight_dtype": weight_dtype}},
+        "2": {"class_type": "DualCLIPLoader", "inputs": {"clip_name1": "clip_l.safetensors", "clip_name2": t5_name, "type": "flux"}},
+        "3": {"class_type": "VAELoader", "inputs": {"vae_name": "ae.safetensors"}},
+    }
+
+FP8_WORKFLOW = flux_workflow("flux1-kontext-dev-fp8.safetensors", "fp8_e4m3fn", "t5xxl_fp8_e4m3fn.safetensors")
+# As built by flux-service-local.js
+LOCAL_FP16_WORKFLOW = flux_workflow("flux1-kontext-dev.safetensors", "default", "t5xxl_fp16.safetensors")
+LOCAL_FP8_WORKFLOW = flux_workflow("flux1-dev-kontext_fp8_scaled.safetensors", "fp8_e4m3fn", "t5xxl_fp8_e4m3fn_scaled.safetensors")
+OTHER_UNET_WORKFLOW = flux_workflow("flux1-schnell.safetensors", "fp8_e4m3fn", "t5xxl_fp8_e4m3fn.safetensors")
+
+class PrecisionPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = handler.PRECISION_POLICY
+        self.resident = handler.resident_precision
+
+    def tearDown(self):
+        handler.PRECISION_POLICY = self.policy
+        handler.resident_precision = self.resident
+
+    def apply(self, policy, resident, workflow):
+        handler.PRECISION_POLICY = policy
+        handler.resident_precision = resident
+        return handler.apply_precision_policy(copy.deepcopy(workflow))
+
+    def assert_loads(self, workflow, precision):
+        self.assertTrue(handler.uses_precision_models(workflow, precision), workflow)
+
+    def test_allow_keeps_workflow(self):
+        workflow, error = self.apply("allow", "fp16", LOCAL_FP8_WORKFLOW)
+        self.assertIsNone(error)
+        self.assertEqual(workflow, LOCAL_FP8_WORKFLOW)
+
+    def test_resident_workflow_is_unchanged(self):
+        for policy in ("rewrite", "reject"):
+            workflow, error = self.apply(policy, "fp8", FP8_WORKFLOW)
+            self.assertIsNone(error)
+            self.assertEqual(workflow, FP8_WORKFLOW)
+
+    def test_rewrite_other_precision(self):
+        workflow, error = self.apply("rewrite", "fp16", FP8_WORKFLOW)
+        self.assertIsNone(error)
+        self.assert_loads(workflow, "fp16")
+        self.assertEqual(workflow["1"]["inputs"]["weight_dtype"], "default")
+
+    def test_rewrite_other_unet_name_at_same_precision(self):
+        workflow, error = self.apply("rewrite", "fp16", LOCAL_FP16_WORKFLOW)
+        self.assertIsNone(error)
+        self.assert_loads(workflow, "fp16")
+
+    def test_rewrite_other_unet_name_at_other_precision(self):
+        workflow, error = self.apply("rewrite", "fp16", LOCAL_FP8_WORKFLOW)
+        self.assertIsNone(error)
+        self.assert_loads(workflow, "fp16")
+
+    def test_rewrite_first_job_to_its_own_precision_files(self):
+        workflow, error = self.apply("rewrite", None, LOCAL_FP8_WORKFLOW)
+        self.assertIsNone(error)
+        self.assert_loads(workflow, "fp8")
+
+    def test_rewrite_rejects_unet_that_is_not_kontext(self):
+        workflow, error = self.apply("rewrite", "fp8", OTHER_UNET_WORKFLOW)
+        self.assertIn("flux1-schnell.safetensors", error)
+        self.assertEqual(workflow, OTHER_UNET_WORKFLOW)
+
+    def test_reject_other_unet_name_at_same_precision(self):
+        _, error = self.apply("reject", "fp16", LOCAL_FP16_WORKFLOW)
+        self.assertIsNotNone(error)
+
+    def test_reject_lets_first_job_decide(self):
+        _, error = self.apply("reject", None, LOCAL_FP8_WORKFLOW)
+        self.assertIsNone(error)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -198,7 +198,9 @@ async function transcribeAudio(book, chapter, container, chapterElement, actionB
 
     // Try to use Whisper service first
     try {
-        const result = await whisperClient.transcribe(chapterFilePath);
+        // The segments decoded so far are written to `${segmentsFilePath}.partial` as the
+        // chapter is transcribed; the .segments.json and .txt are only written once it's complete
+        const result = await whisperClient.transcribe(chapterFilePath, { segmentsPath: segmentsFilePath });
         
         if (result.success) {
             // Save transcription to files
@@ -498,9 +500,19 @@ audio.addEventListener('timeupdate', () => {
 
 async function loadAndDisplayCaptions(chapter) {
     const segmentsFilePath = path.join(audiobooksDir, currentBook, `${chapter.title}.segments.json`);
+    // While the chapter is still being transcribed, show the segments decoded so far
+    const partialFilePath = `${segmentsFilePath}.partial`;
     if (fs.existsSync(segmentsFilePath)) {
         currentSegments = JSON.parse(fs.readFileSync(segmentsFilePath, 'utf-8'));
         captionsDisplay.textContent = ''; // Clear previous captions
+    } else if (fs.existsSync(partialFilePath)) {
+        try {
+            currentSegments = JSON.parse(fs.readFileSync(partialFilePath, 'utf-8'));
+        } catch (error) {
+            // Caught between two writes; the next load will pick it up
+            currentSegments = [];
+        }
+        captionsDisplay.textContent = '';
     } else {
         currentSegments = [];
         captionsDisplay.textContent = 'No captions available. Transcribe the chapter to generate them.';
@@ -1396,55 +1408,64 @@ async function createStoryboardTemplate(book, chaptersData) {
             continue;
         }
         
-        const segments = JSON.parse(fs.readFileSync(segmentsPath, 'utf-8'));
+        const segmentsData = fs.readFileSync(segmentsPath);
+        const segments = JSON.parse(segmentsData.toString('utf-8'));
+        
+        const sceneParameters = () => ({
+            artStyle: artStyleTags.join(', '),
+            camera: "[TO BE FILLED: e.g., 'wide shot', 'close-up', 'medium shot', 'over-the-shoulder', 'aerial view']",
+            environment: "[TO BE FILLED: e.g., 'Roman Forum', 'villa interior', 'street market', 'temple courtyard']",
+            background: "[TO BE FILLED: Describe what's visible in the background]",
+            foreground: "[TO BE FILLED: Describe what's visible in the foreground]",
+            mood: "[TO BE FILLED: e.g., 'tense', 'peaceful', 'chaotic', 'mysterious', 'celebratory']",
+            characters: [],
+            characterPoses: {
+                character1: "[TO BE FILLED: Describe pose/action for first character if present]",
+                character2: "[TO BE FILLED: Describe pose/action for second character if present]"
+            }
+        });
+        // Scene boundaries precomputed by tools/storyboard_prep.py, when they match these segments
+        const cachedScenes = loadPrecomputedScenes(path.join(bookPath, `${chapterData.title}.scenes.json`), segmentsData, chapterNumber);
         
-        // Calculate scenes based on 20-second max duration
         const scenes = [];
-        let currentSceneStart = segments[0].start;
-        let currentSceneSegments = [];
-        let sceneCount = 1;
-        
-        segments.forEach((segment, index) => {
-            currentSceneSegments.push(segment.id);
-            
-            // Check if we should end current scene
-            const sceneDuration = segment.end - currentSceneStart;
-            const isLastSegment = index === segments.length - 1;
+        if (cachedScenes) {
+            for (const scene of cachedScenes) {
+                scenes.push({ ...scene, parameters: sceneParameters() });
+            }
+        } else {
+            // Otherwise calculate scenes based on 20-second max duration
+            let currentSceneStart = segments[0].start;
+            let firstSceneIndex = 0;
+            let sceneCount = 1;
             
-            if (sceneDuration >= 20 || isLastSegment) {
-                // Get the actual segments for this scene
-                const sceneSegments = segments.filter(s => currentSceneSegments.includes(s.id));
-                const segmentTexts = sceneSegments.map(s => s.text).join(' ');
+            segments.forEach((segment, index) => {
+                // Check if we should end current scene
+                const sceneDuration = segment.end - currentSceneStart;
+                const isLastSegment = index === segments.length - 1;
                 
-                scenes.push({
-                    sceneId: `ch${chapterNumber}_scene${sceneCount}`,
-                    startTime: currentSceneStart,
-                    endTime: segment.end,
-                    segmentIds: [...currentSceneSegments],
-                    segmentText: segmentTexts, // Include full text for AI reference
-                    parameters: {
-                        artStyle: artStyleTags.join(', '),
-                        camera: "[TO BE FILLED: e.g., 'wide shot', 'close-up', 'medium shot', 'over-the-shoulder', 'aerial view']",
-                        environment: "[TO BE FILLED: e.g., 'Roman Forum', 'villa interior', 'street market', 'temple courtyard']",
-                        background: "[TO BE FILLED: Describe what's visible in the background]",
-                        foreground: "[TO BE FILLED: Describe what's visible in the foreground]",
-                        mood: "[TO BE FILLED: e.g., 'tense', 'peaceful', 'chaotic', 'mysterious', 'celebratory']",
-                        characters: [],
-                        characterPoses: {
-                            character1: "[TO BE FILLED: Describe pose/action for first character if present]",
-                            character2: "[TO BE FILLED: Describe pose/action for second character if present]"
-                        }
+                if (sceneDuration >= 20 || isLastSegment) {
+                    // The scene is the run of segments since the last cut
+                    const sceneSegments = segments.slice(firstSceneIndex, index + 1);
+                    const segmentTexts = sceneSegments.map(s => s.text).join(' ');
+                    
+                    scenes.push({
+                        sceneId: `ch${chapterNumber}_scene${sceneCount}`,
+                        startTime: currentSceneStart,
+                        endTime: segment.end,
+                        segmentIds: sceneSegments.map(s => s.id),
+                        segmentText: segmentTexts, // Include full text for AI reference
+                        parameters: sceneParameters()
+                    });
+                    
+                    // Start next scene
+                    if (!isLastSegment) {
+                        currentSceneStart = segment.end;
+                        firstSceneIndex = index + 1;
+                        sceneCount++;
                     }
-                });
-                
-                // Start next scene
-                if (!isLastSegment) {
-                    currentSceneStart = segment.end;
-                    currentSceneSegments = [];
-                    sceneCount++;
                 }
-            }
-        });
+            });
+        }
         
         // Create template structure with instructions
         const template = {
@@ -1484,6 +1505,26 @@ async function createStoryboardTemplate(book, chaptersData) {
     }
 }
 
+// Scenes written by tools/storyboard_prep.py, if they were computed from exactly these
+// segments for this chapter with the 20 second target the template builder uses
+function loadPrecomputedScenes(scenesPath, segmentsData, chapterNumber) {
+    if (!fs.existsSync(scenesPath)) {
+        return null;
+    }
+    try {
+        const cached = JSON.parse(fs.readFileSync(scenesPath, 'utf-8'));
+        const segmentsSha256 = require('crypto').createHash('sha256').update(segmentsData).digest('hex');
+        if (cached.segmentsSha256 !== segmentsSha256 || cached.chapter !== chapterNumber ||
+            !cached.settings || cached.settings.targetSeconds !== 20) {
+            return null;
+        }
+        return cached.scenes;
+    } catch (e) {
+        console.error('Error loading precomputed scenes:', e);
+        return null;
+    }
+}
+
 async function generateStoryboardPrompt(book, chaptersData, characters) {
     // Use the audiobook's storyboard directory for the prompt file
     const bookPath = path.join(audiobooksDir, book);
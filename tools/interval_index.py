@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+O(log n) time lookups over a chapter's segments and words
+
+Playback highlighting and storyboard building keep asking "which segment or
+word is playing at time t" and "which words fall between t0 and t1". An
+IntervalIndex answers both with binary searches over start times sorted once:
+
+- starts are sorted, so the intervals that started at or before t are a prefix
+- the running maximum of their ends is sorted too, so the intervals that might
+  still be playing at t start where that maximum first exceeds t
+
+Only the intervals between those two bounds are checked, which is just the
+answer itself when intervals don't overlap (Whisper segments and words
+practically never do), and stays correct when they do. Batched lookups do the
+same with np.searchsorted over an array of times.
+
+Usage:
+    python tools/interval_index.py bench "audiobooks/The Silver Pigs" --chapters 3
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from segment_index import open_index, find_segment_files
+
+class IntervalIndex:
+    """
+    Sorted index over [start, end) intervals. Query results are indices into
+    the starts/ends the index was built from, in start order; intervals with a
+    missing (NaN) start or end never match.
+    """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        valid = np.flatnonzero(~(np.isnan(starts) | np.isnan(ends)))
+        self.order = valid[np.argsort(starts[valid], kind="stable")]
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+        # Scalar queries bisect plain lists, which beats NumPy's per-call overhead
+        self._starts = self.starts.tolist()
+        self._max_ends = self.max_ends.tolist()
+
+    def __len__(self):
+        return len(self.order)
+
+    def _candidates(self, start, end):
+        """Sorted positions that started before end and may still be playing after start"""
+        return bisect.bisect_right(self._max_ends, start), bisect.bisect_left(self._starts, end)
+
+    def find(self, t):
+        """Index of the interval playing at t (the latest started one), or -1 in a gap"""
+        last = bisect.bisect_right(self._starts, t) - 1
+        if last < 0 or self._max_ends[last] <= t:
+            return -1
+        if self.ends[last] > t:
+            return int(self.order[last])
+        # Overlapping intervals: an earlier one is still playing
+        first = bisect.bisect_right(self._max_ends, t)
+        for position in range(last - 1, first - 1, -1):
+            if self.ends[position] > t:
+                return int(self.order[position])
+        return -1
+
+    def find_all(self, t):
+        """Indices of every interval playing at t"""
+        first = bisect.bisect_right(self._max_ends, t)
+        last = bisect.bisect_right(self._starts, t)
+        positions = np.arange(first, last)
+        return self.order[positions[self.ends[first:last] > t]]
+
+    def overlapping(self, start, end):
+        """Indices of the intervals overlapping [start, end), in start order"""
+        first, last = self._candidates(start, end)
+        positions = np.arange(first, last)
+        return self.order[positions[self.ends[first:last] > start]]
+
+    def within(self, start, end):
+        """Indices of the intervals entirely inside [start, end]"""
+        first = bisect.bisect_left(self._starts, start)
+        last = bisect.bisect_right(self._starts, end)
+        positions = np.arange(first, last)
+        return self.order[positions[self.ends[first:last] <= end]]
+
+    def find_many(self, times):
+        """find() for an array of times at once; -1 where a time falls in a gap"""
+        times = np.asarray(times, dtype=np.float64)
+        last = np.searchsorted(self.starts, times, side="right") - 1
+        result = np.full(times.shape, -1, dtype=np.int64)
+        if not len(self.order):
+            return result
+        clipped = np.maximum(last, 0)
+        hit = (last >= 0) & (self.ends[clipped] > times)
+        result[hit] = self.order[last[hit]]
+        # Overlapping intervals: fall back to the scalar search where an earlier one may still play
+        overlapped = np.flatnonzero(~hit & (last >= 0) & (self.max_ends[clipped] > times))
+        for i in overlapped:
+            result.flat[i] = self.find(times.flat[i])
+        return result
+
+class ChapterTimeline:
+    """Segment and word interval indexes for one chapter"""
+
+    def __init__(self, segment_starts, segment_ends, word_starts, word_ends, word_segments):
+        self.segments = IntervalIndex(segment_starts, segment_ends)
+        self.words = IntervalIndex(word_starts, word_ends)
+        self.word_segments = np.asarray(word_segments, dtype=np.int64)
+
+    @classmethod
+    def from_segments(cls, segments):
+        """Build from .segments.json segments"""
+        words = [(index, word) for index, segment in enumerate(segments) for word in segment.get("words") or []]
+        return cls(
+            [_time(segment.get("start")) for segment in segments],
+            [_time(segment.get("end")) for segment in segments],
+            [_time(word.get("start")) for _, word in words],
+            [_time(word.get("end")) for _, word in words],
+            [index for index, _ in words],
+        )
+
+    @classmethod
+    def from_index(cls, index):
+        """Build from a segment_index.SegmentIndex without decoding any text"""
+        word_segments = np.repeat(np.arange(len(index)), np.diff(index.seg_words.astype(np.int64)))
+        return cls(index.starts, index.ends, index.word_starts, index.word_ends, word_segments)
+
+    def segment_at(self, t):
+        return self.segments.find(t)
+
+    def word_at(self, t):
+        return self.words.find(t)
+
+    def words_between(self, start, end):
+        """Words overlapping [start, end), as word indices in chapter order"""
+        return self.words.overlapping(start, end)
+
+    def segments_between(self, start, end):
+        return self.segments.overlapping(start, end)
+
+def _time(value):
+    return float("nan") if value is None else float(value)
+
+def load_timeline(json_path):
+    """Timeline of a chapter, from its .segments.bin when current and its JSON otherwise"""
+    index = open_index(json_path)
+    if index is not None:
+        return ChapterTimeline.from_index(index)
+    with open(json_path, "r", encoding="utf-8") as f:
+        return ChapterTimeline.from_segments(json.load(f))
+
+def _linear_find(starts, ends, t):
+    for i in range(len(starts)):
+        if starts[i] <= t < ends[i]:
+            return i
+    return -1
+
+def _linear_between(starts, ends, start, end):
+    return [i for i in range(len(starts)) if starts[i] < end and ends[i] > start]
+
+def _best_time(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+def benchmark(book_dir, chapters=3, queries=2000, repeat=3, seed=0):
+    """Compare linear scans with the interval index on the largest chapters of a book"""
+    paths = sorted(find_segment_files(book_dir), key=os.path.getsize, reverse=True)[:chapters]
+    rng = np.random.default_rng(seed)
+    rows = []
+    for json_path in paths:
+        with open(json_path, "r", encoding="utf-8") as f:
+            segments = json.load(f)
+        words = [word for segment in segments for word in segment.get("words") or []]
+        use_words = bool(words)
+        items = words if use_words else segments
+        starts = [_time(item.get("start")) for item in items]
+        ends = [_time(item.get("end")) for item in items]
+        duration = max(ends)
+        times = np.sort(rng.uniform(0, duration, queries))
+        time_list = times.tolist()
+        ranges = [(t, t + 30.0) for t in time_list[:200]]
+
+        build = _best_time(lambda: IntervalIndex(starts, ends), repeat)
+        index = IntervalIndex(starts, ends)
+        linear = [_linear_find(starts, ends, t) for t in time_list]
+        assert [index.find(t) for t in time_list] == linear
+        assert index.find_many(times).tolist() == linear
+        for start, end in ranges[:20]:
+            assert index.overlapping(start, end).tolist() == _linear_between(starts, ends, start, end)
+
+        rows.append({
+            "chapter": os.path.basename(json_path),
+            "kind": "words" if use_words else "segments",
+            "intervals": len(items),
+            "build_ms": build * 1000,
+            "linear_point_us": _best_time(lambda: [_linear_find(starts, ends, t) for t in time_list], repeat) / queries * 1e6,
+            "index_point_us": _best_time(lambda: [index.find(t) for t in time_list], repeat) / queries * 1e6,
+            "batch_point_us": _best_time(lambda: index.find_many(times), repeat) / queries * 1e6,
+            "linear_range_us": _best_time(lambda: [_linear_between(starts, ends, s, e) for s, e in ranges], repeat) / len(ranges) * 1e6,
+            "index_range_us": _best_time(lambda: [index.overlapping(s, e) for s, e in ranges], repeat) / len(ranges) * 1e6,
+        })
+    return rows
+
+def print_benchmark(rows):
+    print(f"{'chapter':<50} {'kind':>8} {'n':>6} {'build ms':>9} {'scan us':>8} {'find us':>8} "
+          f"{'batch us':>9} {'scan rng':>9} {'idx rng':>8}")
+    for row in rows:
+        print(f"{row['chapter'][-50:]:<50} {row['kind']:>8} {row['intervals']:>6} {row['build_ms']:>9.2f} "
+              f"{row['linear_point_us']:>8.1f} {row['index_point_us']:>8.2f} {row['batch_point_us']:>9.3f} "
+              f"{row['linear_range_us']:>9.1f} {row['index_range_us']:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark interval index lookups against linear scans")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_parser = commands.add_parser("bench", help="Compare lookups on the largest chapters of a book")
+    bench_parser.add_argument("book_dir", nargs="?", default=os.path.join("audiobooks", "The Silver Pigs"))
+    bench_parser.add_argument("--chapters", type=int, default=3, help="Largest chapters to use (default: 3)")
+    bench_parser.add_argument("--queries", type=int, default=2000, help="Point queries per chapter (default: 2000)")
+    args = parser.parse_args()
+
+    print_benchmark(benchmark(args.book_dir, args.chapters, args.queries))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
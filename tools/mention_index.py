@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Book-wide inverted index of word mentions with audio timestamps
+
+Tokenizes every chapter of a book (the words of its .segments.json, or the
+.txt when there are no segments) and keeps an inverted index from each token
+to its positions, so phrase queries and a character's timeline of mentions
+across the whole book are answered from memory in milliseconds instead of
+re-reading every chapter.
+
+The index lives in <book>/.mentions/:
+
+    manifest.json   per chapter: source file, size, mtime, sha256 and shard
+    <shard>.npz     one chapter's token stream: tokens, their word, start/end times
+    index.npz       the merged index: sorted vocabulary, postings grouped by
+                    token (global positions), token id stream, times and the
+                    position where each chapter starts
+
+Updating re-tokenizes only the chapters whose source changed (by size and
+mtime, then sha256) and re-merges the shards, which is a few vectorized NumPy
+operations. Positions count tokens, so a phrase match is a run of consecutive
+positions within one chapter. Times are NaN for chapters indexed from .txt.
+
+Usage:
+    python tools/mention_index.py build "audiobooks/The Silver Pigs"
+    python tools/mention_index.py search "audiobooks/The Silver Pigs" "Aulus Camillus"
+    python tools/mention_index.py timeline "audiobooks/The Silver Pigs" Sosia "Sosia Camillina" --context 12
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from storyboard_prep import load_chapter_titles
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+INDEX_DIR = ".mentions"
+MANIFEST_FILE = "manifest.json"
+MERGED_FILE = "index.npz"
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+POSSESSIVE = re.compile(r"'s$")
+
+def tokenize(text):
+    """Lower-case tokens of a piece of text; possessives index as the name ("Falco's" -> "falco")"""
+    text = text.replace("’", "'").casefold()
+    return [POSSESSIVE.sub("", token) for token in TOKEN_PATTERN.findall(text)]
+
+def chapter_words(segments):
+    """(word text, start, end) for every word of a chapter's segments"""
+    words = []
+    for segment in segments:
+        if segment.get("words"):
+            for word in segment["words"]:
+                words.append((word.get("word", ""), _time(word.get("start")), _time(word.get("end"))))
+            continue
+        # No word timings: spread the segment's time over its words by character offset
+        text = segment.get("text", "")
+        start, end = _time(segment.get("start")), _time(segment.get("end"))
+        pieces = [(match.start(), match.end(), match.group()) for match in re.finditer(r"\S+", text)]
+        length = max(len(text), 1)
+        for piece_start, piece_end, piece in pieces:
+            words.append((
+                piece,
+                start + (end - start) * piece_start / length,
+                start + (end - start) * piece_end / length,
+            ))
+    return words
+
+def _time(value):
+    return float("nan") if value is None else float(value)
+
+def tokenize_chapter(source_path):
+    """Token stream of a chapter: tokens, the word each came from, word texts, and token times"""
+    with open(source_path, "r", encoding="utf-8") as f:
+        if source_path.endswith(".segments.json"):
+            words = chapter_words(json.load(f))
+        else:
+            words = [(word, float("nan"), float("nan")) for word in f.read().split()]
+    tokens, token_words, starts, ends = [], [], [], []
+    for index, (word, start, end) in enumerate(words):
+        for token in tokenize(word):
+            tokens.append(token)
+            token_words.append(index)
+            starts.append(start)
+            ends.append(end)
+    return {
+        "tokens": np.array(tokens, dtype=str),
+        "token_words": np.array(token_words, dtype=np.int32),
+        "words": np.array([word.strip() for word, _, _ in words], dtype=str),
+        "starts": np.array(starts, dtype=np.float32),
+        "ends": np.array(ends, dtype=np.float32),
+    }
+
+def _sha256_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _chapter_source(book_dir, title):
+    for suffix in (".segments.json", ".txt"):
+        path = os.path.join(book_dir, f"{title}{suffix}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def _save_npz(path, compressed=False, **arrays):
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    (np.savez_compressed if compressed else np.savez)(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+class MentionIndex:
+    """A book's merged mention index, loaded from <book>/.mentions/"""
+
+    def __init__(self, book_dir):
+        self.book_dir = book_dir
+        self.index_dir = os.path.join(book_dir, INDEX_DIR)
+        with open(os.path.join(self.index_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != INDEX_VERSION:
+            raise ValueError(f"{self.index_dir} has an unsupported index version")
+        self.chapters = self.manifest["chapters"]
+        with np.load(os.path.join(self.index_dir, MERGED_FILE), allow_pickle=False) as merged:
+            self.vocab = merged["vocab"]
+            self.offsets = merged["offsets"]
+            self.postings = merged["postings"]
+            self.stream = merged["stream"]
+            self.starts = merged["starts"]
+            self.ends = merged["ends"]
+            self.token_words = merged["token_words"]
+            self.chapter_offsets = merged["chapter_offsets"]
+        self.token_ids = {token: index for index, token in enumerate(self.vocab.tolist())}
+        self._words = {}
+
+    @classmethod
+    def update(cls, book_dir, force=False):
+        """Index new and changed chapters, drop removed ones, re-merge; returns (index, summary)"""
+        index_dir = os.path.join(book_dir, INDEX_DIR)
+        os.makedirs(index_dir, exist_ok=True)
+        manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+            if previous.get("version") != INDEX_VERSION:
+                previous = {}
+        except (OSError, ValueError):
+            previous = {}
+        previous_chapters = {chapter["title"]: chapter for chapter in previous.get("chapters", [])}
+
+        chapters = []
+        indexed = 0
+        for number, title in enumerate(load_chapter_titles(book_dir), 1):
+            source = _chapter_source(book_dir, title)
+            if source is None:
+                continue
+            stat = os.stat(source)
+            entry = {
+                "title": title,
+                "number": number,
+                "source": os.path.basename(source),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "shard": f"{hashlib.sha256(title.encode('utf-8')).hexdigest()[:16]}.npz",
+            }
+            old = previous_chapters.get(title)
+            shard_path = os.path.join(index_dir, entry["shard"])
+            reusable = not force and old is not None and old["source"] == entry["source"] and os.path.exists(shard_path)
+            if reusable and old["size"] == entry["size"] and old["mtime_ns"] == entry["mtime_ns"]:
+                entry["sha256"] = old["sha256"]
+            else:
+                entry["sha256"] = _sha256_file(source)
+                if not (reusable and old["sha256"] == entry["sha256"]):
+                    _save_npz(shard_path, compressed=True, **tokenize_chapter(source))
+                    indexed += 1
+                    logger.info(f"Indexed {title}")
+            chapters.append(entry)
+
+        start = time.perf_counter()
+        unchanged = (
+            indexed == 0
+            and [chapter["shard"] for chapter in chapters] == [chapter["shard"] for chapter in previous.get("chapters", [])]
+            and os.path.exists(os.path.join(index_dir, MERGED_FILE))
+        )
+        if not unchanged:
+            merge_shards(index_dir, chapters)
+        merge_seconds = time.perf_counter() - start
+
+        live_shards = {chapter["shard"] for chapter in chapters}
+        for chapter in previous_chapters.values():
+            if chapter["shard"] not in live_shards:
+                try:
+                    os.remove(os.path.join(index_dir, chapter["shard"]))
+                except OSError:
+                    pass
+
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "chapters": chapters}, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+        index = cls(book_dir)
+        return index, {
+            "chapters": len(chapters),
+            "indexed": indexed,
+            "tokens": int(len(index.stream)),
+            "vocabulary": int(len(index.vocab)),
+            "merge_ms": round(merge_seconds * 1000, 2),
+        }
+
+    def _chapter_of(self, positions):
+        return np.searchsorted(self.chapter_offsets, positions, side="right") - 1
+
+    def positions(self, phrase):
+        """Global token positions where phrase starts"""
+        tokens = tokenize(phrase)
+        if not tokens or any(token not in self.token_ids for token in tokens):
+            return np.zeros(0, dtype=np.int64)
+        first = self.token_ids[tokens[0]]
+        positions = self.postings[self.offsets[first]:self.offsets[first + 1]].astype(np.int64)
+        if len(tokens) > 1:
+            # Keep the starts followed by the rest of the phrase within the same chapter
+            chapter_ends = self.chapter_offsets[self._chapter_of(positions) + 1]
+            keep = positions + len(tokens) <= chapter_ends
+            for offset, token in enumerate(tokens[1:], 1):
+                following = np.minimum(positions + offset, len(self.stream) - 1)
+                keep &= self.stream[following] == self.token_ids[token]
+            positions = positions[keep]
+        return positions
+
+    def _hits(self, positions, length):
+        chapters = self._chapter_of(positions)
+        hits = []
+        for position, chapter in zip(positions.tolist(), chapters.tolist()):
+            end_position = position + length - 1
+            hits.append({
+                "chapter": self.chapters[chapter]["number"],
+                "title": self.chapters[chapter]["title"],
+                "position": position - int(self.chapter_offsets[chapter]),
+                "word": int(self.token_words[position]),
+                "start": _json_time(self.starts[position]),
+                "end": _json_time(self.ends[end_position]),
+            })
+        return hits
+
+    def search(self, phrase):
+        """Every mention of a phrase, in book order"""
+        return self._hits(self.positions(phrase), len(tokenize(phrase)))
+
+    def timeline(self, names):
+        """
+        Mentions of a character under any of their names, in book order.
+        Where one name is part of another ("Falco" in "Marcus Didius Falco")
+        an overlapping mention is only counted once.
+        """
+        found = []
+        for name in names:
+            length = len(tokenize(name))
+            found.extend((position, length) for position in self.positions(name).tolist())
+        found.sort(key=lambda item: (item[0], -item[1]))
+        mentions = []
+        covered_until = -1
+        for position, length in found:
+            if position < covered_until:
+                continue
+            mentions.extend(self._hits(np.array([position]), length))
+            covered_until = position + length
+        by_chapter = {}
+        for mention in mentions:
+            by_chapter[mention["chapter"]] = by_chapter.get(mention["chapter"], 0) + 1
+        return {"mentions": mentions, "chapters": by_chapter}
+
+    def chapter_words(self, chapter_index):
+        if chapter_index not in self._words:
+            shard = os.path.join(self.index_dir, self.chapters[chapter_index]["shard"])
+            with np.load(shard, allow_pickle=False) as arrays:
+                self._words[chapter_index] = arrays["words"]
+        return self._words[chapter_index]
+
+    def passage(self, hit, context=30):
+        """The words around a mention, for pulling only the relevant text of a chapter"""
+        chapter_index = next(i for i, chapter in enumerate(self.chapters) if chapter["title"] == hit["title"])
+        words = self.chapter_words(chapter_index)
+        first = max(0, hit["word"] - context)
+        return " ".join(words[first:hit["word"] + context + 1].tolist())
+
+def _json_time(value):
+    value = float(value)
+    return None if value != value else round(value, 3)
+
+def merge_shards(index_dir, chapters):
+    """Merge chapter shards into index.npz"""
+    streams = []
+    for chapter in chapters:
+        with np.load(os.path.join(index_dir, chapter["shard"]), allow_pickle=False) as arrays:
+            streams.append({name: arrays[name] for name in ("tokens", "token_words", "starts", "ends")})
+    lengths = np.array([len(stream["tokens"]) for stream in streams], dtype=np.int64)
+    chapter_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    def concatenate(name, dtype):
+        return np.concatenate([stream[name] for stream in streams]) if streams else np.zeros(0, dtype=dtype)
+
+    tokens = concatenate("tokens", str)
+    vocab, stream = np.unique(tokens, return_inverse=True)
+    stream = stream.astype(np.int32).ravel()
+    postings = np.argsort(stream, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(stream[postings], np.arange(len(vocab) + 1)).astype(np.int64)
+    _save_npz(
+        os.path.join(index_dir, MERGED_FILE),
+        vocab=vocab,
+        offsets=offsets,
+        postings=postings,
+        stream=stream,
+        starts=concatenate("starts", np.float32),
+        ends=concatenate("ends", np.float32),
+        token_words=concatenate("token_words", np.int32),
+        chapter_offsets=chapter_offsets,
+    )
+
+def open_index(book_dir, update=True):
+    """A book's mention index, bringing it up to date first unless update is False"""
+    if update:
+        return MentionIndex.update(book_dir)[0]
+    return MentionIndex(book_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query a book's mention index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Index new and changed chapters")
+    build_parser.add_argument("book_dir")
+    build_parser.add_argument("--force", action="store_true", help="Re-index every chapter")
+    search_parser = commands.add_parser("search", help="Find every mention of a phrase")
+    search_parser.add_argument("book_dir")
+    search_parser.add_argument("phrase")
+    timeline_parser = commands.add_parser("timeline", help="Timeline of a character's mentions")
+    timeline_parser.add_argument("book_dir")
+    timeline_parser.add_argument("names", nargs="+", help="Names the character goes by")
+    timeline_parser.add_argument("--context", type=int, default=0, help="Include this many words around each mention")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.command == "build":
+        _, summary = MentionIndex.update(args.book_dir, args.force)
+        print(json.dumps(summary))
+        return 0
+
+    index = open_index(args.book_dir)
+    start = time.perf_counter()
+    if args.command == "search":
+        result = {"mentions": index.search(args.phrase)}
+    else:
+        result = index.timeline(args.names)
+        if args.context:
+            for mention in result["mentions"]:
+                mention["passage"] = index.passage(mention, args.context)
+    result["query_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    print(json.dumps(result, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Compact columnar index for chapter .segments.json files
+
+A .segments.json stores every word as an indented JSON object, so a long
+chapter is megabytes of text that has to be parsed in full before any timing
+is usable. The .segments.bin written next to it holds the same timing data
+as flat little-endian arrays that are memory-mapped on open:
+
+    header            magic, version, segment/word counts, source size/mtime/sha256
+    seg_start         float32[segments]
+    seg_end           float32[segments]
+    seg_id            int32[segments]        (-1 when the segment had no id)
+    seg_flags         uint8[segments]        (HAS_ID, HAS_WORDS)
+    seg_words         uint32[segments + 1]   (word range of each segment)
+    seg_text_offsets  uint32[segments + 1]   (byte range of each segment's text)
+    word_start        float32[words]
+    word_end          float32[words]
+    word_text_offsets uint32[words + 1]      (byte range of each word's text)
+    text blob         utf-8 segment texts, then word texts
+
+Every array starts on an 8 byte boundary. Opening an index reads only the
+header; the arrays are numpy views of the mapped file and texts are decoded on
+access. Times are float32 (about a millisecond of precision over a 3 hour
+chapter) and are rounded to milliseconds when converted back to segments.
+Extra per-segment fields some transcribers add (tokens, avg_logprob, ...) are
+not kept: the .segments.json stays the source of truth and the app keeps
+reading it.
+
+Usage:
+    python tools/segment_index.py convert "audiobooks/Book/Chapter 1.segments.json"
+    python tools/segment_index.py migrate audiobooks
+    python tools/segment_index.py bench audiobooks
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ABVSEGS\0"
+VERSION = 1
+# magic, version, segment count, word count, source size, source mtime_ns, source sha256
+HEADER = struct.Struct("<8sIIIQq32s")
+HEADER_SIZE = 72
+ALIGNMENT = 8
+
+HAS_ID = 1
+HAS_WORDS = 2
+
+JSON_SUFFIX = ".segments.json"
+INDEX_SUFFIX = ".segments.bin"
+
+def index_path(json_path):
+    """Path of the .segments.bin for a .segments.json"""
+    if json_path.endswith(JSON_SUFFIX):
+        return json_path[:-len(JSON_SUFFIX)] + INDEX_SUFFIX
+    return os.path.splitext(json_path)[0] + INDEX_SUFFIX
+
+def _layout(segment_count, word_count):
+    """(name, dtype, count, offset) of each array, and where the text blob starts"""
+    arrays = [
+        ("seg_start", np.float32, segment_count),
+        ("seg_end", np.float32, segment_count),
+        ("seg_id", np.int32, segment_count),
+        ("seg_flags", np.uint8, segment_count),
+        ("seg_words", np.uint32, segment_count + 1),
+        ("seg_text_offsets", np.uint32, segment_count + 1),
+        ("word_start", np.float32, word_count),
+        ("word_end", np.float32, word_count),
+        ("word_text_offsets", np.uint32, word_count + 1),
+    ]
+    layout = []
+    offset = HEADER_SIZE
+    for name, dtype, count in arrays:
+        layout.append((name, np.dtype(dtype).newbyteorder("<"), count, offset))
+        offset += count * np.dtype(dtype).itemsize
+        offset += -offset % ALIGNMENT
+    return layout, offset
+
+def _time(value):
+    return float("nan") if value is None else float(value)
+
+def _source_info(json_path, data=None):
+    stat = os.stat(json_path)
+    if data is None:
+        with open(json_path, "rb") as f:
+            data = f.read()
+    return stat.st_size, stat.st_mtime_ns, hashlib.sha256(data).digest()
+
+def write_index(segments, path, source_info=(0, 0, b"\0" * 32)):
+    """Write segments ([{id, start, end, text, words: [{word, start, end}]}]) as an index file"""
+    segment_count = len(segments)
+    words = [word for segment in segments for word in segment.get("words") or []]
+    word_count = len(words)
+    layout, blob_offset = _layout(segment_count, word_count)
+
+    texts = [segment.get("text", "").encode("utf-8") for segment in segments]
+    texts += [word.get("word", "").encode("utf-8") for word in words]
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.uint64)
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+    if text_offsets[-1] > np.iinfo(np.uint32).max:
+        raise ValueError("Segment text is too large for the index format")
+
+    word_counts = [len(segment.get("words") or []) for segment in segments]
+    seg_words = np.zeros(segment_count + 1, dtype=np.uint64)
+    np.cumsum(word_counts, out=seg_words[1:])
+
+    columns = {
+        "seg_start": [_time(segment.get("start")) for segment in segments],
+        "seg_end": [_time(segment.get("end")) for segment in segments],
+        "seg_id": [segment.get("id", -1) for segment in segments],
+        "seg_flags": [
+            (HAS_ID if "id" in segment else 0) | (HAS_WORDS if "words" in segment else 0)
+            for segment in segments
+        ],
+        "seg_words": seg_words,
+        "seg_text_offsets": text_offsets[:segment_count + 1],
+        "word_start": [_time(word.get("start")) for word in words],
+        "word_end": [_time(word.get("end")) for word in words],
+        "word_text_offsets": text_offsets[segment_count:],
+    }
+
+    source_size, source_mtime_ns, source_sha256 = source_info
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, segment_count, word_count, source_size, source_mtime_ns, source_sha256))
+        for name, dtype, count, offset in layout:
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(np.asarray(columns[name], dtype=dtype).tobytes())
+        f.write(b"\0" * (blob_offset - f.tell()))
+        for text in texts:
+            f.write(text)
+    os.replace(tmp_path, path)
+
+def convert(json_path, path=None):
+    """Write the index for a .segments.json; returns the index path"""
+    with open(json_path, "rb") as f:
+        data = f.read()
+    path = path or index_path(json_path)
+    write_index(json.loads(data), path, _source_info(json_path, data))
+    return path
+
+class SegmentIndex:
+    """
+    A memory-mapped .segments.bin. starts/ends/ids and word_starts/word_ends
+    are read-only numpy views of the file; nothing is parsed or copied until
+    texts or segment dicts are asked for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.raw = np.memmap(path, dtype=np.uint8, mode="r")
+        if len(self.raw) < HEADER_SIZE:
+            raise ValueError(f"{path} is not a segment index")
+        magic, version, segment_count, word_count, size, mtime_ns, sha256 = HEADER.unpack_from(self.raw)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a segment index")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported segment index version {version}")
+        self.source_size = size
+        self.source_mtime_ns = mtime_ns
+        self.source_sha256 = sha256.hex()
+
+        layout, blob_offset = _layout(segment_count, word_count)
+        for name, dtype, count, offset in layout:
+            setattr(self, name, self.raw[offset:offset + count * dtype.itemsize].view(dtype))
+        self.blob = self.raw[blob_offset:]
+
+        self.starts = self.seg_start
+        self.ends = self.seg_end
+        self.ids = self.seg_id
+        self.word_starts = self.word_start
+        self.word_ends = self.word_end
+
+    def __len__(self):
+        return len(self.seg_start)
+
+    @property
+    def word_count(self):
+        return len(self.word_start)
+
+    def _text(self, offsets, index):
+        return bytes(self.blob[offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def segment_text(self, index):
+        return self._text(self.seg_text_offsets, index)
+
+    def word_text(self, index):
+        return self._text(self.word_text_offsets, index)
+
+    def word_range(self, index):
+        """Indices of a segment's words in word_starts/word_ends"""
+        return range(int(self.seg_words[index]), int(self.seg_words[index + 1]))
+
+    def is_current(self, json_path):
+        """Whether the index still matches its .segments.json (by size and mtime)"""
+        try:
+            stat = os.stat(json_path)
+        except OSError:
+            return False
+        return stat.st_size == self.source_size and stat.st_mtime_ns == self.source_mtime_ns
+
+    def segment(self, index):
+        """One segment in the .segments.json format"""
+        flags = int(self.seg_flags[index])
+        segment = {}
+        if flags & HAS_ID:
+            segment["id"] = int(self.seg_id[index])
+        segment["start"] = _round_time(self.seg_start[index])
+        segment["end"] = _round_time(self.seg_end[index])
+        segment["text"] = self.segment_text(index)
+        if flags & HAS_WORDS:
+            segment["words"] = [
+                {
+                    "word": self.word_text(word),
+                    "start": _round_time(self.word_start[word]),
+                    "end": _round_time(self.word_end[word]),
+                }
+                for word in self.word_range(index)
+            ]
+        return segment
+
+    def to_segments(self):
+        """All segments in the .segments.json format"""
+        return [self.segment(index) for index in range(len(self))]
+
+def _round_time(value):
+    value = float(value)
+    return None if value != value else round(value, 3)
+
+def open_index(json_path):
+    """The up-to-date index for a .segments.json, or None if it's missing or stale"""
+    path = index_path(json_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        index = SegmentIndex(path)
+    except ValueError as e:
+        logger.warning(f"Ignoring {path}: {e}")
+        return None
+    return index if index.is_current(json_path) else None
+
+def load_segments(json_path):
+    """Segments of a chapter, from its index when it's current and from the JSON otherwise"""
+    index = open_index(json_path)
+    if index is not None:
+        return index.to_segments()
+    with open(json_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def find_segment_files(root):
+    found = []
+    for directory, _, files in os.walk(root):
+        found.extend(os.path.join(directory, name) for name in files if name.endswith(JSON_SUFFIX))
+    return sorted(found)
+
+def migrate(root, force=False):
+    """Write or refresh the index of every .segments.json under root; returns a summary"""
+    summary = {"converted": 0, "up_to_date": 0, "failed": [], "json_bytes": 0, "index_bytes": 0}
+    for json_path in find_segment_files(root):
+        path = index_path(json_path)
+        try:
+            with open(json_path, "rb") as f:
+                data = f.read()
+            source_info = _source_info(json_path, data)
+            if not force and _indexed_sha256(path) == source_info[2]:
+                # Unchanged (maybe touched or copied): just record the new size and mtime
+                _update_source_info(path, source_info)
+                summary["up_to_date"] += 1
+            else:
+                write_index(json.loads(data), path, source_info)
+                summary["converted"] += 1
+                logger.info(f"Indexed {json_path}")
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not index {json_path}: {e}")
+            summary["failed"].append(json_path)
+            continue
+        summary["json_bytes"] += len(data)
+        summary["index_bytes"] += os.path.getsize(path)
+    return summary
+
+def _read_header(f):
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    fields = HEADER.unpack(header)
+    return fields if fields[0] == MAGIC and fields[1] == VERSION else None
+
+def _indexed_sha256(path):
+    try:
+        with open(path, "rb") as f:
+            header = _read_header(f)
+    except OSError:
+        return None
+    return header[6] if header else None
+
+def _update_source_info(path, source_info):
+    with open(path, "r+b") as f:
+        magic, version, segment_count, word_count = _read_header(f)[:4]
+        f.seek(0)
+        f.write(HEADER.pack(magic, version, segment_count, word_count, *source_info))
+
+def _best_time(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmark(root, repeat=5):
+    """Compare loading every indexed chapter under root from JSON and from its index"""
+    def load_json(json_path):
+        with open(json_path, "r", encoding="utf-8") as f:
+            segments = json.load(f)
+        return [segment["start"] for segment in segments], [segment["end"] for segment in segments]
+
+    def load_timings(path):
+        index = SegmentIndex(path)
+        return index.starts, index.ends, index.word_starts, index.word_ends
+
+    rows = []
+    for json_path in find_segment_files(root):
+        path = index_path(json_path)
+        index = open_index(json_path)
+        if index is None:
+            continue
+        rows.append({
+            "chapter": os.path.relpath(json_path, root),
+            "segments": len(index),
+            "words": index.word_count,
+            "json_bytes": os.path.getsize(json_path),
+            "index_bytes": os.path.getsize(path),
+            "json_load": _best_time(lambda: load_json(json_path), repeat),
+            "index_timings": _best_time(lambda: load_timings(path), repeat),
+            "index_segments": _best_time(lambda: SegmentIndex(path).to_segments(), repeat),
+        })
+        del index
+    return rows
+
+def print_benchmark(rows):
+    if not rows:
+        print("No indexed chapters found (run migrate first)")
+        return
+    print(f"{'chapter':<60} {'segs':>6} {'words':>7} {'json KB':>8} {'bin KB':>7} "
+          f"{'json ms':>8} {'mmap ms':>8} {'dicts ms':>8}")
+    for row in rows:
+        print(f"{row['chapter'][-60:]:<60} {row['segments']:>6} {row['words']:>7} "
+              f"{row['json_bytes'] / 1024:>8.1f} {row['index_bytes'] / 1024:>7.1f} "
+              f"{row['json_load'] * 1000:>8.2f} {row['index_timings'] * 1000:>8.3f} {row['index_segments'] * 1000:>8.2f}")
+    json_total = sum(row["json_load"] for row in rows)
+    timings_total = sum(row["index_timings"] for row in rows)
+    print(f"Total: {sum(row['json_bytes'] for row in rows) / 1024:.0f} KB JSON -> "
+          f"{sum(row['index_bytes'] for row in rows) / 1024:.0f} KB index; timing load "
+          f"{json_total * 1000:.1f} ms -> {timings_total * 1000:.2f} ms "
+          f"({json_total / timings_total if timings_total else 0:.0f}x)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and benchmark compact .segments.bin indexes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert_parser = commands.add_parser("convert", help="Index one .segments.json")
+    convert_parser.add_argument("json_path")
+    convert_parser.add_argument("-o", "--output", help="Index path (default: next to the JSON)")
+    migrate_parser = commands.add_parser("migrate", help="Index every .segments.json under a directory")
+    migrate_parser.add_argument("root", nargs="?", default="audiobooks")
+    migrate_parser.add_argument("--force", action="store_true", help="Rewrite indexes that are up to date")
+    bench_parser = commands.add_parser("bench", help="Compare JSON and index load times")
+    bench_parser.add_argument("root", nargs="?", default="audiobooks")
+    bench_parser.add_argument("--repeat", type=int, default=5, help="Runs per chapter, best is reported (default: 5)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.command == "convert":
+        print(convert(args.json_path, args.output))
+    elif args.command == "migrate":
+        summary = migrate(args.root, args.force)
+        print(json.dumps(summary))
+        return 1 if summary["failed"] else 0
+    else:
+        print_benchmark(benchmark(args.root, args.repeat))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
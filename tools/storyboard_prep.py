@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Precompute storyboard scene boundaries for a whole book
+
+Scenes are cut at segment boundaries roughly every --target seconds. Rather
+than cutting at the first segment past the target, each cut goes to the
+longest pause near a multiple of the target: the silence between the last
+word of one segment and the first word of the next (segment times when there
+are no word timings), less a small penalty for drifting from the mark. All
+chapters are concatenated and the boundaries picked in one vectorized NumPy
+pass, so a 60 chapter book takes milliseconds.
+
+Each chapter's scenes are cached in <chapter>.scenes.json next to its
+.segments.json, along with the sha256 of the segments file, the chapter
+number and the settings they were computed from; they're recomputed when any
+of those change. The storyboard template builder in script.js uses them when
+they match the chapter's segments.
+
+Usage:
+    python tools/storyboard_prep.py "audiobooks/The Silver Pigs" --target 20
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCENES_VERSION = 1
+SCENES_SUFFIX = ".scenes.json"
+
+DEFAULT_TARGET_SECONDS = 20.0
+# Cuts are only considered within this fraction of the target around each mark
+WINDOW_FRACTION = 0.25
+# Pause seconds traded for drifting a whole target length from the mark
+DRIFT_PENALTY = 1.0
+# A tail shorter than this fraction of the target joins the chapter's last scene
+MIN_TAIL_FRACTION = 0.5
+
+def natural_key(name):
+    """Sort "Chapter 2" before "Chapter 10", like the app's numeric localeCompare"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+def load_chapter_titles(book_dir):
+    """Chapter titles in chapters.json order, or the .segments.json files found"""
+    try:
+        with open(os.path.join(book_dir, "chapters.json"), "r", encoding="utf-8") as f:
+            return [chapter["title"] for chapter in json.load(f)]
+    except (OSError, ValueError, KeyError, TypeError):
+        suffix = ".segments.json"
+        return sorted((name[:-len(suffix)] for name in os.listdir(book_dir) if name.endswith(suffix)), key=natural_key)
+
+def scene_settings(target_seconds):
+    return {
+        "targetSeconds": target_seconds,
+        "window": WINDOW_FRACTION,
+        "drift": DRIFT_PENALTY,
+        "tail": MIN_TAIL_FRACTION,
+    }
+
+def load_cached_scenes(path, segments_sha256, chapter_number, target_seconds):
+    """Cached scenes when they were computed from these segments with these settings"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    current = (
+        cached.get("version") == SCENES_VERSION
+        and cached.get("segmentsSha256") == segments_sha256
+        and cached.get("chapter") == chapter_number
+        and cached.get("settings") == scene_settings(target_seconds)
+    )
+    return cached if current else None
+
+def _time(value):
+    return np.nan if value is None else float(value)
+
+def segment_arrays(segments):
+    """start, end, first word start and last word end (NaN without words) per segment"""
+    starts = np.array([_time(segment.get("start")) for segment in segments], dtype=np.float64)
+    ends = np.array([_time(segment.get("end")) for segment in segments], dtype=np.float64)
+    first_words = np.array([
+        _time(segment["words"][0].get("start")) if segment.get("words") else np.nan
+        for segment in segments
+    ], dtype=np.float64)
+    last_words = np.array([
+        _time(segment["words"][-1].get("end")) if segment.get("words") else np.nan
+        for segment in segments
+    ], dtype=np.float64)
+    return starts, ends, first_words, last_words
+
+def compute_cuts(chapter_segments, target_seconds=DEFAULT_TARGET_SECONDS):
+    """
+    Scene cuts for many chapters at once: for each chapter, the indices of the
+    segments that end a scene (the last segment always does)
+    """
+    if not chapter_segments:
+        return []
+    columns = [segment_arrays(segments) for segments in chapter_segments]
+    counts = np.array([len(segments) for segments in chapter_segments])
+    starts, ends, first_words, last_words = (np.concatenate(column) for column in zip(*columns))
+    chapters = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    nonempty = counts > 0
+    chapter_start = np.zeros(len(counts))
+    chapter_end = np.zeros(len(counts))
+    chapter_start[nonempty] = starts[offsets[:-1][nonempty]]
+    chapter_end[nonempty] = ends[offsets[1:][nonempty] - 1]
+
+    # Candidate cuts: after every segment that isn't the last of its chapter
+    speech_end = np.where(np.isnan(last_words), ends, last_words)
+    speech_start = np.where(np.isnan(first_words), starts, first_words)
+    pause = np.zeros(len(ends))
+    pause[:-1] = np.maximum(0.0, speech_start[1:] - speech_end[:-1])
+    is_last = np.zeros(len(ends), dtype=bool)
+    is_last[offsets[1:][nonempty] - 1] = True
+
+    elapsed = ends - chapter_start[chapters]
+    mark = np.rint(elapsed / target_seconds)
+    drift = np.abs(elapsed - mark * target_seconds) / target_seconds
+    eligible = (
+        ~is_last
+        & (mark >= 1)
+        & (drift <= WINDOW_FRACTION)
+        & (chapter_end[chapters] - ends >= MIN_TAIL_FRACTION * target_seconds)
+        & ~np.isnan(elapsed)
+    )
+    candidates = np.flatnonzero(eligible)
+    score = pause[candidates] - DRIFT_PENALTY * drift[candidates]
+
+    # Best candidate per (chapter, mark): sort by chapter, mark, then best score first
+    order = np.lexsort((-score, mark[candidates], chapters[candidates]))
+    ranked = candidates[order]
+    first_of_group = np.ones(len(ranked), dtype=bool)
+    first_of_group[1:] = (chapters[ranked][1:] != chapters[ranked][:-1]) | (mark[ranked][1:] != mark[ranked][:-1])
+    cut_positions = np.sort(np.concatenate([ranked[first_of_group], np.flatnonzero(is_last)]))
+
+    # Split back per chapter, as indices within the chapter
+    cut_chapters = chapters[cut_positions]
+    bounds = np.searchsorted(cut_chapters, np.arange(len(counts) + 1))
+    return [
+        (cut_positions[bounds[i]:bounds[i + 1]] - offsets[i]).tolist()
+        for i in range(len(counts))
+    ]
+
+def build_scenes(segments, cuts, chapter_number):
+    """Scene records (as the storyboard templates use them) from a chapter's cuts"""
+    scenes = []
+    first = 0
+    scene_start = segments[0]["start"] if segments else 0
+    for scene_number, last in enumerate(cuts, 1):
+        scene_segments = segments[first:last + 1]
+        scenes.append({
+            "sceneId": f"ch{chapter_number}_scene{scene_number}",
+            "startTime": scene_start,
+            "endTime": scene_segments[-1]["end"],
+            "segmentIds": [segment.get("id", first + i) for i, segment in enumerate(scene_segments)],
+            "segmentText": " ".join(segment.get("text", "") for segment in scene_segments),
+        })
+        scene_start = scene_segments[-1]["end"]
+        first = last + 1
+    return scenes
+
+def prepare_book(book_dir, target_seconds=DEFAULT_TARGET_SECONDS, force=False):
+    """Write the scenes file of every chapter whose cache is missing or stale; returns a summary"""
+    stale = []
+    up_to_date = 0
+    for number, title in enumerate(load_chapter_titles(book_dir), 1):
+        segments_path = os.path.join(book_dir, f"{title}.segments.json")
+        if not os.path.exists(segments_path):
+            continue
+        with open(segments_path, "rb") as f:
+            data = f.read()
+        segments_sha256 = hashlib.sha256(data).hexdigest()
+        scenes_path = os.path.join(book_dir, f"{title}{SCENES_SUFFIX}")
+        if not force and load_cached_scenes(scenes_path, segments_sha256, number, target_seconds):
+            up_to_date += 1
+            continue
+        stale.append((number, title, scenes_path, segments_sha256, json.loads(data)))
+
+    start = time.perf_counter()
+    all_cuts = compute_cuts([segments for *_, segments in stale], target_seconds)
+    compute_seconds = time.perf_counter() - start
+
+    scene_count = 0
+    for (number, title, scenes_path, segments_sha256, segments), cuts in zip(stale, all_cuts):
+        scenes = build_scenes(segments, cuts, number)
+        scene_count += len(scenes)
+        tmp_path = f"{scenes_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": SCENES_VERSION,
+                "segmentsSha256": segments_sha256,
+                "chapter": number,
+                "settings": scene_settings(target_seconds),
+                "scenes": scenes,
+            }, f, indent=2)
+        os.replace(tmp_path, scenes_path)
+        logger.info(f"{title}: {len(scenes)} scenes")
+
+    return {
+        "prepared": len(stale),
+        "up_to_date": up_to_date,
+        "scenes": scene_count,
+        "compute_ms": round(compute_seconds * 1000, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute storyboard scene boundaries for a book")
+    parser.add_argument("book_dir", help="Book directory containing chapters.json and .segments.json files")
+    parser.add_argument("--target", type=float, default=DEFAULT_TARGET_SECONDS,
+                        help=f"Target scene length in seconds (default: {DEFAULT_TARGET_SECONDS:g})")
+    parser.add_argument("--force", action="store_true", help="Recompute chapters whose scenes are up to date")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    print(json.dumps(prepare_book(args.book_dir, args.target, args.force)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
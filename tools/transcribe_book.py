@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Transcribe every chapter of an audiobook directory in parallel
+
+Upcoming chapters are decoded and resampled to 16 kHz mono by a pool of
+ffmpeg decoder processes while model worker processes transcribe the ones
+already decoded, so whole-book ingest scales with cores instead of taking the
+sum of the chapter times. Each worker loads the model once.
+
+Chapters whose .segments.json is already up to date are skipped. The sha256
+of every transcribed MP3 is recorded in .transcription.json in the book
+directory, and a chapter is only redone when its audio hash changes (or with
+--force). Existing transcripts without a recorded hash are adopted as-is.
+
+Writes <chapter>.txt and <chapter>.segments.json (with per-word timestamps)
+next to each MP3, in the same format as the app. Long silences and non-speech
+are skipped before decoding (see whisper_service.transcribe_audio).
+
+Usage:
+    python tools/transcribe_book.py "audiobooks/The Silver Pigs" --model base --workers 2
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from whisper_service import transcribe_audio
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = ".transcription.json"
+READ_SIZE = 1024 * 1024
+
+# Set in each model worker process by init_worker()
+worker_model = None
+
+def natural_key(name):
+    """Sort "Chapter 2" before "Chapter 10\""""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+def find_chapters(book_dir):
+    return sorted((f for f in os.listdir(book_dir) if f.lower().endswith(".mp3")), key=natural_key)
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(book_dir):
+    try:
+        with open(os.path.join(book_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(book_dir, manifest):
+    path = os.path.join(book_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def audio_hash(path, entry):
+    """sha256 of an MP3, reusing the recorded hash while size and mtime are unchanged"""
+    stat = os.stat(path)
+    if entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        return entry["sha256"]
+    return sha256_file(path)
+
+def output_paths(book_dir, chapter_file):
+    base = os.path.join(book_dir, os.path.splitext(chapter_file)[0])
+    return f"{base}.txt", f"{base}.segments.json"
+
+def decode_audio(audio_path, decode_dir):
+    """Decode and resample one chapter with ffmpeg (decoder pool); returns a .npy path"""
+    import numpy as np
+    import whisper
+    audio = whisper.load_audio(audio_path)
+    fd, npy_path = tempfile.mkstemp(suffix=".npy", dir=decode_dir)
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, audio)
+    return npy_path, len(audio) / whisper.audio.SAMPLE_RATE
+
+def init_worker(model_name, threads):
+    """Load the model once per worker process"""
+    global worker_model
+    import torch
+    import whisper
+    if threads:
+        torch.set_num_threads(threads)
+    worker_model = whisper.load_model(model_name)
+
+def transcribe_decoded(npy_path, language, word_timestamps, vad):
+    """Transcribe a decoded chapter (model worker pool)"""
+    import numpy as np
+    start = time.time()
+    audio = np.load(npy_path, mmap_mode="r")
+    result = transcribe_audio(worker_model, np.ascontiguousarray(audio), language,
+                              word_timestamps=word_timestamps, vad=vad)
+    return result, time.time() - start
+
+def write_outputs(book_dir, chapter_file, result):
+    text_path, segments_path = output_paths(book_dir, chapter_file)
+    with open(text_path, "w", encoding="utf-8") as f:
+        f.write(result["text"].strip())
+    with open(segments_path, "w", encoding="utf-8") as f:
+        json.dump(result["segments"], f, indent=2)
+
+def plan_chapters(book_dir, manifest, model_name, language, force):
+    """Hash every chapter and return the ones that need transcribing"""
+    pending = []
+    for chapter_file in find_chapters(book_dir):
+        audio_path = os.path.join(book_dir, chapter_file)
+        entry = manifest.get(chapter_file)
+        sha256 = audio_hash(audio_path, entry)
+        stat = os.stat(audio_path)
+        record = {"sha256": sha256, "size": stat.st_size, "mtime": stat.st_mtime}
+
+        text_path, segments_path = output_paths(book_dir, chapter_file)
+        have_outputs = os.path.exists(text_path) and os.path.exists(segments_path)
+        if not force and have_outputs:
+            if entry is None:
+                # Transcribed before hashes were recorded (or by the app): adopt it
+                manifest[chapter_file] = {**record, "model": None, "language": None}
+                logger.info(f"Up to date (adopted): {chapter_file}")
+                continue
+            if entry["sha256"] == sha256:
+                manifest[chapter_file] = {**entry, **record}
+                logger.info(f"Up to date: {chapter_file}")
+                continue
+        pending.append((chapter_file, {**record, "model": model_name, "language": language}))
+    return pending
+
+def transcribe_book(book_dir, model_name="base", language="en", workers=1, decoders=2, force=False,
+                    word_timestamps=True, vad=True):
+    """Transcribe the chapters of a book that aren't up to date; returns a summary"""
+    manifest = load_manifest(book_dir)
+    pending = plan_chapters(book_dir, manifest, model_name, language, force)
+    save_manifest(book_dir, manifest)
+    skipped = len(find_chapters(book_dir)) - len(pending)
+    if not pending:
+        logger.info("All chapters are up to date")
+        return {"transcribed": 0, "skipped": skipped, "failed": []}
+
+    logger.info(f"Transcribing {len(pending)} chapters with {workers} model worker(s) and {decoders} decoder(s)")
+    threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 else 0
+    # Decoded audio is ~230 MB per hour, so only decode a few chapters ahead
+    prefetch = workers + decoders
+
+    start = time.time()
+    audio_seconds = 0.0
+    vad_skipped_seconds = 0.0
+    failed = []
+    with tempfile.TemporaryDirectory(prefix="transcribe_book_") as decode_dir, \
+            ProcessPoolExecutor(decoders) as decode_pool, \
+            ProcessPoolExecutor(workers, initializer=init_worker, initargs=(model_name, threads)) as model_pool:
+        queue = list(pending)
+        decoding = {}
+        transcribing = {}
+
+        def fill():
+            # Decoded chapters stay on disk until their transcription finishes
+            while queue and len(decoding) + len(transcribing) < prefetch:
+                chapter_file, record = queue.pop(0)
+                future = decode_pool.submit(decode_audio, os.path.join(book_dir, chapter_file), decode_dir)
+                decoding[future] = (chapter_file, record)
+
+        fill()
+        while decoding or transcribing:
+            done, _ = wait(list(decoding) + list(transcribing), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in decoding:
+                    chapter_file, record = decoding.pop(future)
+                    try:
+                        npy_path, duration = future.result()
+                    except Exception as e:
+                        logger.error(f"Could not decode {chapter_file}: {e}")
+                        failed.append(chapter_file)
+                        continue
+                    transcribing[model_pool.submit(transcribe_decoded, npy_path, language, word_timestamps, vad)] = (chapter_file, record, npy_path, duration)
+                else:
+                    chapter_file, record, npy_path, duration = transcribing.pop(future)
+                    os.remove(npy_path)
+                    try:
+                        result, seconds = future.result()
+                    except Exception as e:
+                        logger.error(f"Could not transcribe {chapter_file}: {e}")
+                        failed.append(chapter_file)
+                        continue
+                    write_outputs(book_dir, chapter_file, result)
+                    manifest[chapter_file] = record
+                    save_manifest(book_dir, manifest)
+                    audio_seconds += duration
+                    vad_skipped_seconds += result["skipped_seconds"]
+                    logger.info(
+                        f"Transcribed {chapter_file}: {duration / 60:.1f} min of audio in {seconds:.1f}s "
+                        f"({result['skipped_seconds']:.0f}s skipped as non-speech)"
+                    )
+            fill()
+
+    elapsed = time.time() - start
+    logger.info(
+        f"Transcribed {len(pending) - len(failed)} chapters ({audio_seconds / 3600:.2f} h of audio) "
+        f"in {elapsed:.1f}s, {audio_seconds / elapsed if elapsed else 0:.1f}x real time; "
+        f"VAD skipped {vad_skipped_seconds / 60:.1f} min of non-speech"
+    )
+    return {
+        "transcribed": len(pending) - len(failed),
+        "skipped": skipped,
+        "failed": failed,
+        "audio_seconds": round(audio_seconds, 1),
+        "vad_skipped_seconds": round(vad_skipped_seconds, 1),
+        "elapsed_seconds": round(elapsed, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe every chapter of an audiobook directory")
+    parser.add_argument("book_dir", help="Book directory containing chapter MP3s")
+    parser.add_argument("--model", default="base", help="Whisper model name (default: base)")
+    parser.add_argument("--language", default="en", help="Audio language (default: en)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Model worker processes (default: 1; use more on many-core CPU hosts)")
+    parser.add_argument("--decoders", type=int, default=2, help="ffmpeg decoder processes (default: 2)")
+    parser.add_argument("--force", action="store_true", help="Re-transcribe chapters that are up to date")
+    parser.add_argument("--no-word-timestamps", action="store_true", help="Don't add per-word timestamps to segments")
+    parser.add_argument("--no-vad", action="store_true", help="Decode silence and non-speech instead of skipping it")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    summary = transcribe_book(
+        args.book_dir, args.model, args.language, args.workers, args.decoders, args.force,
+        word_timestamps=not args.no_word_timestamps, vad=not args.no_vad
+    )
+    print(json.dumps(summary))
+    return 1 if summary.get("failed") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
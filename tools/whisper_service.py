@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""
+Long-lived Whisper transcription service for the desktop app
+
+Speaks line-delimited JSON-RPC over stdin/stdout: every request is one JSON
+object per line, {"id", "method", "params"}, and every response one line,
+{"id", "result"} or {"id", "error"}. Models are loaded once and stay warm, so
+transcribing a whole book pays for the import and model load once instead of
+once per chapter. Requests are handled in order; queued chapters wait on stdin.
+
+Methods:
+    ping                                          -> {"models": [loaded model names]}
+    load_model   {"model"}                        -> {"model", "load_seconds"}
+    transcribe   {"audio_path", "model", "language", "stream", "segments_path",
+                  "word_timestamps", "vad"}        -> {"text", "segments", "audio_seconds", "skipped_seconds"}
+    unload       {"model"} (all models if omitted) -> {"unloaded": [...]}
+    shutdown                                      -> {}
+
+With "stream": true, transcribe also sends notification lines carrying the
+request id before its response, as Whisper decodes each 30 second window:
+    {"id", "event": "segments", "segments": [...new segments]}
+    {"id", "event": "progress", "processed_seconds", "total_seconds"}
+With "segments_path", the segments decoded so far are kept on disk as a valid
+"<segments_path>.partial" JSON list while the chapter is transcribed, so
+playback and highlighting can start on the early part of a long chapter. It
+replaces segments_path only once transcription succeeds, so an interrupted run
+never clobbers an existing transcript.
+
+Segments carry per-word timestamps ("words": [{"word", "start", "end"}]) like
+the RunPod transcription output, unless "word_timestamps" is false. Unless
+"vad" is false, voice-activity detection finds long silences and non-speech
+(music intros, with the optional silero-vad package) before decoding, and only
+the speech is decoded; "skipped_seconds" reports the audio time saved.
+
+The service exits on shutdown or when stdin closes (i.e. when the app does).
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import inspect
+import logging
+import importlib
+import contextlib
+
+# stdout carries protocol messages only (main() sends stray prints to stderr)
+protocol_out = sys.stdout
+
+logger = logging.getLogger(__name__)
+
+# Loaded models by name
+models = {}
+
+# Id of the request being handled, for notifications sent while it runs
+current_request_id = None
+
+# Voice-activity detection: only silences/non-speech at least this long are skipped
+VAD_MIN_SKIP_SECONDS = 3.0
+VAD_PAD_SECONDS = 0.5
+ENERGY_FRAME_SECONDS = 0.03
+ENERGY_FLOOR_DB = -50.0
+ENERGY_RANGE_DB = 35.0
+
+# Silero VAD model, loaded on first use when the package is installed
+silero_model = None
+
+def get_model(name):
+    """Return a loaded model, loading it on first use"""
+    if name not in models:
+        import whisper
+        start = time.time()
+        models[name] = whisper.load_model(name)
+        logger.info(f"Loaded {name} model in {time.time() - start:.1f}s")
+    return models[name]
+
+def load_model(model="base"):
+    start = time.time()
+    get_model(model)
+    return {"model": model, "load_seconds": round(time.time() - start, 3)}
+
+def format_segment(segment):
+    formatted = {
+        "id": segment["id"],
+        "start": segment["start"],
+        "end": segment["end"],
+        "text": segment["text"].strip()
+    }
+    if "words" in segment:
+        formatted["words"] = [
+            {"word": word["word"], "start": word["start"], "end": word["end"]}
+            for word in segment["words"]
+        ]
+    return formatted
+
+def detect_speech(audio, sample_rate):
+    """
+    Speech regions of a 16 kHz mono array as [(start_seconds, end_seconds)].
+    Uses Silero VAD when the silero-vad package is installed, which also tells
+    music apart from speech; otherwise falls back to a frame energy detector
+    that only finds silence.
+    """
+    try:
+        import torch
+        from silero_vad import load_silero_vad, get_speech_timestamps
+    except ImportError:
+        return detect_speech_energy(audio, sample_rate)
+    
+    global silero_model
+    if silero_model is None:
+        silero_model = load_silero_vad()
+    timestamps = get_speech_timestamps(torch.from_numpy(audio), silero_model, sampling_rate=sample_rate)
+    return [(timestamp["start"] / sample_rate, timestamp["end"] / sample_rate) for timestamp in timestamps]
+
+def detect_speech_energy(audio, sample_rate):
+    """Regions whose frame energy is within ENERGY_RANGE_DB of the loud parts of the audio"""
+    import numpy as np
+    frame_size = int(sample_rate * ENERGY_FRAME_SECONDS)
+    frame_count = len(audio) // frame_size
+    if frame_count == 0:
+        return []
+    frames = np.asarray(audio[:frame_count * frame_size], dtype=np.float32).reshape(frame_count, frame_size)
+    energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    threshold = max(ENERGY_FLOOR_DB, np.percentile(energy_db, 95) - ENERGY_RANGE_DB)
+    
+    voiced = np.concatenate([[False], energy_db > threshold, [False]])
+    edges = np.flatnonzero(voiced[1:] != voiced[:-1])
+    return [
+        (float(start * ENERGY_FRAME_SECONDS), float(end * ENERGY_FRAME_SECONDS))
+        for start, end in zip(edges[::2], edges[1::2])
+    ]
+
+def speech_clips(regions, duration):
+    """
+    Merge speech regions into the clips to decode. Gaps shorter than
+    VAD_MIN_SKIP_SECONDS are kept (every clip costs at least one 30 second
+    decoding window), and clips are padded so words at the edges survive.
+    """
+    clips = []
+    for start, end in regions:
+        start = max(0.0, start - VAD_PAD_SECONDS)
+        end = min(duration, end + VAD_PAD_SECONDS)
+        if clips and start - clips[-1][1] < VAD_MIN_SKIP_SECONDS:
+            clips[-1][1] = max(clips[-1][1], end)
+        else:
+            clips.append([start, end])
+    return clips
+
+class SegmentProgress:
+    """
+    Stand-in for the tqdm bar whisper.transcribe() advances after every decoded
+    window. The window's segments are handed over with add_segments() before the
+    bar advances; each update passes them (numbered like transcribe()'s result)
+    and the audio seconds processed so far to on_update.
+    """
+    
+    def __init__(self, on_update, total=None, **kwargs):
+        import whisper
+        self.on_update = on_update
+        self.frames_per_second = whisper.audio.SAMPLE_RATE / whisper.audio.HOP_LENGTH
+        self.total = total or 0
+        self.n = 0
+        self.reported = 0
+        self.pending = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+    
+    def add_segments(self, segments):
+        self.pending = segments
+    
+    def update(self, n=1):
+        self.n += n
+        new_segments = [{"id": self.reported + i, **segment} for i, segment in enumerate(self.pending)]
+        self.reported += len(new_segments)
+        self.pending = []
+        self.on_update(
+            [format_segment(segment) for segment in new_segments],
+            self.n / self.frames_per_second,
+            self.total / self.frames_per_second
+        )
+
+@contextlib.contextmanager
+def report_progress(on_update):
+    """
+    Route whisper.transcribe()'s progress bar to on_update for the duration.
+    Each window's segments reach the bar through add_word_timestamps(), which
+    transcribe() calls with them (segments=...) when word timestamps are on.
+    """
+    transcribe_module = importlib.import_module("whisper.transcribe")
+    original_tqdm = transcribe_module.tqdm
+    original_add_word_timestamps = getattr(transcribe_module, "add_word_timestamps", None)
+    progress = None
+    
+    def make_progress(*args, **kwargs):
+        nonlocal progress
+        progress = SegmentProgress(on_update, **kwargs)
+        return progress
+    
+    def add_word_timestamps(*, segments, **kwargs):
+        result = original_add_word_timestamps(segments=segments, **kwargs)
+        # transcribe() still clears empty segments in place before the bar advances
+        progress.add_segments(segments)
+        return result
+    
+    transcribe_module.tqdm = types.SimpleNamespace(tqdm=make_progress)
+    if original_add_word_timestamps:
+        transcribe_module.add_word_timestamps = add_word_timestamps
+    try:
+        yield
+    finally:
+        transcribe_module.tqdm = original_tqdm
+        if original_add_word_timestamps:
+            transcribe_module.add_word_timestamps = original_add_word_timestamps
+
+def transcribe_audio(whisper_model, audio, language="en", on_update=None, word_timestamps=True, vad=True):
+    """
+    Transcribe an audio file path or decoded 16 kHz array into the app's
+    {text, segments} format, with per-word timestamps by default.
+    on_update(new_segments, processed_seconds, total_seconds) is called as
+    each window is decoded. Without word timestamps whisper hands the window's
+    segments to nothing we can hook, so only progress is reported per window
+    and the segments follow in one last update.
+    
+    With vad, non-speech regions are found before decoding and only the
+    speech is decoded (timestamps stay on the original timeline). The audio
+    time skipped is reported as "skipped_seconds".
+    """
+    import whisper
+    options = {"language": language, "word_timestamps": word_timestamps}
+    if isinstance(audio, str):
+        audio = whisper.load_audio(audio)
+    duration = len(audio) / whisper.audio.SAMPLE_RATE
+    
+    skipped_seconds = 0.0
+    if vad and "clip_timestamps" in inspect.signature(whisper.transcribe).parameters:
+        vad_start = time.time()
+        clips = speech_clips(detect_speech(audio, whisper.audio.SAMPLE_RATE), duration)
+        skipped_seconds = duration - sum(end - start for start, end in clips)
+        logger.info(
+            f"VAD found {len(clips)} speech clip(s) in {time.time() - vad_start:.1f}s, "
+            f"skipping {skipped_seconds:.1f}s of {duration:.1f}s"
+        )
+        if not clips:
+            return {"text": "", "segments": [], "audio_seconds": round(duration, 2), "skipped_seconds": round(duration, 2)}
+        if skipped_seconds > 0:
+            options["clip_timestamps"] = [t for clip in clips for t in clip]
+    elif vad:
+        logger.warning("This whisper version has no clip_timestamps; transcribing without VAD")
+    
+    reported = 0
+    
+    def on_window(new_segments, processed_seconds, total_seconds):
+        nonlocal reported
+        reported += len(new_segments)
+        on_update(new_segments, processed_seconds, total_seconds)
+    
+    if on_update:
+        with report_progress(on_window):
+            result = whisper_model.transcribe(audio, **options)
+    else:
+        result = whisper_model.transcribe(audio, **options)
+    segments = [format_segment(segment) for segment in result["segments"]]
+    if on_update and reported < len(segments):
+        on_update(segments[reported:], duration, duration)
+    return {
+        "text": result["text"],
+        "segments": segments,
+        "audio_seconds": round(duration, 2),
+        "skipped_seconds": round(skipped_seconds, 2)
+    }
+
+class PartialSegmentsFile:
+    """
+    A .segments.json.partial next to path that stays a valid JSON list while
+    segments are appended. Each append rewrites only the closing bracket, and
+    the file is formatted exactly like json.dump(segments, f, indent=2).
+    commit() moves the final segments onto path; discard() removes the file.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = f"{path}.partial"
+        self.file = open(self.partial_path, "w+b")
+        self.file.write(b"[]")
+        self.file.flush()
+        self.tail = 1
+        self.count = 0
+    
+    def append(self, segments):
+        if not segments:
+            return
+        body = ",\n".join(
+            "\n".join(f"  {line}" for line in json.dumps(segment, indent=2).splitlines())
+            for segment in segments
+        )
+        self.file.seek(self.tail)
+        self.file.write(f"{',' if self.count else ''}\n{body}\n]".encode("utf-8"))
+        self.file.truncate()
+        self.file.flush()
+        self.tail = self.file.tell() - 2
+        self.count += len(segments)
+    
+    def commit(self, segments):
+        """Rewrite the file with the final segments and replace path with it"""
+        self.file.seek(0)
+        self.file.write(json.dumps(segments, indent=2).encode("utf-8"))
+        self.file.truncate()
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+    
+    def discard(self):
+        self.file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.partial_path)
+
+def notify(event, **data):
+    send({"id": current_request_id, "event": event, **data})
+
+def transcribe(audio_path, model="base", language="en", stream=False, segments_path=None,
+               word_timestamps=True, vad=True):
+    start = time.time()
+    partial = PartialSegmentsFile(segments_path) if segments_path else None
+    
+    def on_update(new_segments, processed_seconds, total_seconds):
+        if partial:
+            partial.append(new_segments)
+        if stream:
+            if new_segments:
+                notify("segments", segments=new_segments)
+            notify("progress", processed_seconds=round(processed_seconds, 2), total_seconds=round(total_seconds, 2))
+    
+    try:
+        result = transcribe_audio(
+            get_model(model), audio_path, language,
+            on_update if stream or partial else None, word_timestamps, vad
+        )
+    except BaseException:
+        if partial:
+            partial.discard()
+        raise
+    if partial:
+        partial.commit(result["segments"])
+    logger.info(
+        f"Transcribed {audio_path} in {time.time() - start:.1f}s "
+        f"({result['skipped_seconds']:.1f}s of {result['audio_seconds']:.1f}s skipped as non-speech)"
+    )
+    return result
+
+def unload(model=None):
+    names = [model] if model else list(models)
+    for name in names:
+        models.pop(name, None)
+    if names:
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+    return {"unloaded": names}
+
+def ping():
+    return {"models": sorted(models)}
+
+METHODS = {
+    "ping": ping,
+    "load_model": load_model,
+    "transcribe": transcribe,
+    "unload": unload,
+}
+
+def send(message):
+    protocol_out.write(json.dumps(message) + "\n")
+    protocol_out.flush()
+
+def main():
+    global current_request_id
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="whisper-service: %(message)s")
+    # Anything whisper or tqdm prints must not corrupt the protocol stream
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            send({"id": None, "error": {"message": f"Invalid request: {e}"}})
+            continue
+
+        request_id = request.get("id")
+        current_request_id = request_id
+        method = request.get("method")
+        if method == "shutdown":
+            send({"id": request_id, "result": {}})
+            break
+        if method not in METHODS:
+            send({"id": request_id, "error": {"message": f"Unknown method: {method}"}})
+            continue
+
+        try:
+            result = METHODS[method](**(request.get("params") or {}))
+            send({"id": request_id, "result": result})
+        except Exception as e:
+            logger.exception(f"{method} failed")
+            send({"id": request_id, "error": {"message": str(e)}})
+
+if __name__ == "__main__":
+    main()
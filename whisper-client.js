@@ -470,7 +470,7 @@
     }
 
     // Transcribe using service
-    async transcribeWithService(audioPath, modelName = 'base', language = 'en') {
+    async transcribeWithService(audioPath, modelName = 'base', language = 'en', segmentsPath = null) {
         try {
             // Read the audio file and convert to base64
             const audioBuffer = fs.readFileSync(audioPath);
@@ -482,7 +482,8 @@
                 audioData: audioBase64,
                 filename,
                 modelName,
-                language
+                language,
+                segmentsPath
             });
             
             if (jobResult.error) {
@@ -495,7 +496,7 @@
             const maxAttempts = 600; // 10 minutes max
             
             while (attempts < maxAttempts) {
-                const status = await ipcRenderer.invoke('whisper-get-job-status', jobId);
+                const status = await ipcRenderer.invoke('whisper-get-job-status', { jobId });
                 
                 if (status.status === 'completed') {
                     const result = await ipcRenderer.invoke('whisper-get-job-result', jobId);
@@ -508,6 +509,10 @@
                     throw new Error(status.error || 'Transcription failed');
                 }
                 
+                if (status.message && window.updateTranscriptionProgress) {
+                    window.updateTranscriptionProgress(status.message);
+                }
+                
                 // Wait 1 second before next poll
                 await new Promise(resolve => setTimeout(resolve, 1000));
                 attempts++;
@@ -570,7 +575,7 @@
             }
         } else {
             // Use local transcription through service compatibility layer
-            return await this.transcribeWithService(audioPath, modelName, language);
+            return await this.transcribeWithService(audioPath, modelName, language, options.segmentsPath);
         }
     }
     
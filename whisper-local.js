@@ -136,12 +136,18 @@ class WhisperLocal {
         
         try {
             // Use Python whisper for transcription
-            const result = await this.whisperPython.transcribe(audioPath, modelName, language);
+            const result = await this.whisperPython.transcribe(audioPath, modelName, language, {
+                segmentsPath: options.segmentsPath,
+                onSegments: options.onSegments,
+                onProgress: options.onProgress
+            });
             
             return {
                 text: result.text,
                 segments: result.segments,
-                language: language
+                language: language,
+                audioSeconds: result.audio_seconds,
+                skippedSeconds: result.skipped_seconds
             };
         } catch (error) {
             console.error('Transcription error:', error);
@@ -155,17 +161,26 @@ class WhisperLocal {
         }
     }
 
-    // Unload current model (Python whisper manages its own memory)
+    // Unload current model from the transcription service
     unloadModel() {
+        if (this.currentModel && this.whisperPython.service) {
+            this.whisperPython.request('unload', { model: this.currentModel }).catch((error) => {
+                console.error('Error unloading model:', error);
+            });
+        }
         this.currentModel = null;
         this.isInitialized = false;
-        return { success: true, message: 'Model reference cleared' };
+        return { success: true, message: 'Model unloaded' };
     }
 
-    // Unload all models
+    // Unload all models by stopping the transcription service
     unloadAllModels() {
-        this.unloadModel();
-        return { success: true, message: 'Model references cleared' };
+        this.currentModel = null;
+        this.isInitialized = false;
+        this.whisperPython.stopService().catch((error) => {
+            console.error('Error stopping whisper service:', error);
+        });
+        return { success: true, message: 'Models unloaded' };
     }
 }
 
@@ -5,11 +5,19 @@ const os = require('os');
 const util = require('util');
 const execPromise = util.promisify(exec);
 
+// Long-lived transcription service (tools/whisper_service.py), spoken to over
+// line-delimited JSON-RPC on stdin/stdout so models stay loaded between chapters
+const SERVICE_SCRIPT = path.join(__dirname, 'tools', 'whisper_service.py');
+
 class WhisperPython {
     constructor() {
         this.modelsPath = path.join(os.homedir(), '.cache', 'whisper');
         this.pythonCommand = null;
         this.whisperCommand = null;
+        this.service = null;
+        this.serviceBuffer = '';
+        this.pendingRequests = new Map();
+        this.nextRequestId = 1;
     }
 
     // Check if Python is installed
@@ -136,111 +144,148 @@ class WhisperPython {
         return available;
     }
 
-    // Pre-download a model by loading it in Python
-    async preDownloadModel(modelName) {
+    // Start the transcription service if it isn't running
+    async startService() {
+        if (this.service) {
+            return this.service;
+        }
+        
         if (!await this.checkWhisper()) {
-            throw new Error('Whisper is not installed.');
+            throw new Error('Whisper is not installed. Please install it first.');
         }
         
-        // Create a Python script that just loads the model
-        const scriptContent = `
-import whisper
-import sys
-
-model_name = sys.argv[1]
-print(f"Loading {model_name} model...")
-model = whisper.load_model(model_name)
-print(f"Model {model_name} loaded successfully!")
-`;
-
-        const tempScript = path.join(os.tmpdir(), `whisper_download_${Date.now()}.py`);
-        fs.writeFileSync(tempScript, scriptContent);
+        // The script may be packed inside the app archive, where Python can't read it,
+        // so run a copy from the temp directory
+        const scriptPath = path.join(os.tmpdir(), `whisper_service_${process.pid}.py`);
+        fs.writeFileSync(scriptPath, fs.readFileSync(SERVICE_SCRIPT, 'utf8'));
         
-        try {
-            const { stdout, stderr } = await execPromise(
-                `${this.pythonCommand} "${tempScript}" "${modelName}"`,
-                { maxBuffer: 10 * 1024 * 1024 }
-            );
-            
-            // Clean up temp script
-            fs.unlinkSync(tempScript);
-            
-            return { success: true, output: stdout };
-        } catch (error) {
-            // Clean up temp script
-            if (fs.existsSync(tempScript)) {
-                fs.unlinkSync(tempScript);
+        const service = spawn(this.pythonCommand, [scriptPath], { stdio: ['pipe', 'pipe', 'pipe'] });
+        this.service = service;
+        this.serviceBuffer = '';
+        
+        service.stdout.on('data', (data) => {
+            this.serviceBuffer += data.toString();
+            const lines = this.serviceBuffer.split('\n');
+            this.serviceBuffer = lines.pop();
+            for (const line of lines) {
+                if (line.trim()) {
+                    this.handleServiceMessage(line);
+                }
             }
-            throw error;
-        }
+        });
+        
+        service.stderr.on('data', (data) => {
+            const output = data.toString();
+            if (!output.includes('UserWarning')) {
+                console.error('Whisper service:', output.trim());
+            }
+        });
+        
+        const onExit = (error) => {
+            if (this.service === service) {
+                this.service = null;
+            }
+            for (const { reject } of this.pendingRequests.values()) {
+                reject(error);
+            }
+            this.pendingRequests.clear();
+            if (fs.existsSync(scriptPath)) {
+                fs.unlinkSync(scriptPath);
+            }
+        };
+        service.on('exit', (code) => onExit(new Error(`Whisper service exited with code ${code}`)));
+        service.on('error', (err) => onExit(err));
+        
+        return service;
     }
-    
-    // Transcribe audio using Python whisper
-    async transcribe(audioPath, modelName = 'base', language = 'en') {
-        if (!await this.checkWhisper()) {
-            throw new Error('Whisper is not installed. Please install it first.');
+
+    handleServiceMessage(line) {
+        let message;
+        try {
+            message = JSON.parse(line);
+        } catch (e) {
+            console.error('Invalid message from whisper service:', line);
+            return;
         }
         
-        // Create a temporary Python script to run whisper and output JSON
-        const scriptContent = `
-import whisper
-import json
-import sys
-
-audio_path = sys.argv[1]
-model_name = sys.argv[2]
-language = sys.argv[3]
-
-# Load model
-model = whisper.load_model(model_name)
-
-# Transcribe
-result = model.transcribe(audio_path, language=language)
-
-# Output as JSON
-output = {
-    "text": result["text"],
-    "segments": []
-}
+        const pending = this.pendingRequests.get(message.id);
+        if (!pending) {
+            return;
+        }
+        
+        // Streaming notifications arrive before the request's final response
+        if (message.event) {
+            if (pending.onEvent) {
+                pending.onEvent(message);
+            }
+            return;
+        }
+        this.pendingRequests.delete(message.id);
+        
+        if (message.error) {
+            pending.reject(new Error(message.error.message));
+        } else {
+            pending.resolve(message.result);
+        }
+    }
 
-for segment in result["segments"]:
-    output["segments"].append({
-        "id": segment["id"],
-        "start": segment["start"],
-        "end": segment["end"],
-        "text": segment["text"].strip()
-    })
+    // Send a request to the service; requests queue up and are handled in order.
+    // onEvent receives any notifications the service streams for this request.
+    async request(method, params = {}, onEvent = null) {
+        const service = await this.startService();
+        const id = this.nextRequestId++;
+        
+        return new Promise((resolve, reject) => {
+            this.pendingRequests.set(id, { resolve, reject, onEvent });
+            service.stdin.write(JSON.stringify({ id, method, params }) + '\n');
+        });
+    }
 
-print(json.dumps(output))
-`;
+    // Stop the service, releasing every loaded model
+    async stopService() {
+        if (!this.service) {
+            return;
+        }
+        try {
+            await this.request('shutdown');
+        } catch (e) {
+            // Already exiting
+        }
+        if (this.service) {
+            this.service.kill();
+            this.service = null;
+        }
+    }
 
-        const tempScript = path.join(os.tmpdir(), `whisper_transcribe_${Date.now()}.py`);
-        fs.writeFileSync(tempScript, scriptContent);
+    // Pre-download a model by loading it in the service (it stays warm for transcription)
+    async preDownloadModel(modelName) {
+        const result = await this.request('load_model', { model: modelName });
+        return { success: true, output: `Model ${modelName} loaded in ${result.load_seconds}s` };
+    }
+    
+    // Transcribe audio using Python whisper. With onSegments/onProgress the service
+    // streams segments and progress as they are decoded; with segmentsPath it keeps
+    // the segments decoded so far in segmentsPath + ".partial" until it completes.
+    async transcribe(audioPath, modelName = 'base', language = 'en', options = {}) {
+        const { segmentsPath, onSegments, onProgress } = options;
+        const stream = !!(onSegments || onProgress);
         
-        try {
-            const { stdout, stderr } = await execPromise(
-                `${this.pythonCommand} "${tempScript}" "${audioPath}" "${modelName}" "${language}"`,
-                { maxBuffer: 50 * 1024 * 1024 } // 50MB buffer for large transcriptions
-            );
-            
-            if (stderr && !stderr.includes('UserWarning')) {
-                console.error('Whisper stderr:', stderr);
-            }
-            
-            const result = JSON.parse(stdout);
-            
-            // Clean up temp script
-            fs.unlinkSync(tempScript);
-            
-            return result;
-        } catch (error) {
-            // Clean up temp script
-            if (fs.existsSync(tempScript)) {
-                fs.unlinkSync(tempScript);
+        return await this.request('transcribe', {
+            audio_path: audioPath,
+            model: modelName,
+            language,
+            stream,
+            segments_path: segmentsPath || null
+        }, stream ? (message) => {
+            if (message.event === 'segments' && onSegments) {
+                onSegments(message.segments);
+            } else if (message.event === 'progress' && onProgress) {
+                onProgress({
+                    processedSeconds: message.processed_seconds,
+                    totalSeconds: message.total_seconds
+                });
             }
-            
-            throw error;
-        }
+        } : null);
     }
 }
 